@@ -3,37 +3,107 @@
 雨の降り始めを通知します。
 
 Usage:
-  app.py [-c CONFIG] [-n COUNT] [-D]
+  app.py [-c CONFIG] [-n COUNT] [-P] [-D]
 
 Options:
   -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
   -n COUNT     	    : 実行回数 [default: 0]
+  -P                : 何周期かに 1 回プロファイルを取得し、設定の profile.dir にレポートを書き出します。
   -D                : デバッグモードで動作します。
 """
 
+import asyncio
 import logging
 import time
 
 import my_lib.footprint
+import rainfall.breaker
+import rainfall.ingest
+import rainfall.metrics
 import rainfall.monitor
+import rainfall.notifier
+import rainfall.profiler
+import rainfall.radar
+import rainfall.reload
+import rainfall.scheduler
+import rainfall.site
+import rainfall.status
 
 SCHEMA_CONFIG = "config.schema"
 
 
-def do_work(config, count=0):
+async def do_work_async(config, count=0, config_file=None):
+    for site_config in rainfall.site.get_config_list(config):
+        rainfall.monitor.load_state(site_config)
+        rainfall.monitor.init_voice(site_config)
+        rainfall.monitor.init_nowcast(site_config)
+
+    rainfall.breaker.init(config)
+    rainfall.ingest.start(config)
+    rainfall.radar.start(config)
+    rainfall.status.start(config)
+    if config_file is not None:
+        rainfall.reload.start(config_file, SCHEMA_CONFIG)
+    try:
+        await watch_loop(config, count)
+    finally:
+        rainfall.reload.stop()
+        rainfall.status.stop()
+        rainfall.radar.stop()
+        rainfall.ingest.stop()
+
+
+async def watch_all_async(config, fetch):
+    # NOTE: 外部サービスが応答しなくても、監視ループ (と Liveness の更新) が止まらないようにする
+    deadline = rainfall.monitor.get_cycle_deadline(config)
+    try:
+        return await asyncio.wait_for(rainfall.monitor.watch_all_async(config, fetch=fetch), deadline)
+    except asyncio.TimeoutError:
+        logging.warning("Watch cycle exceeded the deadline (%.1f sec)", deadline)
+        return [None]
+
+
+async def watch_loop(config, count):
     i = 0
+    interval = None
+    fetch = True
+    last_fetch = 0
     while True:
+        # NOTE: 設定ファイルが更新されていた場合は、周期の合間に新しい設定に切り替える
+        config = rainfall.reload.apply(config)
+
         start_time = time.time()
-        rainfall.monitor.watch(config)
+        if fetch:
+            last_fetch = start_time
+        with rainfall.profiler.sample(config, i), rainfall.metrics.measure("cycle"):
+            result_list = await watch_all_async(config, fetch)
 
         my_lib.footprint.update(config["liveness"]["file"]["watch"])
+        rainfall.metrics.export(config)
+        rainfall.status.publish(config, result_list, i, start_time)
 
         i += 1
         if i == count:
             logging.info("The specified number of attempts has been reached, so the process will end.")
+            rainfall.notifier.join()
+            rainfall.metrics.export(config)
             break
 
-        time.sleep(max(config["watch"]["interval_sec"] - (time.time() - start_time), 1))
+        interval = rainfall.scheduler.next_interval(config, result_list, interval)
+        reconcile_sec = rainfall.scheduler.get_reconcile_interval(config)
+
+        deadline = start_time + interval
+        if reconcile_sec is not None:
+            deadline = min(deadline, last_fetch + reconcile_sec)
+
+        # NOTE: データがプッシュされた場合は、待たずにそのデータで判定する。プッシュが続いていても、
+        # reconcile_sec 毎に InfluxDB と突き合わせる
+        pushed = await rainfall.ingest.wait(max(deadline - time.time(), 1))
+        fetch = (not pushed) or ((reconcile_sec is not None) and (time.time() - last_fetch >= reconcile_sec))
+
+
+def do_work(config, count=0, config_file=None):
+    asyncio.run(do_work_async(config, count, config_file))
 
 
 if __name__ == "__main__":
@@ -45,6 +115,7 @@ if __name__ == "__main__":
 
     config_file = args["-c"]
     count = int(args["-n"])
+    profile_mode = args["-P"]
     debug_mode = args["-D"]
 
     log_level = logging.DEBUG if debug_mode else logging.INFO
@@ -53,4 +124,7 @@ if __name__ == "__main__":
 
     config = my_lib.config.load(config_file, SCHEMA_CONFIG)
 
-    do_work(config, count)
+    if profile_mode:
+        rainfall.profiler.init(config)
+
+    do_work(config, count, config_file)
@@ -10,16 +10,109 @@ Options:
   -D                : デバッグモードで動作します。
 """
 
+import hashlib
+import json
 import logging
+import os
 import pathlib
 import sys
-
-import my_lib.healthz
+import urllib.request
 
 SCHEMA_CONFIG = "config.schema"
+SNAPSHOT_DIR = pathlib.Path("/dev/shm")  # noqa: S108
+STATUS_TIMEOUT_SEC = 5
+
+
+def get_snapshot_path(config_file):
+    key = hashlib.sha1(str(pathlib.Path(config_file).resolve()).encode()).hexdigest()[:12]  # noqa: S324
+
+    return SNAPSHOT_DIR / f"rainfall.healthz.{key}.json"
+
+
+def get_stamp(config_file):
+    # NOTE: 設定ファイルかスキーマが更新されたら、スナップショットを作り直す
+    stamp = []
+    for path in [pathlib.Path(config_file), pathlib.Path(SCHEMA_CONFIG)]:
+        try:
+            stat = path.stat()
+        except OSError:
+            stamp.append(None)
+            continue
+        stamp.append([stat.st_mtime_ns, stat.st_size])
+
+    return stamp
+
+
+def make_snapshot(config):
+    import rainfall.scheduler
+
+    return {
+        "target_list": [
+            {
+                "name": name,
+                "liveness_file": config["liveness"]["file"][name],
+                "interval": rainfall.scheduler.get_liveness_interval(config),
+            }
+            for name in ["watch"]
+        ],
+        **{key: config[key] for key in ["metrics", "status"] if key in config},
+    }
+
+
+def load_snapshot(config_file):
+    try:
+        snapshot = json.loads(get_snapshot_path(config_file).read_text())
+    except (OSError, ValueError):
+        return None
+
+    if snapshot.get("stamp") != get_stamp(config_file):
+        return None
+
+    return snapshot
+
+
+def write_snapshot(config_file, config):
+    snapshot = {"stamp": get_stamp(config_file), **make_snapshot(config)}
+
+    # NOTE: 複数のプローブが同時に書き込んでも壊れないよう、別名で書いてから置き換える
+    path = get_snapshot_path(config_file)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}")
+    try:
+        tmp_path.write_text(json.dumps(snapshot))
+        tmp_path.replace(path)
+    except OSError:
+        logging.warning("Failed to write config snapshot: %s", path)
+
+    return snapshot
+
+
+def get_snapshot(config_file):
+    snapshot = load_snapshot(config_file)
+    if snapshot is not None:
+        return snapshot
+
+    # NOTE: 設定の読み込みと検証は重いので、スナップショットが無いか古い場合のみ行う
+    import my_lib.config
+
+    logging.debug("Config snapshot is missing or outdated. Validating %s.", config_file)
+
+    return write_snapshot(config_file, my_lib.config.load(config_file, pathlib.Path(SCHEMA_CONFIG)))
+
+
+def get_target_list(snapshot):
+    return [
+        {
+            "name": target["name"],
+            "liveness_file": pathlib.Path(target["liveness_file"]),
+            "interval": target["interval"],
+        }
+        for target in snapshot["target_list"]
+    ]
 
 
 def check_liveness(target_list):
+    import my_lib.healthz
+
     for target in target_list:
         if not my_lib.healthz.check_liveness(target["name"], target["liveness_file"], target["interval"]):
             return False
@@ -27,12 +120,43 @@ def check_liveness(target_list):
     return True
 
 
+def check_status(status_config):
+    # NOTE: 監視結果を HTTP で返している場合は、ファイルの代わりにそれで生きているかを確かめる
+    host = status_config.get("host", "0.0.0.0")  # noqa: S104
+    if host == "0.0.0.0":  # noqa: S104
+        host = "127.0.0.1"
+    url = f"http://{host}:{status_config['port']}/healthz"
+
+    try:
+        with urllib.request.urlopen(url, timeout=STATUS_TIMEOUT_SEC) as res:
+            return res.status == 200
+    except OSError:
+        logging.warning("Status endpoint is not healthy: %s", url)
+        return False
+
+
+def check_cycle_time(config):
+    if ("metrics" not in config) or ("cycle_p95_sec" not in config["metrics"]):
+        return True
+
+    import rainfall.metrics
+
+    cycle_p95 = rainfall.metrics.read_quantile(config["metrics"]["file"], "cycle", 0.95)
+    if (cycle_p95 is not None) and (cycle_p95 > config["metrics"]["cycle_p95_sec"]):
+        logging.warning(
+            "p95 of cycle time is too long (%.2f sec > %.2f sec)",
+            cycle_p95,
+            config["metrics"]["cycle_p95_sec"],
+        )
+        return False
+
+    return True
+
+
 ######################################################################
 if __name__ == "__main__":
     import docopt
-    import my_lib.config
     import my_lib.logger
-    import my_lib.pretty
 
     args = docopt.docopt(__doc__)
 
@@ -43,20 +167,15 @@ if __name__ == "__main__":
 
     my_lib.logger.init("notify.rainfall", level=log_level)
 
-    config = my_lib.config.load(config_file, pathlib.Path(SCHEMA_CONFIG))
+    # NOTE: 頻繁に実行されるので、検証済みの設定のスナップショットを使う
+    snapshot = get_snapshot(config_file)
+    target_list = get_target_list(snapshot)
 
-    target_list = [
-        {
-            "name": name,
-            "liveness_file": pathlib.Path(config["liveness"]["file"][name]),
-            "interval": config[name]["interval_sec"],
-        }
-        for name in ["watch"]
-    ]
+    logging.debug(target_list)
 
-    logging.debug(my_lib.pretty.format(target_list))
+    is_alive = check_status(snapshot["status"]) if "status" in snapshot else check_liveness(target_list)
 
-    if check_liveness(target_list):
+    if is_alive and check_cycle_time(snapshot):
         logging.info("OK.")
         sys.exit(0)
     else:
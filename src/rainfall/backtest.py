@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+過去のセンサーデータを使って、雨の降り始めの判定条件を評価します。
+
+過去の天気予報は残っていないので、音声通知は観測した雨量のみで判定します。実際には予報雨量が
+閾値以上の場合にも音声通知するので、予報で雨とされていた日は、音声通知の回数を少なく、
+音声通知までの遅延を長く見積もります。
+
+Usage:
+  backtest.py [-c CONFIG] [-s START] [-e END] [-d DATA] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -s START          : 評価期間の開始日時。[default: -90d]
+  -e END            : 評価期間の終了日時。[default: now()]
+  -d DATA           : 取得したデータを保存する NumPy のファイル。
+                      既に存在する場合は、InfluxDB から取得せずに使います。
+  -D                : デバッグモードで動作します。
+"""
+
+import datetime
+import itertools
+import logging
+import pathlib
+
+import my_lib.time
+import numpy as np
+import rainfall.monitor
+import rainfall.sensor
+
+# NOTE: 1分毎に集約して、全期間を一括で取得する
+FLUX_BULK_QUERY = """
+data = from(bucket: "{bucket}")
+    |> range(start: {start}, stop: {stop})
+    |> filter(fn: (r) => r._measurement == "{measure}")
+    |> filter(fn: (r) => r.hostname == "{hostname}")
+    |> map(fn: (r) => ({{ r with _value: float(v: r._value) }}))
+
+data
+    |> filter(fn: (r) => r._field == "raining")
+    |> aggregateWindow(every: 1m, fn: max, createEmpty: false)
+    |> yield(name: "raining")
+
+data
+    |> filter(fn: (r) => r._field == "rain")
+    |> aggregateWindow(every: 1m, fn: sum, createEmpty: false)
+    |> yield(name: "rain")
+
+data
+    |> filter(fn: (r) => r._field == "solar_rad")
+    |> aggregateWindow(every: 1m, fn: mean, createEmpty: false)
+    |> yield(name: "solar_rad")
+"""
+SOLAR_RAD_BEFORE_MIN = 10  # NOTE: 降り始めの何分前までの日射量を見るか (monitor と同じ)
+
+PARAM_GRID = {
+    "solar_rad_threshold": [400, 500, rainfall.monitor.SOLAR_RAD_THRESHOLD, 700, 800],
+    "sum_min": [1, rainfall.monitor.SUM_MIN, 5, 10],
+    "continuous_min": [10, rainfall.monitor.CONTINUOUS_MIN, 60],
+    "voice_threshold": [rainfall.monitor.VOICE_THRESHOLD, 0.2, 0.5],
+}
+
+
+def load(config, start, stop):
+    sensor_config = config["sensor"]["rain_fall"]
+
+    flux = FLUX_BULK_QUERY.format(
+        bucket=config["influxdb"]["bucket"],
+        measure=sensor_config["measure"],
+        hostname=sensor_config["hostname"],
+        start=start,
+        stop=stop,
+    )
+
+    point_map = {field: ([], []) for field in rainfall.sensor.FIELD_LIST}
+    query_api = rainfall.sensor.get_client(config["influxdb"]).query_api()
+    for record in query_api.query_stream(query=flux):
+        point_map[record.values["result"]][0].append(record.get_time().timestamp())
+        point_map[record.values["result"]][1].append(record.get_value())
+
+    return to_grid({field: (np.array(t), np.array(v)) for field, (t, v) in point_map.items()})
+
+
+def to_grid(point_map):
+    # NOTE: 全フィールドを 1 分刻みの共通の時間軸に並べる。欠損は NaN
+    time_all = np.concatenate([time_array for time_array, _ in point_map.values()])
+    if len(time_all) == 0:
+        raise ValueError("No data")  # noqa: TRY003, EM101
+
+    start = int(time_all.min() // 60 * 60)
+    length = int((time_all.max() - start) // 60) + 1
+
+    data = {"start": start, "length": length}
+    for field, (time_array, value_array) in point_map.items():
+        grid = np.full(length, np.nan)
+        grid[((time_array - start) // 60).astype(np.int64)] = value_array
+        data[field] = grid
+
+    return data
+
+
+def save(path, data):
+    np.savez_compressed(path, **data)
+
+
+def restore(path):
+    with np.load(path) as npz:
+        return {key: npz[key].item() if npz[key].ndim == 0 else npz[key] for key in npz.files}
+
+
+def make_param(grid=None):
+    grid = PARAM_GRID if grid is None else grid
+    combination = list(itertools.product(*grid.values()))
+
+    return {key: np.array([value[i] for value in combination]) for i, key in enumerate(grid.keys())}
+
+
+def rolling_sum(value, minutes):
+    cumsum = np.concatenate([[0.0], np.cumsum(np.nan_to_num(value))])
+    index = np.arange(1, len(value) + 1)
+
+    return cumsum[index] - cumsum[np.maximum(index - minutes, 0)]
+
+
+def ffill(value):
+    # NOTE: 欠損していない直近のデータの位置
+    index = np.where(np.isnan(value), -1, np.arange(len(value)))
+    return np.maximum.accumulate(index)
+
+
+def ffill_value(value):
+    index = ffill(value)
+    return np.where(index >= 0, value[np.maximum(index, 0)], np.nan)
+
+
+def get_solar_rad_at(data, edge):
+    # NOTE: 降り始めの 10 分前から 1 分後までの最後の日射量
+    last_index = ffill(data["solar_rad"])[np.minimum(edge + 1, data["length"] - 1)]
+    valid = (last_index >= 0) & (last_index >= edge - SOLAR_RAD_BEFORE_MIN)
+
+    return np.where(valid, data["solar_rad"][np.maximum(last_index, 0)], np.nan)
+
+
+def get_hour(data, voice_hour):
+    start = datetime.datetime.fromtimestamp(data["start"], tz=my_lib.time.get_zoneinfo())
+    hour = ((start.hour * 60 + start.minute + np.arange(data["length"])) // 60) % 24
+
+    return (hour >= voice_hour["start"]) & (hour <= voice_hour["end"])
+
+
+def get_voice_fire(data, param, edge, next_edge, voice_hour):
+    # NOTE: 降り始め以降、次の降り始めまでに、音声通知の条件を満たす最初の時刻を
+    # (積算時間, 閾値) の組み合わせ毎にまとめて求める。予報雨量による音声通知は含まない
+    in_hour = get_hour(data, voice_hour)
+    fire = np.full((len(edge), len(param["sum_min"])), -1, dtype=np.int64)
+
+    for sum_min, threshold in set(
+        zip(param["sum_min"].tolist(), param["voice_threshold"].tolist(), strict=True)
+    ):
+        cond_index = np.flatnonzero((rolling_sum(data["rain"], sum_min) >= threshold) & in_hour)
+        target = (param["sum_min"] == sum_min) & (param["voice_threshold"] == threshold)
+        if len(cond_index) == 0:
+            continue
+
+        pos = np.searchsorted(cond_index, edge)
+        candidate = cond_index[np.minimum(pos, len(cond_index) - 1)]
+        fire[:, target] = np.where((pos < len(cond_index)) & (candidate < next_edge), candidate, -1)[:, None]
+
+    return fire
+
+
+def evaluate(data, param, voice_hour):
+    raining = np.nan_to_num(ffill_value(data["raining"])) > 0.5
+    edge = np.flatnonzero(raining[1:] & ~raining[:-1]) + 1
+    next_edge = np.append(edge[1:], data["length"])
+
+    solar_rad = get_solar_rad_at(data, edge)
+    voice_fire = get_voice_fire(data, param, edge, next_edge, voice_hour)
+
+    size = len(param["sum_min"])
+    result = {
+        key: np.zeros(size, dtype=np.int64)
+        for key in ["line", "voice", "suppressed_solar", "suppressed_continuous"]
+    }
+    voice_delay = np.zeros(size, dtype=np.int64)
+    last_line = np.full(size, -(10**9), dtype=np.int64)
+    last_voice = np.full(size, -(10**9), dtype=np.int64)
+
+    # NOTE: 通知の抑制は直前の通知時刻に依存するので、降り始め毎に順に処理し、
+    # パラメータの組み合わせ方向はベクトル化する
+    for i, start in enumerate(edge):
+        # NOTE: 監視と同じ判定を、判定条件の組毎にまとめて行う (時刻の単位は分)
+        sunny = rainfall.monitor.is_sunny(param, solar_rad[i])
+
+        continuous = rainfall.monitor.is_continuous(param, (start - last_line) * 60)
+        result["suppressed_continuous"] += continuous
+        result["suppressed_solar"] += ~continuous & sunny
+        result["line"] += ~continuous & ~sunny
+        last_line[:] = start
+
+        continuous = rainfall.monitor.is_continuous(param, (start - last_voice) * 60)
+        fire = ~continuous & ~sunny & (voice_fire[i] >= 0)
+        result["voice"] += fire
+        voice_delay += np.where(fire, voice_fire[i] - start, 0)
+        last_voice = np.where(continuous | sunny, start, np.where(fire, voice_fire[i], last_voice))
+
+    result["voice_delay_min"] = np.divide(
+        voice_delay, result["voice"], out=np.full(size, np.nan), where=result["voice"] != 0
+    )
+    result["edge"] = len(edge)
+
+    return result
+
+
+def format_table(param, result):
+    header = [*param.keys(), "line", "voice", "suppressed_solar", "suppressed_continuous", "voice_delay_min"]
+    line_list = [" ".join(f"{name:>21s}" for name in header)]
+
+    for i in range(len(param["sum_min"])):
+        value_list = [
+            *[param[key][i] for key in param],
+            *[result[key][i] for key in header[len(param) :]],
+        ]
+        line_list.append(" ".join(f"{value:>21g}" for value in value_list))
+
+    line_list.append(
+        "NOTE: voice and voice_delay_min use measured rain only (forecast-triggered voice is not counted)"
+    )
+
+    return "\n".join(line_list)
+
+
+if __name__ == "__main__":
+    import time
+
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    start = args["-s"]
+    stop = args["-e"]
+    data_file = args["-d"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    if (data_file is not None) and pathlib.Path(data_file).exists():
+        data = restore(data_file)
+    else:
+        data = load(config, start, stop)
+        if data_file is not None:
+            save(data_file, data)
+
+    logging.info("Loaded %d minutes of data", data["length"])
+
+    param = make_param()
+
+    start_time = time.perf_counter()
+    result = evaluate(data, param, config["notify"]["voice"]["hour"])
+    logging.info(
+        "Evaluated %d parameter sets over %d rain starts in %.2f sec",
+        len(param["sum_min"]),
+        result["edge"],
+        time.perf_counter() - start_time,
+    )
+
+    print(format_table(param, result))  # noqa: T201
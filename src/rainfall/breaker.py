@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""外部サービスの呼び出しにサーキットブレーカーを設け、失敗が続くサービスをしばらく呼ばないようにします。"""
+
+import concurrent.futures
+import contextlib
+import dataclasses
+import logging
+import threading
+import time
+
+THRESHOLD = 3  # NOTE: 連続してこの回数失敗したら、呼び出しを止める
+COOLDOWN_SEC = 60  # NOTE: 呼び出しを止めてから、再度試すまでの時間
+
+STATE_LIST = ["closed", "open", "half_open"]
+
+
+class OpenError(Exception):
+    def __init__(self, name):
+        """ブレーカー name が開いていて、呼び出しを行わなかったことを表します。"""
+        super().__init__(f"Circuit breaker is open: {name}")
+        self.name = name
+
+
+@dataclasses.dataclass
+class Breaker:
+    name: str
+    threshold: int = THRESHOLD
+    cooldown_sec: float = COOLDOWN_SEC
+    state: str = "closed"
+    failure: int = 0  # NOTE: 連続して失敗した回数
+    failure_total: int = 0
+    opened: float = 0.0
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if (self.state == "open") and (time.time() - self.opened >= self.cooldown_sec):
+                # NOTE: 1 回だけ試しに呼び出し、その結果で閉じるか開いたままにするかを決める
+                logging.info("Circuit breaker half-open: %s", self.name)
+                self.state = "half_open"
+                return True
+
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logging.info("Circuit breaker closed: %s", self.name)
+            self.state = "closed"
+            self.failure = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failure += 1
+            self.failure_total += 1
+
+            if (self.state == "half_open") or (self.failure >= self.threshold):
+                if self.state != "open":
+                    logging.warning(
+                        "Circuit breaker opened: %s (skipping for %d sec)", self.name, self.cooldown_sec
+                    )
+                self.state = "open"
+                self.opened = time.time()
+
+
+_breaker_map = {}
+_setting = {"threshold": THRESHOLD, "cooldown_sec": COOLDOWN_SEC}
+_lock = threading.Lock()
+
+# NOTE: 応答しない呼び出しを待たずに済むよう、別スレッドで実行してタイムアウトさせる
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="breaker")
+
+
+def init(config):
+    breaker_config = config["watch"].get("breaker", {})
+
+    with _lock:
+        _setting["threshold"] = breaker_config.get("threshold", THRESHOLD)
+        _setting["cooldown_sec"] = breaker_config.get("cooldown_sec", COOLDOWN_SEC)
+        breaker_list = list(_breaker_map.values())
+
+    # NOTE: 設定を読み込み直した場合は、既に作ったサーキットブレーカーにも反映する
+    for breaker in breaker_list:
+        with breaker.lock:
+            breaker.threshold = _setting["threshold"]
+            breaker.cooldown_sec = _setting["cooldown_sec"]
+
+
+def get(name):
+    with _lock:
+        if name not in _breaker_map:
+            _breaker_map[name] = Breaker(name=name, **_setting)
+        return _breaker_map[name]
+
+
+@contextlib.contextmanager
+def guard(name):
+    breaker = get(name)
+    if not breaker.allow():
+        raise OpenError(name)
+
+    try:
+        yield
+    except Exception:
+        breaker.record_failure()
+        raise
+
+    breaker.record_success()
+
+
+def call(name, timeout, func, *args):
+    with guard(name):
+        future = _executor.submit(func, *args)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            logging.warning("Timeout calling %s (%.1f sec)", name, timeout)
+            raise
+
+
+def get_stat():
+    with _lock:
+        breaker_list = list(_breaker_map.values())
+
+    stat = {}
+    for breaker in breaker_list:
+        with breaker.lock:
+            stat[breaker.name] = {"state": breaker.state, "failure_total": breaker.failure_total}
+
+    return stat
+
+
+def clear():
+    with _lock:
+        _breaker_map.clear()
+        _setting["threshold"] = THRESHOLD
+        _setting["cooldown_sec"] = COOLDOWN_SEC
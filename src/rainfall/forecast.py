@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+複数の天気予報から降水量を並行して取得し、1 時間毎の値にまとめてキャッシュします。
+
+Usage:
+  forecast.py [-c CONFIG] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -D                : デバッグモードで動作します。
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+import lxml.html
+import my_lib.time
+import my_lib.weather
+import numpy as np
+import rainfall.breaker
+import requests
+
+CACHE_TTL_SEC = 30 * 60  # NOTE: 予報の更新は数時間毎なので、これ位の間隔で十分
+DEADLINE_SEC = 10  # NOTE: これ以上かかる予報は待たずに、揃っている予報だけを使う
+HOURS = 48  # NOTE: 今日と明日の分
+
+TENKI_TABLE_ID = {"today": "forecast-point-1h-today", "tomorrow": "forecast-point-1h-tomorrow"}
+
+_cache = {}
+_inflight_map = {}  # NOTE: 取得中の予報。同じ予報を使う地点は、同じ取得の結果を待つ
+_cache_lock = threading.Lock()
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="forecast")
+_session = requests.Session()
+
+# NOTE: 応答しない予報でスレッドを使い切らないよう、取得中の予報は終わるまで新たに取得しない
+_running_map = {}
+_timeout_set = set()  # NOTE: 期限切れとして記録済みの取得
+_running_lock = threading.Lock()
+
+
+def get_ttl(config):
+    return config["weather"]["forecast"].get("ttl_sec", CACHE_TTL_SEC)
+
+
+def get_deadline(config):
+    return config["weather"]["forecast"].get("deadline_sec", DEADLINE_SEC)
+
+
+def fetch_yahoo(forecast_config, deadline):  # noqa: ARG001
+    weather_info = my_lib.weather.get_weather_yahoo(forecast_config)
+
+    # NOTE: 3時間毎の降水量なので、1時間毎に均等に割り振る
+    precip_list = [
+        hour_data["precip"] for day in ["today", "tomorrow"] for hour_data in weather_info[day]["data"]
+    ]
+    return np.repeat(np.array(precip_list, dtype=np.float64) / 3, 3)
+
+
+def parse_tenki(html):
+    tree = lxml.html.fromstring(html)
+
+    hourly = np.full(HOURS, np.nan)
+    for i, table_id in enumerate(TENKI_TABLE_ID.values()):
+        hour_list = tree.xpath(f'//table[@id="{table_id}"]//tr[contains(@class, "hour")]/td')
+        precip_list = tree.xpath(f'//table[@id="{table_id}"]//tr[contains(@class, "precipitation")]/td')
+
+        for hour_td, precip_td in zip(hour_list, precip_list, strict=True):
+            # NOTE: 時刻はその 1 時間の終わり (01 は 0時〜1時) を表す。「---」など数値でないものは欠損扱い
+            try:
+                hour = int(hour_td.text_content().strip())
+                precip = float(precip_td.text_content().strip())
+            except ValueError:
+                continue
+            if 1 <= hour <= 24:
+                hourly[i * 24 + hour - 1] = precip
+
+    return hourly
+
+
+def fetch_tenki(forecast_config, deadline):
+    res = _session.get(forecast_config["url"], timeout=deadline, headers={"User-Agent": "Mozilla/5.0"})
+    res.raise_for_status()
+
+    return parse_tenki(res.content)
+
+
+PROVIDER_MAP = {
+    "tenki": {"fetch": fetch_tenki, "resolution": 1},
+    "yahoo": {"fetch": fetch_yahoo, "resolution": 3},
+}
+
+
+def get_breaker_name(name):
+    return f"forecast.{name}"
+
+
+def fetch_provider(name, forecast_config, deadline):
+    hourly = PROVIDER_MAP[name]["fetch"](forecast_config, deadline)
+
+    if (len(hourly) != HOURS) or np.isnan(hourly).all():
+        raise ValueError(f"Invalid forecast: {name}")  # noqa: TRY003, EM102
+
+    return hourly
+
+
+def record_result(name, key, future):
+    with _running_lock:
+        if _running_map.get(key) is future:
+            del _running_map[key]
+        if future in _timeout_set:
+            # NOTE: 期限切れとして記録済みなので、結果は記録しない
+            _timeout_set.discard(future)
+            return
+
+    breaker = rainfall.breaker.get(get_breaker_name(name))
+    if future.exception() is None:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+def record_timeout(name, future):
+    with _running_lock:
+        if future.done():
+            # NOTE: 期限の直後に終わった場合は、結果の方を記録する
+            return
+        _timeout_set.add(future)
+
+    rainfall.breaker.get(get_breaker_name(name)).record_failure()
+
+
+def submit(name, forecast_config, deadline):
+    # NOTE: 失敗が続いている予報は、しばらく取得しない
+    if not rainfall.breaker.get(get_breaker_name(name)).allow():
+        return None
+
+    key = (name, forecast_config["url"])
+    with _running_lock:
+        future = _running_map.get(key)
+        if future is not None:
+            logging.debug("Forecast is still being fetched: %s", name)
+            return future
+
+        future = _executor.submit(fetch_provider, name, forecast_config, deadline)
+        _running_map[key] = future
+    future.add_done_callback(lambda future: record_result(name, key, future))
+
+    return future
+
+
+def get_provider_list(config):
+    # NOTE: 時間の刻みが細かい順に並べる
+    return sorted(
+        (name for name in PROVIDER_MAP if name in config["weather"]["forecast"]),
+        key=lambda name: PROVIDER_MAP[name]["resolution"],
+    )
+
+
+def get_key(config):
+    forecast_config = config["weather"]["forecast"]
+
+    return tuple(forecast_config[name]["url"] for name in get_provider_list(config))
+
+
+def merge(hourly_map):
+    # NOTE: 時間毎に、刻みの細かい予報から順に欠損していないものを使う
+    hourly = np.full(HOURS, np.nan)
+    for name in sorted(hourly_map, key=lambda name: PROVIDER_MAP[name]["resolution"]):
+        hourly = np.where(np.isnan(hourly), hourly_map[name], hourly)
+
+    return hourly
+
+
+def fetch_hourly(config):
+    forecast_config = config["weather"]["forecast"]
+    deadline = get_deadline(config)
+    limit = time.monotonic() + deadline
+
+    provider_list = get_provider_list(config)
+    future_map = {}
+    for name in provider_list:
+        future = submit(name, forecast_config[name], deadline)
+        if future is None:
+            logging.debug("Skipping forecast: %s (failed repeatedly)", name)
+            continue
+        future_map[future] = name
+
+    hourly_map = {}
+    pending = set(future_map)
+    while len(pending) != 0:
+        done, pending = concurrent.futures.wait(
+            pending, timeout=max(limit - time.monotonic(), 0), return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        if len(done) == 0:
+            logging.warning(
+                "Forecast deadline exceeded (%.1f sec). Skipping: %s",
+                deadline,
+                ", ".join(sorted(future_map[future] for future in pending)),
+            )
+            for future in pending:
+                record_timeout(future_map[future], future)
+            break
+
+        for future in done:
+            name = future_map[future]
+            try:
+                hourly = future.result()
+            except Exception:
+                logging.warning("Failed to fetch forecast: %s", name)
+                continue
+
+            hourly_map[name] = hourly
+
+        # NOTE: 最も刻みの細かい予報で全時間が揃ったら、残りは待たない
+        if (provider_list[0] in hourly_map) and not np.isnan(hourly_map[provider_list[0]]).any():
+            break
+
+    if len(hourly_map) == 0:
+        raise RuntimeError("No forecast available")  # noqa: TRY003, EM101
+
+    logging.debug("Forecast fetched from: %s", ", ".join(hourly_map.keys()))
+
+    return np.nan_to_num(merge(hourly_map))
+
+
+def make_entry(today, fetch_time, hourly):
+    # NOTE: 任意の時刻からの積算雨量を引き算だけで求められるよう、累積和を持っておく
+    return {
+        "date": today,
+        "time": fetch_time,
+        "hourly": hourly,
+        "cumsum": np.concatenate([[0.0], np.cumsum(hourly)]),
+    }
+
+
+def shift_day(entry, today):
+    # NOTE: 日付が変わった後に古いデータを使う場合、「明日」を「今日」として扱う
+    hourly = entry["hourly"][(today - entry["date"]).days * 24 :]
+    if len(hourly) == 0:
+        return None
+
+    # NOTE: 足りない分は、最後の値で埋める
+    return make_entry(today, entry["time"], np.append(hourly, np.full(HOURS - len(hourly), hourly[-1])))
+
+
+def get_forecast(config):
+    key = get_key(config)
+    today = my_lib.time.now().date()
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if (
+            (entry is not None)
+            and (entry["date"] == today)
+            and (time.time() - entry["time"] < get_ttl(config))
+        ):
+            return entry
+
+        future = _inflight_map.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = concurrent.futures.Future()
+            _inflight_map[key] = future
+
+    if not is_owner:
+        logging.debug("Waiting for forecast being fetched (url: %s)", ", ".join(key))
+        return future.result()
+
+    try:
+        entry = refresh(config, key, today, entry)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(entry)
+    finally:
+        with _cache_lock:
+            _inflight_map.pop(key, None)
+
+    return entry
+
+
+def refresh(config, key, today, entry):
+    try:
+        hourly = fetch_hourly(config)
+    except Exception:
+        if entry is None:
+            raise
+        stale = shift_day(entry, today)
+        if stale is None:
+            raise
+
+        logging.warning(
+            "Failed to refresh forecast. Using stale data fetched at %s.",
+            time.strftime("%Y/%m/%d %H:%M", time.localtime(entry["time"])),
+        )
+        return stale
+
+    logging.debug("Forecast refreshed (url: %s)", ", ".join(key))
+
+    entry = make_entry(today, time.time(), hourly)
+    with _cache_lock:
+        _cache[key] = entry
+
+    return entry
+
+
+def get_precip_sum(config, hour, hours):
+    cumsum = get_forecast(config)["cumsum"]
+
+    return float(cumsum[min(hour + hours, HOURS)] - cumsum[min(hour, HOURS)])
+
+
+def clear():
+    with _cache_lock:
+        _cache.clear()
+        _inflight_map.clear()
+    with _running_lock:
+        _running_map.clear()
+        _timeout_set.clear()
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+    import my_lib.pretty
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    for name in get_provider_list(config):
+        logging.info(
+            "%s: %s",
+            name,
+            my_lib.pretty.format(
+                PROVIDER_MAP[name]["fetch"](
+                    config["weather"]["forecast"][name], get_deadline(config)
+                ).tolist()
+            ),
+        )
+
+    logging.info(my_lib.pretty.format(get_forecast(config)["hourly"].tolist()))
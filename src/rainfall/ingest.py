@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+センサーから InfluxDB の line protocol でプッシュされたデータを受信し、監視ループを起こします。
+
+Usage:
+  ingest.py [-c CONFIG] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -D                : デバッグモードで動作します。
+"""
+
+import asyncio
+import datetime
+import gzip
+import http.server
+import logging
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import rainfall.monitor
+import rainfall.sensor
+import rainfall.site
+
+PRECISION_SCALE = {"ns": 1e9, "us": 1e6, "ms": 1e3, "s": 1}
+WAKE_FIELD_LIST = ["raining", "rain"]  # NOTE: これらのデータを受信したら、すぐに判定する
+
+_server_list = []
+_target_map = {}  # NOTE: (measurement, hostname) 毎の地点の設定
+_lock = threading.Lock()
+_wake = {"loop": None, "event": None, "pending": False}
+
+
+def split(text, sep):
+    # NOTE: バックスラッシュでエスケープされた区切り文字や、文字列中の区切り文字では分割しない
+    part_list = []
+    part = []
+    quoted = False
+    escaped = False
+
+    for c in text:
+        if escaped:
+            part.append(c)
+            escaped = False
+        elif c == "\\":
+            part.append(c)
+            escaped = True
+        elif c == '"':
+            part.append(c)
+            quoted = not quoted
+        elif (c == sep) and not quoted:
+            part_list.append("".join(part))
+            part = []
+        else:
+            part.append(c)
+    part_list.append("".join(part))
+
+    return part_list
+
+
+def unescape(text):
+    for c in [",", "=", " ", '"']:
+        text = text.replace("\\" + c, c)
+
+    return text
+
+
+def parse_value(text):
+    if text.startswith('"'):
+        return None
+    if text in ["t", "T", "true", "True", "TRUE"]:
+        return 1.0
+    if text in ["f", "F", "false", "False", "FALSE"]:
+        return 0.0
+    if text[-1] in "iu":
+        return float(int(text[:-1]))
+
+    return float(text)
+
+
+def parse_line(line, precision="ns"):
+    line = line.strip()
+    if (line == "") or line.startswith("#"):
+        return None
+
+    part_list = split(line, " ")
+    series = split(part_list[0], ",")
+
+    tag = {}
+    for item in series[1:]:
+        key, value = split(item, "=")
+        tag[unescape(key)] = unescape(value)
+
+    field = {}
+    for item in split(part_list[1], ","):
+        key, value = split(item, "=")
+        value = parse_value(value)
+        if value is not None:
+            field[unescape(key)] = value
+
+    timestamp = int(part_list[2]) / PRECISION_SCALE[precision] if len(part_list) > 2 else time.time()
+
+    return {
+        "measurement": unescape(series[0]),
+        "tag": tag,
+        "field": field,
+        "time": datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc),
+    }
+
+
+def receive(text, precision="ns"):
+    # NOTE: 監視対象のセンサー毎・フィールド毎にまとめてから積算する
+    point_map = {}
+    for line in text.splitlines():
+        try:
+            point = parse_line(line, precision)
+        except Exception:
+            logging.warning("Invalid line protocol: %s", line)
+            continue
+        if point is None:
+            continue
+
+        key = (point["measurement"], point["tag"].get("hostname"))
+        with _lock:
+            config = _target_map.get(key)
+        if config is None:
+            continue
+
+        field_map = point_map.setdefault(key, (config, {}))[1]
+        for field, value in point["field"].items():
+            if field in rainfall.sensor.FIELD_LIST:
+                field_map.setdefault(field, []).append((point["time"], value))
+
+    count = 0
+    is_wake = False
+    for config, field_map in point_map.values():
+        rainfall.sensor.append(rainfall.sensor.get_accumulator(config, rainfall.monitor.SUM_MIN), field_map)
+
+        count += sum(len(point_list) for point_list in field_map.values())
+        is_wake |= any(field in field_map for field in WAKE_FIELD_LIST)
+
+    if is_wake:
+        wake()
+
+    return count
+
+
+def wake():
+    with _lock:
+        loop, event = _wake["loop"], _wake["event"]
+
+        if (loop is None) or loop.is_closed():
+            # NOTE: 監視ループが待機を始める前に受信した場合は、最初の待機ですぐに起こす
+            _wake["pending"] = True
+            return
+
+    loop.call_soon_threadsafe(event.set)
+
+
+async def wait(timeout):
+    # NOTE: データがプッシュされた場合は True を、タイムアウトした場合は False を返す
+    if not is_enabled():
+        await asyncio.sleep(timeout)
+        return False
+
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if _wake["loop"] is not loop:
+            _wake["loop"] = loop
+            _wake["event"] = asyncio.Event()
+            if _wake["pending"]:
+                _wake["event"].set()
+                _wake["pending"] = False
+        event = _wake["event"]
+
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+
+    event.clear()
+    return True
+
+
+class HttpHandler(http.server.BaseHTTPRequestHandler):
+    precision = "ns"
+
+    def do_POST(self):
+        # NOTE: InfluxDB v1 (/write) と v2 (/api/v2/write) のどちらの書き込み先としても受け付ける
+        url = urllib.parse.urlparse(self.path)
+        if url.path not in ["/write", "/api/v2/write"]:
+            self.send_error(404)
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+
+        precision = urllib.parse.parse_qs(url.query).get("precision", [self.precision])[0]
+        if precision not in PRECISION_SCALE:
+            self.send_error(400)
+            return
+
+        receive(body.decode(), precision)
+
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):  # noqa: A002
+        logging.debug(format, *args)
+
+
+class UdpHandler(socketserver.BaseRequestHandler):
+    precision = "ns"
+
+    def handle(self):
+        receive(self.request[0].decode(), self.precision)
+
+
+def is_enabled():
+    with _lock:
+        return len(_server_list) != 0
+
+
+def get_address(kind):
+    with _lock:
+        for server_kind, server in _server_list:
+            if server_kind == kind:
+                return server.server_address
+
+    return None
+
+
+def start(config):
+    if "ingest" not in config:
+        return
+
+    ingest_config = config["ingest"]
+    # NOTE: 受信したデータは認証せずに判定に使うので、他のホストから受信する場合は明示的に指定する
+    host = ingest_config.get("host", "127.0.0.1")
+    precision = ingest_config.get("precision", "ns")
+
+    with _lock:
+        _target_map.clear()
+        for site_config in rainfall.site.get_config_list(config):
+            _target_map[rainfall.sensor.get_sensor_key(site_config)] = site_config
+
+    for kind, server_class, handler_class in [
+        ("http", http.server.ThreadingHTTPServer, HttpHandler),
+        ("udp", socketserver.ThreadingUDPServer, UdpHandler),
+    ]:
+        if kind not in ingest_config:
+            continue
+
+        server = server_class(
+            (host, ingest_config[kind]["port"]),
+            type(f"{kind}_handler", (handler_class,), {"precision": precision}),
+        )
+        threading.Thread(target=server.serve_forever, name=f"ingest-{kind}", daemon=True).start()
+        logging.info("Listening for line protocol on %s %s:%d", kind.upper(), *server.server_address)
+
+        with _lock:
+            _server_list.append((kind, server))
+
+
+def stop():
+    with _lock:
+        server_list = list(_server_list)
+        _server_list.clear()
+        _target_map.clear()
+        _wake["loop"] = None
+        _wake["event"] = None
+        _wake["pending"] = False
+
+    for _, server in server_list:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    start(config)
+
+    async def watch():
+        while True:
+            if await wait(60):
+                logging.info(
+                    rainfall.sensor.fetch_snapshot_list(
+                        rainfall.site.get_config_list(config), rainfall.monitor.SUM_MIN, fetch=False
+                    )
+                )
+
+    asyncio.run(watch())
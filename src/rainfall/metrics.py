@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""監視処理の各段階の所要時間を集計し、Prometheus のテキスト形式で書き出します。"""
+
+import collections
+import contextlib
+import logging
+import math
+import pathlib
+import re
+import threading
+import time
+
+import rainfall.breaker
+import rainfall.notifier
+
+BUCKET_LIST = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+SAMPLE_SIZE = 500  # NOTE: パーセンタイルの計算に使う直近のサンプル数
+QUANTILE_LIST = [0.5, 0.95]
+
+METRIC_NAME = "rainfall_stage_seconds"
+
+
+class Histogram:
+    def __init__(self):
+        """全てのバケットが 0 の空のヒストグラムを作ります。"""
+        self.bucket = [0] * len(BUCKET_LIST)
+        self.sum = 0.0
+        self.count = 0
+        self.sample = collections.deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, sec):
+        for i, upper in enumerate(BUCKET_LIST):
+            if sec <= upper:
+                self.bucket[i] += 1
+        self.sum += sec
+        self.count += 1
+        self.sample.append(sec)
+
+    def quantile(self, q):
+        if len(self.sample) == 0:
+            return None
+
+        sample_list = sorted(self.sample)
+        return sample_list[min(int(len(sample_list) * q), len(sample_list) - 1)]
+
+
+_hist_map = collections.defaultdict(Histogram)
+_hist_lock = threading.Lock()
+
+
+def observe(stage, sec):
+    with _hist_lock:
+        _hist_map[stage].observe(sec)
+
+
+@contextlib.contextmanager
+def measure(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def quantile(stage, q):
+    with _hist_lock:
+        if stage not in _hist_map:
+            return None
+        return _hist_map[stage].quantile(q)
+
+
+def format_le(upper):
+    return "+Inf" if math.isinf(upper) else f"{upper:g}"
+
+
+def format_text():
+    line_list = [
+        f"# HELP {METRIC_NAME} Time spent in each stage of the watch cycle.",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    quantile_list = [
+        f"# HELP {METRIC_NAME}_quantile Recent quantiles of the time spent in each stage.",
+        f"# TYPE {METRIC_NAME}_quantile gauge",
+    ]
+
+    with _hist_lock:
+        for stage, hist in sorted(_hist_map.items()):
+            for upper, count in zip(BUCKET_LIST, hist.bucket, strict=True):
+                line_list.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{format_le(upper)}"}} {count}')
+            line_list.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {hist.sum:.6f}')
+            line_list.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {hist.count}')
+
+            for q in QUANTILE_LIST:
+                quantile_list.append(
+                    f'{METRIC_NAME}_quantile{{stage="{stage}",quantile="{q:g}"}} {hist.quantile(q):.6f}'
+                )
+
+    notify_stat = rainfall.notifier.get_stat()
+    gauge_list = [
+        "# TYPE rainfall_notify_queue_depth gauge",
+        f"rainfall_notify_queue_depth {notify_stat['depth']}",
+        "# TYPE rainfall_notify_jobs_total counter",
+        *[
+            f'rainfall_notify_jobs_total{{result="{result}"}} {notify_stat[result]}'
+            for result in ["done", "failed", "dropped"]
+        ],
+    ]
+
+    breaker_stat = rainfall.breaker.get_stat()
+    breaker_list = [
+        "# TYPE rainfall_breaker_open gauge",
+        *[
+            f'rainfall_breaker_open{{backend="{name}"}} {int(stat["state"] != "closed")}'
+            for name, stat in sorted(breaker_stat.items())
+        ],
+        "# TYPE rainfall_breaker_failures_total counter",
+        *[
+            f'rainfall_breaker_failures_total{{backend="{name}"}} {stat["failure_total"]}'
+            for name, stat in sorted(breaker_stat.items())
+        ],
+    ]
+
+    return "\n".join(line_list + quantile_list + gauge_list + breaker_list) + "\n"
+
+
+def export(config):
+    if "metrics" not in config:
+        return
+
+    path = pathlib.Path(config["metrics"]["file"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # NOTE: 読み込み中のファイルが壊れないよう、別名で書いてから置き換える
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(format_text())
+    tmp_path.replace(path)
+
+
+def read_quantile(path, stage, q):
+    pattern = re.compile(
+        rf'^{METRIC_NAME}_quantile\{{stage="{re.escape(stage)}",quantile="{q:g}"\}} (\S+)$', re.MULTILINE
+    )
+
+    try:
+        m = pattern.search(pathlib.Path(path).read_text())
+    except OSError:
+        logging.warning("Failed to read metrics: %s", path)
+        return None
+
+    return float(m.group(1)) if m is not None else None
+
+
+def clear():
+    with _hist_lock:
+        _hist_map.clear()
@@ -3,103 +3,139 @@
 降雨の開始を監視します。
 
 Usage:
-  monitor.py [-c CONFIG] [-d] [-f] [-D]
+  monitor.py [-c CONFIG] [-d] [-f] [-P] [-D]
 
 Options:
   -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
   -f                : 強制的に音声通知を行う。
   -d                : ダミーモードで実行します。CI テストで利用することを想定しています。
+  -P                : プロファイルを取得し、設定の profile.dir にレポートを書き出します。
   -D                : デバッグモードで動作します。
 """
 
+import asyncio
+import concurrent.futures
 import datetime
+import hashlib
 import logging
-import pathlib
-import threading
 import time
 
-import my_lib.footprint
 import my_lib.notify.line
-import my_lib.sensor_data
 import my_lib.time
-import my_lib.voice
-import my_lib.weather
+import numpy as np
 import psutil
-
-PERIOD_HOURS = 3  # NOTE: Yahoo天気のデータは3時間毎の降雨量なのでそれに合わせる
+import rainfall.breaker
+import rainfall.forecast
+import rainfall.metrics
+import rainfall.notifier
+import rainfall.nowcast
+import rainfall.profiler
+import rainfall.radar
+import rainfall.scheduler
+import rainfall.sensor
+import rainfall.shadow
+import rainfall.site
+import rainfall.state
+
+PERIOD_HOURS = 3  # NOTE: 今後この期間に降る雨量を予報から求める[時間]
 SUM_MIN = 3  # NOTE: 直近の雨量を積算する期間[分]
 SOLAR_RAD_THRESHOLD = 600  # 日射量がこれよりある場合は、雨の降り始め扱いにしない
+CONTINUOUS_MIN = 30  # NOTE: 前の通知からこの期間内に降り始めた場合は、連続した雨とみなす[分]
+VOICE_THRESHOLD = 0.1  # NOTE: 観測・予報雨量のどちらもこれ未満の場合は、音声通知しない[mm]
+PRESYNTH_RAINING_SUM_LIST = [0, 0.1, 0.2, 0.3, 0.4, 0.5]  # NOTE: 降り始めに観測されそうな雨量[mm]
+SENSOR_TIMEOUT_SEC = 10
+FORECAST_TIMEOUT_SEC = 20
+LINE_TIMEOUT_SEC = 10
+SYNTHESIZE_TIMEOUT_SEC = 30
+NOWCAST_TIMEOUT_SEC = 5
+CYCLE_MARGIN_SEC = 5  # NOTE: 監視 1 周期の期限は、センサーと天気予報の取得期限にこれを加えたもの
+
+# NOTE: asyncio.to_thread を使うと、タイムアウトしたスレッドの終了を asyncio.run が待ってしまうので、
+# 専用のスレッドプールを使う
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="watch")
+
+
+def get_default_param():
+    # NOTE: 判定条件。影で評価する条件は、これを元に一部を変えたものになる
+    return {
+        "solar_rad_threshold": SOLAR_RAD_THRESHOLD,
+        "sum_min": SUM_MIN,
+        "continuous_min": CONTINUOUS_MIN,
+        "voice_threshold": VOICE_THRESHOLD,
+    }
 
 
-def get_solar_rad(config, raining_start):
-    start = (raining_start - datetime.timedelta(minutes=10)).isoformat()
-    stop = (raining_start + datetime.timedelta(minutes=1)).isoformat()
+def get_budget(config, name):
+    # NOTE: 外部サービス毎の呼び出しの期限[秒]
+    default = {
+        "sensor": SENSOR_TIMEOUT_SEC,
+        "forecast": FORECAST_TIMEOUT_SEC,
+        "line": LINE_TIMEOUT_SEC,
+        "synthesize": SYNTHESIZE_TIMEOUT_SEC,
+        "nowcast": NOWCAST_TIMEOUT_SEC,
+    }[name]
 
-    solar_rad_info = my_lib.sensor_data.fetch_data(
-        config["influxdb"],
-        config["sensor"]["rain_fall"]["measure"],
-        config["sensor"]["rain_fall"]["hostname"],
-        "solar_rad",
-        start=start,
-        stop=stop,
-        last=True,
-    )
+    return config["watch"].get("budget", {}).get(name, default)
 
-    return solar_rad_info["value"][0] if solar_rad_info["valid"] else None
 
+def get_cycle_deadline(config):
+    # NOTE: センサー・天気予報・雨雲の予測は並行して行うので、長いものに余裕を加える
+    if "cycle" in config["watch"].get("budget", {}):
+        return config["watch"]["budget"]["cycle"]
 
-def check_raining(config):
-    raining_start = my_lib.sensor_data.get_last_event(
-        config["influxdb"],
-        config["sensor"]["rain_fall"]["measure"],
-        config["sensor"]["rain_fall"]["hostname"],
-        "raining",
+    return (
+        max(get_budget(config, "sensor"), get_budget(config, "forecast"), get_budget(config, "nowcast"))
+        + CYCLE_MARGIN_SEC
     )
 
-    if raining_start is None:
-        # NOTE: まだデータがない場合は、一年前に降り始めたことにする
-        return my_lib.time.now() - datetime.timedelta(days=365)
-
-    return raining_start.astimezone(my_lib.time.get_zoneinfo())
-
 
-def get_raining_sum(config):
-    raining_sum = my_lib.sensor_data.get_minute_sum(
-        config["influxdb"],
-        config["sensor"]["rain_fall"]["measure"],
-        config["sensor"]["rain_fall"]["hostname"],
-        "rain",
-        SUM_MIN,
-    )
+def get_forecast_text(precip_sum):
+    # NOTE: 予報が取得できなかった場合は、見込みに触れない
+    if (precip_sum is None) or (precip_sum < 0.1):
+        return ""
 
-    return raining_sum if raining_sum is not None else 0
+    return f"今後{PERIOD_HOURS}時間で{precip_sum:.1f}mm降る見込みです。"
 
 
 def get_cloud_url(config):
-    # MEMO: 10分遡って5分単位に丸める
-    now = datetime.datetime.fromtimestamp(
-        ((time.time() - 60 * 10) // (60 * 5)) * (60 * 5), tz=my_lib.time.get_zoneinfo()
-    )
-
-    url = now.strftime(config["rain_cloud"]["img"]["url_tmpl"]).format(now.minute // 5 * 5)
+    url = rainfall.radar.get_image_url(config)
 
     logging.info("Cloud URL: %s", url)
 
     return url
 
 
-def notify_line_impl(config, precip_sum):
-    message = {
+def get_title(config):
+    name = rainfall.site.get_name(config)
+
+    return "天気速報" if name is None else f"天気速報 ({name})"
+
+
+def get_log_prefix(config):
+    name = rainfall.site.get_name(config)
+
+    return "" if name is None else f"[{name}] "
+
+
+def get_line_text(precip_sum):
+    if precip_sum is None:
+        return "雨が降り始めました。\n予報は取得できませんでした。"
+
+    return f"雨が降り始めました。\n今後{PERIOD_HOURS}時間で{precip_sum:.1f}mm降る見込みです。"
+
+
+def make_line_message(config, alt_text, text):
+    return {
         "type": "template",
-        "altText": "雨が降り始めました！",
+        "altText": alt_text,
         "template": {
             "type": "buttons",
             "thumbnailImageUrl": get_cloud_url(config),
             "imageAspectRatio": "rectangle",
             "imageSize": "cover",
             "imageBackgroundColor": "#FFFFFF",
-            "title": "天気速報",
-            "text": f"雨が降り始めました。\n今後{PERIOD_HOURS}時間で{precip_sum:.1f}mm降る見込みです。",
+            "title": get_title(config),
+            "text": text,
             "defaultAction": {
                 "type": "uri",
                 "label": "雨雲を見る",
@@ -112,61 +148,117 @@ def notify_line_impl(config, precip_sum):
         },
     }
 
-    my_lib.notify.line.send(config["notify"]["line"], message)
 
-    return True
+def get_line_breaker_name(config):
+    # NOTE: 地点毎にチャンネルが異なる場合に、1 つのチャンネルの障害で他の地点の通知まで止めない
+    token = config["notify"]["line"]["channel"]["access_token"]
 
+    return "line.{}".format(hashlib.sha1(token.encode()).hexdigest()[:8])  # noqa: S324
 
-def check_forecast(config, hour):
-    weather_info = my_lib.weather.get_weather_yahoo(config["weather"]["forecast"]["yahoo"])
-    weather_data = weather_info["today"]["data"] + weather_info["tomorrow"]["data"]
 
-    precip_list = [hour_data["precip"] for hour_data in weather_data]
+def send_line(config, message):
+    rainfall.breaker.call(
+        get_line_breaker_name(config),
+        get_budget(config, "line"),
+        my_lib.notify.line.send,
+        config["notify"]["line"],
+        message,
+    )
 
-    # NOTE: 3時間毎のデータなので線形補完する
-    lower = hour // PERIOD_HOURS
-    upper = lower + 1
 
-    weight_upper = (hour - lower * PERIOD_HOURS) / PERIOD_HOURS
-    weight_lower = 1 - weight_upper
+def notify_line_impl(config, precip_sum):
+    send_line(config, make_line_message(config, "雨が降り始めました！", get_line_text(precip_sum)))
 
-    return precip_list[lower] * weight_lower + precip_list[upper] * weight_upper
+    return True
 
 
-def notify_voice_impl(config, raining_sum, precip_sum):
-    if (
-        my_lib.footprint.elapsed(config["notify"]["footprint"]["voice"]["file"]) < 3 * 60 * 60
-    ):  # NOTE: 前の通知から 3時間以内の場合、言葉を変える
+def get_nowcast_text(arrival_min):
+    if arrival_min == 0:
+        return "雨雲が近づいています。\nまもなく雨が降り始めそうです。"
+
+    return f"雨雲が近づいています。\n約{arrival_min}分後に雨が降り始めそうです。"
+
+
+def check_forecast(config, hour):
+    # NOTE: 1時間毎の予報にまとめてあるので、今後の積算雨量は配列の参照だけで求まる
+    return rainfall.forecast.get_precip_sum(config, hour, PERIOD_HOURS)
+
+
+def get_voice_message(raining_sum, precip_sum, again):
+    if again:
         message = "また、雨が降り始めました。"
     else:
         message = "雨が降り始めました。"
 
     if raining_sum >= 0.1:
         message += f"過去{SUM_MIN}分間に{raining_sum:.1f}mm降っています。"
-    if precip_sum >= 0.1:
-        message += f"今後{PERIOD_HOURS}時間で{precip_sum:.1f}mm降る見込みです。"
+    message += get_forecast_text(precip_sum)
+
+    return message
+
+
+def is_voice_again(config):
+    # NOTE: 前の通知から 3時間以内の場合、言葉を変える
+    return get_state(config).elapsed("voice") < 3 * 60 * 60
+
 
-    message_wav = my_lib.voice.synthesize(config, message)
+def is_voice_enabled(config):
+    return "voice" in config["notify"]
+
+
+def init_nowcast(config):
+    if rainfall.nowcast.is_enabled(config) and not rainfall.nowcast.is_available():
+        logging.warning("Pillow is not installed. Nowcast is disabled.")
+
+
+def init_voice(config):
+    if not is_voice_enabled(config):
+        return
+
+    # NOTE: 音声関係のライブラリは読み込みが重いので、音声通知を使う場合のみ読み込む
+    import rainfall.voice
+
+    rainfall.voice.init(config)
+
+
+def presynthesize_voice(config, precip_sum):
+    import rainfall.voice
+
+    # NOTE: 雨が降りそうな場合、通知に使いそうなメッセージを予め合成しておく
+    again = is_voice_again(config)
+
+    rainfall.voice.presynthesize(
+        config,
+        [
+            get_voice_message(raining_sum, precip_sum, is_again)
+            for is_again in [again, not again]
+            for raining_sum in PRESYNTH_RAINING_SUM_LIST
+        ],
+        get_budget(config, "synthesize"),
+    )
+
+
+def notify_voice_impl(config, snapshot, precip_sum):
+    import my_lib.voice
+    import rainfall.speaker
+    import rainfall.voice
+
+    message = get_voice_message(snapshot.raining_sum, precip_sum, is_voice_again(config))
+
+    message_wav = rainfall.voice.synthesize(config, message, get_budget(config, "synthesize"))
 
     if "chime" in config["notify"]["voice"]:
-        chime_duration = config["notify"]["voice"]["chime"]["duration"]
-        
-        with pathlib.Path(config["notify"]["voice"]["chime"]["file"]).open("rb") as file:
-            chime_wav = my_lib.voice.convert_wav_data(file.read())
-        
-        # チャイムをバックグラウンドで再生開始
-        chime_thread = threading.Thread(target=my_lib.voice.play, args=(chime_wav,))
-        chime_thread.start()
-        
-        # 指定時間後に音声メッセージを再生
-        voice_thread = threading.Timer(chime_duration, my_lib.voice.play, args=(message_wav,))
-        voice_thread.start()
-        
-        # 両方のスレッドの完了を待つ
-        chime_thread.join()
-        voice_thread.join()
+        wav_list = rainfall.voice.add_chime(config, message_wav)
     else:
-        my_lib.voice.play(message_wav)
+        wav_list = [message_wav]
+
+    with rainfall.metrics.measure("play"):
+        if rainfall.speaker.is_enabled(config):
+            # NOTE: 複数のスピーカーで同時に再生し、1 つでも再生できたら通知済みとする
+            return any(result.success for result in rainfall.speaker.play(config, wav_list))
+
+        for wav_data in wav_list:
+            my_lib.voice.play(wav_data)
 
     return True
 
@@ -175,76 +267,165 @@ def get_process_start():
     return datetime.datetime.fromtimestamp(psutil.Process().create_time(), tz=my_lib.time.get_zoneinfo())
 
 
-def is_notify_done(config, raining_start, mode):
+def get_watch_start(config):
     process_start = get_process_start()
 
-    if (raining_start - process_start).total_seconds() < -60 * 10:
+    # NOTE: 再起動前のデータが保存されていて間が空いていない場合は、その時点から監視を続けていたとみなす
+    last_time = rainfall.sensor.get_last_time(config, SUM_MIN)
+    if (last_time is None) or (time.time() - last_time > rainfall.sensor.BACKFILL_MIN * 60):
+        return process_start
+
+    return min(process_start, datetime.datetime.fromtimestamp(last_time, tz=my_lib.time.get_zoneinfo()))
+
+
+def load_state(config):
+    return rainfall.state.load(config, get_watch_start(config))
+
+
+def get_state(config):
+    state = rainfall.state.get(config)
+    if state is None:
+        state = load_state(config)
+
+    return state
+
+
+def is_continuous(param, elapsed_sec):
+    # NOTE: 前の通知から間もなく降り始めた場合は、連続した雨とみなす。判定条件の組毎の配列でも使える
+    return elapsed_sec < param["continuous_min"] * 60
+
+
+def is_sunny(param, solar_rad):
+    # NOTE: 雨の降り始め時点で日射量が多い場合、光学式雨量計の誤検知の可能性が高いので、
+    # 無視する (狐の嫁入りの可能性もありますが...)。日射量が分からない場合は NaN を渡す
+    return np.nan_to_num(solar_rad, nan=-np.inf) >= param["solar_rad_threshold"]
+
+
+def get_skip_reason(snapshot, state, mode, param=None, now=None):
+    # NOTE: 通知しない理由を返す。通知する場合は None。影で評価する条件でも同じ判定を使う
+    param = get_default_param() if param is None else param
+    now = my_lib.time.now().timestamp() if now is None else now
+
+    if (snapshot.raining_start - state.process_start).total_seconds() < -60 * 10:
         # NONE 雨の降り始めがプログラム開始前の場合、通知をしない
-        logging.debug("Since this is likely the initial check, skipping notification.")
-        return True
+        return "initial"
+
+    raining_before = now - snapshot.raining_start.timestamp()
 
-    raining_before = (my_lib.time.now() - raining_start).total_seconds()
+    elapsed = state.elapsed(mode)
 
-    if raining_before >= my_lib.footprint.elapsed(config["notify"]["footprint"][mode]["file"]):
+    if raining_before >= elapsed:
         # NOTE: 既に通知している場合
-        return True
-    if my_lib.footprint.elapsed(config["notify"]["footprint"][mode]["file"]) < (30 * 60):
-        # NOTE: 30分内に通知している場合は、連続した雨とみなす
-        logging.info("Recent notification sent. Treated as continuous rain. Skipping.")
-        my_lib.footprint.update(config["notify"]["footprint"][mode]["file"])
+        return "done"
+    if is_continuous(param, elapsed):
+        return "continuous"
+    if is_sunny(param, np.nan if snapshot.solar_rad is None else snapshot.solar_rad):
+        return "solar"
+
+    return None
+
+
+def is_notify_done(config, snapshot, mode, param=None):
+    if rainfall.notifier.is_pending(config["notify"]["footprint"][mode]["file"]):
+        # NOTE: 通知処理中の場合
         return True
 
-    solar_rad = get_solar_rad(config, raining_start)
-    if (solar_rad is not None) and (solar_rad >= SOLAR_RAD_THRESHOLD):
+    state = get_state(config)
+    reason = get_skip_reason(snapshot, state, mode, param)
+
+    if reason == "initial":
+        logging.debug("Since this is likely the initial check, skipping notification.")
+    elif reason == "continuous":
+        logging.info("Recent notification sent. Treated as continuous rain. Skipping.")
+        state.update(mode)
+    elif reason == "solar":
         logging.warning("Rain detected by sensor, but ignored due to high solar radiation.")
-        # NOTE: 雨の降り始め時点で日射量が多い場合、光学式雨量計の誤検知の可能性が高いので、
-        # 無視する (狐の嫁入りの可能性もありますが...)
-        my_lib.footprint.update(config["notify"]["footprint"][mode]["file"])
-        return True
+        state.update(mode)
 
-    return False
+    return reason is not None
 
 
-def notify_line(config, raining_start, precip_sum):
-    logging.info("Notify by LINE")
-    logging.info("Raining started at %s", raining_start.strftime("%Y/%m/%d %H:%M"))
+def notify_line(config, snapshot, precip_sum):
+    logging.info("%sNotify by LINE", get_log_prefix(config))
+    logging.info("Raining started at %s", snapshot.raining_start.strftime("%Y/%m/%d %H:%M"))
 
-    notify_line_impl(config, precip_sum)
+    with rainfall.metrics.measure("notify_line"):
+        notify_line_impl(config, precip_sum)
 
-    my_lib.footprint.update(pathlib.Path(config["notify"]["footprint"]["line"]["file"]))
+    get_state(config).update("line")
 
 
-def notify_voice(config, raining_start, raining_sum, precip_sum):
-    logging.info("Notify by VOICE")
-    if notify_voice_impl(config, raining_sum, precip_sum):
-        my_lib.footprint.update(pathlib.Path(config["notify"]["footprint"]["voice"]["file"]))
+def notify_voice(config, snapshot, precip_sum):
+    logging.info("%sNotify by VOICE", get_log_prefix(config))
+    if notify_voice_impl(config, snapshot, precip_sum):
+        get_state(config).update("voice")
         return True
 
     return False
 
 
-def should_notify_line(config, raining_start):
-    if is_notify_done(config, raining_start, "line"):
+def notify_nowcast(config, nowcast):
+    logging.info("%sNotify rain arriving in %d min by LINE", get_log_prefix(config), nowcast["arrival_min"])
+
+    with rainfall.metrics.measure("notify_nowcast"):
+        send_line(
+            config,
+            make_line_message(config, "雨雲が近づいています！", get_nowcast_text(nowcast["arrival_min"])),
+        )
+
+    get_state(config).update("nowcast")
+
+
+def get_nowcast_key(config):
+    return config["notify"]["footprint"]["line"]["file"] + ".nowcast"
+
+
+def should_notify_nowcast(config, snapshot, nowcast):
+    if (nowcast is None) or (nowcast["arrival_min"] is None):
+        return False
+
+    # NOTE: 既に雨が降っている場合や、最近通知した場合は、雨雲の接近を知らせない
+    if snapshot.raining or rainfall.notifier.is_pending(get_nowcast_key(config)):
+        return False
+
+    state = get_state(config)
+    if min(state.elapsed("nowcast"), state.elapsed("line")) < (CONTINUOUS_MIN * 60):
+        return False
+
+    return True
+
+
+def should_notify_line(config, snapshot):
+    if is_notify_done(config, snapshot, "line"):
         return False
 
     return True
 
 
-def should_notify_voice(config, raining_start, raining_sum, precip_sum, hour):
-    if is_notify_done(config, raining_start, "voice"):
+def is_voice_hour(config, hour):
+    return config["notify"]["voice"]["hour"]["start"] <= hour <= config["notify"]["voice"]["hour"]["end"]
+
+
+def format_precip(precip_sum):
+    return "unknown" if precip_sum is None else f"{precip_sum:.1f}mm"
+
+
+def should_notify_voice(config, snapshot, precip_sum, hour):
+    if not is_voice_enabled(config):
+        return False
+
+    if is_notify_done(config, snapshot, "voice"):
         return False
 
-    if (raining_sum < 0.1) and (precip_sum < 0.1):
+    if (snapshot.raining_sum < VOICE_THRESHOLD) and ((precip_sum or 0) < VOICE_THRESHOLD):
         logging.info(
-            "Skipping notify by voice (small rainfall, sum: %.2fmm, forecast: %.1fmm)",
-            raining_sum,
-            precip_sum,
+            "Skipping notify by voice (small rainfall, sum: %.2fmm, forecast: %s)",
+            snapshot.raining_sum,
+            format_precip(precip_sum),
         )
         return False
 
-    if (hour < config["notify"]["voice"]["hour"]["start"]) or (
-        hour > config["notify"]["voice"]["hour"]["end"]
-    ):
+    if not is_voice_hour(config, hour):
         # NOTE: 指定された時間内ではなかったら音声通知しない
         logging.info("Skipping notify by voice (out of hour: %d)", hour)
         return False
@@ -252,22 +433,164 @@ def should_notify_voice(config, raining_start, raining_sum, precip_sum, hour):
     return True
 
 
-def watch(config, dummy_mode=False):
-    raining_start = check_raining(config)
+async def run_async(func, *args, timeout=None):
+    future = asyncio.get_running_loop().run_in_executor(_executor, rainfall.profiler.wrap(func), *args)
+
+    if timeout is None:
+        return await future
+    return await asyncio.wait_for(future, timeout)
+
+
+async def fetch_snapshot_list_async(config_list, fetch=True):
+    timeout = get_budget(config_list[0], "sensor")
+
+    try:
+        with rainfall.metrics.measure("sensor"):
+            return await run_async(
+                rainfall.sensor.fetch_snapshot_list, config_list, SUM_MIN, fetch, timeout, timeout=timeout
+            )
+    except asyncio.TimeoutError:
+        # NOTE: 手元に積算済みのデータで判定する。失敗は問い合わせの方で数えるので、ここでは数えない
+        logging.warning("Timeout fetching sensor data (%.1f sec). Using cached data.", timeout)
+        return rainfall.sensor.fetch_snapshot_list(config_list, SUM_MIN, fetch=False)
+
+
+async def fetch_snapshot_async(config):
+    return (await fetch_snapshot_list_async([config]))[0]
+
+
+async def check_forecast_async(config, hour):
+    # NOTE: 予報が取得できなくても、雨の検知は続ける。その場合は None を返す
+    timeout = get_budget(config, "forecast")
+
+    try:
+        with rainfall.metrics.measure("forecast"):
+            return await run_async(check_forecast, config, hour, timeout=timeout)
+    except asyncio.TimeoutError:
+        logging.warning("Timeout fetching forecast (%.1f sec)", timeout)
+    except Exception:
+        logging.exception("Failed to fetch forecast")
+
+    return None
 
-    hour = my_lib.time.now().hour
-    raining_sum = get_raining_sum(config)
-    precip_sum = check_forecast(config, hour)
 
-    logging.debug("raining_sum: %.2f, precip_sum: %.2f", raining_sum, precip_sum)
+def check_nowcast(config):
+    return rainfall.nowcast.estimate(config)
+
+
+async def check_nowcast_async(config):
+    if not rainfall.nowcast.is_enabled(config) or not rainfall.nowcast.is_available():
+        return None
+
+    timeout = get_budget(config, "nowcast")
+
+    try:
+        with rainfall.metrics.measure("nowcast"):
+            return await run_async(check_nowcast, config, timeout=timeout)
+    except asyncio.TimeoutError:
+        logging.warning("Timeout estimating nowcast (%.1f sec)", timeout)
+    except Exception:
+        logging.exception("Failed to estimate nowcast")
+
+    return None
+
+
+def handle(config, snapshot, precip_sum, hour, dummy_mode=False, nowcast=None):
+    if snapshot is None:
+        return None
+
+    logging.debug(
+        "%sraining_sum: %.2f, precip_sum: %s",
+        get_log_prefix(config),
+        snapshot.raining_sum,
+        format_precip(precip_sum),
+    )
+
+    result = {"snapshot": snapshot, "precip_sum": precip_sum, "hour": hour, "nowcast": nowcast}
 
     if dummy_mode:
-        return
+        return result
+
+    if rainfall.shadow.is_enabled(config):
+        with rainfall.metrics.measure("shadow"):
+            rainfall.shadow.evaluate(
+                config,
+                snapshot,
+                precip_sum,
+                is_voice_enabled(config) and is_voice_hour(config, hour),
+                rainfall.sensor.get_accumulator(config, SUM_MIN),
+                get_default_param(),
+                get_state(config).process_start,
+            )
+
+    if rainfall.scheduler.is_rain_likely(result):
+        # NOTE: 通知に使う雨雲レーダーの画像を、雨が降りそうな間だけ先読みしておく
+        rainfall.radar.request(config)
+    elif rainfall.nowcast.is_enabled(config):
+        # NOTE: 予報が外れた雨も雨雲の予測で知らせられるよう、雨が降りそうでなくても枠毎に 1 回は先読みする
+        rainfall.radar.request_every_slot(config)
 
-    if should_notify_line(config, raining_start):
-        notify_line(config, raining_start, precip_sum)
-    if should_notify_voice(config, raining_start, raining_sum, precip_sum, hour):
-        notify_voice(config, raining_start, raining_sum, precip_sum)
+    if (
+        is_voice_enabled(config)
+        and (precip_sum is not None)
+        and (precip_sum >= 0.1)
+        and is_voice_hour(config, hour)
+    ):
+        presynthesize_voice(config, precip_sum)
+
+    # NOTE: 音声の再生などで監視が止まらないよう、通知は別スレッドで行う
+    if should_notify_line(config, snapshot):
+        rainfall.notifier.submit(
+            config["notify"]["footprint"]["line"]["file"], notify_line, config, snapshot, precip_sum
+        )
+    if should_notify_voice(config, snapshot, precip_sum, hour):
+        rainfall.notifier.submit(
+            config["notify"]["footprint"]["voice"]["file"], notify_voice, config, snapshot, precip_sum
+        )
+    if should_notify_nowcast(config, snapshot, nowcast):
+        rainfall.notifier.submit(get_nowcast_key(config), notify_nowcast, config, nowcast)
+
+    return result
+
+
+async def watch_async(config, dummy_mode=False):
+    hour = my_lib.time.now().hour
+
+    # NOTE: センサーデータと天気予報は独立しているので、並行して取得する
+    snapshot, precip_sum, nowcast = await asyncio.gather(
+        fetch_snapshot_async(config), check_forecast_async(config, hour), check_nowcast_async(config)
+    )
+
+    return handle(config, snapshot, precip_sum, hour, dummy_mode, nowcast)
+
+
+async def watch_all_async(config, dummy_mode=False, fetch=True):
+    # NOTE: fetch が False の場合は、InfluxDB に問い合わせず、プッシュされたデータのみで判定する
+    config_list = rainfall.site.get_config_list(config)
+    hour = my_lib.time.now().hour
+
+    # NOTE: センサーデータは全地点まとめて、天気予報と雨雲の予測は地点毎に並行して取得する
+    snapshot_list, *check_list = await asyncio.gather(
+        fetch_snapshot_list_async(config_list, fetch),
+        *[check_forecast_async(site_config, hour) for site_config in config_list],
+        *[check_nowcast_async(site_config) for site_config in config_list],
+    )
+    precip_list, nowcast_list = check_list[: len(config_list)], check_list[len(config_list) :]
+
+    return [
+        handle(site_config, snapshot, precip_sum, hour, dummy_mode, nowcast)
+        for site_config, snapshot, precip_sum, nowcast in zip(
+            config_list, snapshot_list, precip_list, nowcast_list, strict=True
+        )
+    ]
+
+
+def watch(config, dummy_mode=False):
+    return asyncio.run(watch_async(config, dummy_mode))
+
+
+def watch_all(config, dummy_mode=False):
+    return asyncio.run(watch_all_async(config, dummy_mode))
 
 
 if __name__ == "__main__":
@@ -281,15 +604,27 @@ if __name__ == "__main__":
     config_file = args["-c"]
     force_mode = args["-f"]
     dummy_mode = args["-d"]
+    profile_mode = args["-P"]
     debug_mode = args["-D"]
 
     my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
 
     config = my_lib.config.load(config_file)
 
+    if profile_mode:
+        rainfall.profiler.init(config)
+
     if force_mode:
-        notify_voice(config, my_lib.time.now(), 1, 2)
+        notify_voice(
+            rainfall.site.get_config_list(config)[0],
+            rainfall.sensor.Snapshot(
+                raining_start=my_lib.time.now(), raining_sum=1, solar_rad=0, raining=True
+            ),
+            2,
+        )
     else:
-        watch(config, dummy_mode)
+        with rainfall.profiler.sample(config, 0):
+            watch_all(config, dummy_mode)
+        rainfall.notifier.join()
 
     logging.info("Finish.")
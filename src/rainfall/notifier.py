@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""通知を監視ループとは別のスレッドで順に実行します。"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+QUEUE_SIZE = 8
+LATENCY_HIST_SIZE = 100
+
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_lock = threading.Lock()
+_pending = set()
+_worker = None
+_stat = {
+    "done": 0,
+    "failed": 0,
+    "dropped": 0,
+    "latency": collections.deque(maxlen=LATENCY_HIST_SIZE),
+}
+
+
+def worker():
+    while True:
+        key, func, args, submit_time = _queue.get()
+        try:
+            logging.debug("Start notification job: %s (wait: %.2f sec)", key, time.time() - submit_time)
+            func(*args)
+
+            latency = time.time() - submit_time
+            logging.info("Notification job done: %s (latency: %.2f sec)", key, latency)
+            with _lock:
+                _stat["done"] += 1
+                _stat["latency"].append(latency)
+        except Exception:
+            logging.exception("Notification job failed: %s", key)
+            with _lock:
+                _stat["failed"] += 1
+        finally:
+            with _lock:
+                _pending.discard(key)
+            _queue.task_done()
+
+
+def start():
+    global _worker  # noqa: PLW0603
+
+    with _lock:
+        if (_worker is None) or not _worker.is_alive():
+            _worker = threading.Thread(target=worker, name="notifier", daemon=True)
+            _worker.start()
+
+
+def submit(key, func, *args):
+    # NOTE: key は通知済みかどうかを管理する単位 (フットプリントのファイル名) とする
+    start()
+
+    with _lock:
+        if key in _pending:
+            logging.info("Notification job is already queued: %s", key)
+            return False
+        try:
+            _queue.put_nowait((key, func, args, time.time()))
+        except queue.Full:
+            logging.warning("Notification queue is full. Dropping job: %s", key)
+            _stat["dropped"] += 1
+            return False
+        _pending.add(key)
+
+    logging.info("Notification job queued: %s (depth: %d)", key, _queue.qsize())
+
+    return True
+
+
+def is_pending(key):
+    with _lock:
+        return key in _pending
+
+
+def join():
+    _queue.join()
+
+
+def get_stat():
+    with _lock:
+        latency_list = list(_stat["latency"])
+
+        return {
+            "depth": _queue.qsize(),
+            "pending": sorted(_pending),
+            "done": _stat["done"],
+            "failed": _stat["failed"],
+            "dropped": _stat["dropped"],
+            "latency_avg": sum(latency_list) / len(latency_list) if latency_list else None,
+            "latency_max": max(latency_list) if latency_list else None,
+        }
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+雨雲レーダーの直近の画像から雨雲の動きを求め、指定した地点に雨雲が届くまでの時間を予測します。
+
+Usage:
+  nowcast.py [-c CONFIG] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -D                : デバッグモードで動作します。
+"""
+
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+import rainfall.radar
+
+# NOTE: 気象庁の降水強度の配色と、その階級の代表的な強さ[mm/h]
+PALETTE = np.array(
+    [
+        [242, 242, 255],
+        [160, 210, 255],
+        [33, 140, 255],
+        [0, 65, 255],
+        [250, 245, 0],
+        [255, 153, 0],
+        [255, 40, 0],
+        [180, 0, 104],
+    ],
+    dtype=np.int32,
+)
+INTENSITY = np.array([0.5, 3, 7.5, 15, 25, 40, 65, 100], dtype=np.float32)
+COLOR_TOLERANCE = 40  # NOTE: 配色からこれ以上離れた色は、地図などの背景とみなす
+
+SCALE = 4  # NOTE: 計算量を減らすため、画像をこの間隔で間引いてから扱う
+BLOCK = 8  # NOTE: 動きを求めるブロックの大きさ (間引いた後の画素数)
+SEARCH = 4  # NOTE: 1 枚の間に動く最大の距離 (間引いた後の画素数)
+FRAME_GAP_MAX_SEC = 15 * 60  # NOTE: これより離れた画像の組からは、動きを求めない
+
+RADIUS = 10  # NOTE: 地点の周囲のこの半径[画素]に雨雲が入ったら、雨が降り始めるとみなす
+LEAD_MIN = 30
+THRESHOLD = 1.0  # NOTE: この強さ[mm/h]以上の雨雲を対象とする
+
+_decode_cache = {}  # NOTE: 直近の 2 枚分だけ、変換した結果を持っておく
+_decode_lock = threading.Lock()
+
+
+def is_enabled(config):
+    return ("nowcast" in config["rain_cloud"]) and rainfall.radar.is_enabled(config)
+
+
+def is_available():
+    # NOTE: 画像の読み込みに Pillow を使うが、必須の依存関係にはしない
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        return False
+
+    return True
+
+
+def to_intensity(rgb):
+    rgb = rgb[::SCALE, ::SCALE].astype(np.int32)
+
+    dist = ((rgb[:, :, np.newaxis, :] - PALETTE) ** 2).sum(axis=-1)
+    index = dist.argmin(axis=-1)
+
+    return np.where(
+        np.take_along_axis(dist, index[:, :, np.newaxis], axis=-1)[:, :, 0] <= COLOR_TOLERANCE**2,
+        INTENSITY[index],
+        0,
+    ).astype(np.float32)
+
+
+def decode(path):
+    import PIL.Image
+
+    with PIL.Image.open(path) as img:
+        return to_intensity(np.asarray(img.convert("RGB")))
+
+
+def decode_cached(path):
+    with _decode_lock:
+        intensity = _decode_cache.get(path)
+    if intensity is not None:
+        return intensity
+
+    intensity = decode(path)
+
+    with _decode_lock:
+        _decode_cache[path] = intensity
+        while len(_decode_cache) > 2:
+            _decode_cache.pop(next(iter(_decode_cache)))
+
+    return intensity
+
+
+def estimate_motion(prev, cur):
+    # NOTE: ずらし方毎に差分をまとめて求め、ブロック毎に差分が最も小さいずらし方を選ぶ
+    height, width = (cur.shape[0] // BLOCK) * BLOCK, (cur.shape[1] // BLOCK) * BLOCK
+    shape = (height // BLOCK, BLOCK, width // BLOCK, BLOCK)
+
+    cur = cur[:height, :width]
+    prev = np.pad(prev[:height, :width], SEARCH)
+
+    shift_list = np.array(
+        [(dy, dx) for dy in range(-SEARCH, SEARCH + 1) for dx in range(-SEARCH, SEARCH + 1)]
+    )
+    sad = np.empty((len(shift_list), height // BLOCK, width // BLOCK), dtype=np.float32)
+    for i, (dy, dx) in enumerate(shift_list):
+        shifted = prev[SEARCH - dy : SEARCH - dy + height, SEARCH - dx : SEARCH - dx + width]
+        sad[i] = np.abs(cur - shifted).reshape(shape).sum(axis=(1, 3))
+
+    # NOTE: 差分が同じ場合は、動きの小さい方を選ぶ
+    sad += 1e-3 * (shift_list**2).sum(axis=1)[:, np.newaxis, np.newaxis]
+
+    motion = shift_list[sad.argmin(axis=0)]
+    echo = cur.reshape(shape).max(axis=(1, 3)) > 0
+
+    return motion, echo
+
+
+def get_velocity(motion, echo, point, window):
+    # NOTE: 地点の周囲で雨雲のあるブロックの動きの中央値を、雨雲の動きとする
+    center = (np.stack(np.mgrid[0 : echo.shape[0], 0 : echo.shape[1]], axis=-1) + 0.5) * BLOCK
+    near = echo & (np.abs(center - point).max(axis=-1) <= window)
+    if not near.any():
+        return None
+
+    return np.median(motion[near], axis=0)
+
+
+def extrapolate(intensity, point, velocity, radius, threshold, elapsed_min, lead_min):
+    # NOTE: 雨雲は今の動きのまま進むとみなし、地点に届く雨雲を遡って求める
+    yy, xx = np.mgrid[0 : intensity.shape[0], 0 : intensity.shape[1]]
+
+    for minute in range(lead_min + 1):
+        y, x = point - velocity * (elapsed_min + minute)
+        disk = (yy - y) ** 2 + (xx - x) ** 2 <= radius**2
+        if disk.any() and (intensity[disk].max() >= threshold):
+            return minute
+
+    return None
+
+
+def get_frame_pair(config):
+    latest = rainfall.radar.get_latest(config)
+    if latest is None:
+        return None
+
+    frame_list = rainfall.radar.get_frame_list(config)
+    prev_list = [frame for frame in frame_list if frame.slot < latest.slot]
+    if len(prev_list) == 0:
+        return None
+
+    prev = prev_list[-1]
+    if (latest.slot - prev.slot).total_seconds() > FRAME_GAP_MAX_SEC:
+        return None
+
+    return prev, latest
+
+
+def estimate(config):
+    frame_pair = get_frame_pair(config)
+    if frame_pair is None:
+        logging.debug("Not enough radar frames for nowcast")
+        return None
+    prev, cur = frame_pair
+
+    nowcast_config = config["rain_cloud"]["nowcast"]
+    radius = nowcast_config.get("radius", RADIUS) / SCALE
+    lead_min = nowcast_config.get("lead_min", LEAD_MIN)
+    point = np.array([nowcast_config["y"], nowcast_config["x"]]) / SCALE
+
+    prev_map = decode_cached(prev.path)
+    cur_map = decode_cached(cur.path)
+
+    interval_min = (cur.slot - prev.slot).total_seconds() / 60
+    elapsed_min = max((time.time() - cur.slot.timestamp()) / 60, 0)
+
+    motion, echo = estimate_motion(prev_map, cur_map)
+    # NOTE: 予測する時間内に届きうる範囲の雨雲の動きを使う
+    window = SEARCH * math.ceil((elapsed_min + lead_min) / interval_min) + radius + BLOCK
+    velocity = get_velocity(motion, echo, point, window)
+    if velocity is None:
+        return {"arrival_min": None, "velocity": None}
+
+    velocity = velocity / interval_min
+    arrival_min = extrapolate(
+        cur_map,
+        point,
+        velocity,
+        radius,
+        nowcast_config.get("threshold", THRESHOLD),
+        elapsed_min,
+        lead_min,
+    )
+
+    logging.debug(
+        "Nowcast: arrival in %s min (velocity: %.1f, %.1f px/min)",
+        arrival_min,
+        *(velocity * SCALE),
+    )
+
+    return {"arrival_min": arrival_min, "velocity": (velocity * SCALE).tolist()}
+
+
+def clear():
+    with _decode_lock:
+        _decode_cache.clear()
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    rainfall.radar.request(config)
+    rainfall.radar.join()
+
+    logging.info(estimate(config))
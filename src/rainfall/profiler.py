@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+監視の周期を何回かに 1 回だけプロファイルし、CPU 時間・メモリ確保の多い箇所と RSS の増減を書き出します。
+
+長期間動かしたままで調べられるよう、プロファイルする周期の間隔と、残すレポートの数を設定で抑えます。
+"""
+
+import contextlib
+import cProfile
+import dataclasses
+import datetime
+import io
+import logging
+import pathlib
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+import my_lib.time
+import psutil
+import rainfall.metrics
+
+DIR = "/dev/shm/rainfall.profile"  # noqa: S108
+EVERY = 10  # NOTE: この周期毎に 1 回だけプロファイルする
+KEEP = 20  # NOTE: 残すレポートの数
+TOP = 20  # NOTE: レポートに載せる箇所の数
+MODE_LIST = ["cpu", "memory"]
+FRAMES = 1  # NOTE: メモリを確保した箇所として記録する呼び出し元の深さ
+
+# NOTE: Python 3.12 以降の cProfile は全てのスレッドを記録する (同時に 1 つしか有効にできない) が、
+# それより前は有効にしたスレッドしか記録しないので、スレッドプールで実行する処理は個別に記録する
+PER_THREAD = sys.version_info < (3, 12)
+
+# NOTE: プロファイラ自身によるメモリ確保は、レポートに含めない
+TRACE_FILTER = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+@dataclasses.dataclass
+class Session:
+    cycle: int
+    start: float
+    cpu: bool
+    profile_list: list = dataclasses.field(default_factory=list)
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+
+
+_state = {"enabled": False, "session": None, "rss": None, "prefix": None}
+
+
+def get_profile_config(config):
+    return config.get("profile", {})
+
+
+def get_mode_list(config):
+    return get_profile_config(config).get("mode", MODE_LIST)
+
+
+def init(config):
+    _state["enabled"] = True
+    _state["rss"] = psutil.Process().memory_info().rss
+    # NOTE: 周期の番号は起動毎に 0 から数え直すので、起動した時刻をレポートの名前に含める
+    _state["prefix"] = my_lib.time.now().strftime("%Y%m%d%H%M%S")
+
+    logging.info(
+        "Profiling every %d cycles (%s)",
+        get_profile_config(config).get("every", EVERY),
+        ", ".join(get_mode_list(config)),
+    )
+
+
+def is_sampled(config, cycle):
+    return _state["enabled"] and (cycle % get_profile_config(config).get("every", EVERY) == 0)
+
+
+def wrap(func):
+    session = _state["session"]
+    if (not PER_THREAD) or (session is None) or not session.cpu:
+        return func
+
+    def profiled(*args):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            with session.lock:
+                session.profile_list.append(profile)
+
+    return profiled
+
+
+def format_cpu(session, top):
+    with session.lock:
+        profile_list = list(session.profile_list)
+
+    stream = io.StringIO()
+    stats = pstats.Stats(*profile_list, stream=stream)
+    stats.sort_stats("cumulative").print_stats(top)
+
+    return stats, stream.getvalue()
+
+
+def format_memory(snapshot, top):
+    # NOTE: 周期の間に確保し、周期の終わりにまだ解放されていないメモリを、確保した箇所毎に並べる
+    stat_list = snapshot.filter_traces(TRACE_FILTER).statistics("lineno")
+
+    return "\n".join(
+        [
+            f"== Memory (top {top} retained at the end of the cycle) ==",
+            *(str(stat) for stat in stat_list[:top]),
+        ]
+    )
+
+
+def format_rss():
+    rss = psutil.Process().memory_info().rss
+    prev = _state["rss"]
+    _state["rss"] = rss
+
+    return f"rss: {rss / 1024**2:.1f} MiB ({(rss - prev) / 1024**2:+.1f} MiB)"
+
+
+def rotate(report_dir, keep):
+    path_list = sorted(report_dir.glob("*.cycle.*.txt"), key=lambda path: path.stat().st_mtime)
+
+    for path in path_list[: max(len(path_list) - keep, 0)]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".prof").unlink(missing_ok=True)
+
+
+def write_report(config, session, snapshot):
+    profile_config = get_profile_config(config)
+    top = profile_config.get("top", TOP)
+    report_dir = pathlib.Path(profile_config.get("dir", DIR))
+    report_dir.mkdir(parents=True, exist_ok=True)
+
+    path = report_dir / f"{_state['prefix']}.cycle.{session.cycle:08d}.txt"
+    section_list = [
+        "\n".join(
+            [
+                f"cycle: {session.cycle}",
+                "time: {}".format(
+                    datetime.datetime.fromtimestamp(session.start, tz=my_lib.time.get_zoneinfo()).isoformat()
+                ),
+                f"elapsed: {time.time() - session.start:.3f} sec",
+                format_rss(),
+            ]
+        )
+    ]
+
+    if session.cpu:
+        stats, text = format_cpu(session, top)
+        # NOTE: 詳しく調べられるよう、snakeviz などで読める形式でも残す
+        stats.dump_stats(path.with_suffix(".prof"))
+        section_list.append(f"== CPU (top {top} by cumulative time) ==\n{text.strip()}")
+    if snapshot is not None:
+        section_list.append(format_memory(snapshot, top))
+
+    path.write_text("\n\n".join(section_list) + "\n")
+    rotate(report_dir, profile_config.get("keep", KEEP))
+
+    logging.info("Profile written: %s", path)
+
+
+@contextlib.contextmanager
+def sample(config, cycle):
+    if not is_sampled(config, cycle):
+        yield
+        return
+
+    session = Session(cycle=cycle, start=time.time(), cpu="cpu" in get_mode_list(config))
+    profile = None
+    if session.cpu:
+        profile = cProfile.Profile()
+        session.profile_list.append(profile)
+        profile.enable()
+    _state["session"] = session
+
+    # NOTE: メモリの確保の記録は負荷が大きいので、プロファイルする周期の間だけ行う
+    is_trace = ("memory" in get_mode_list(config)) and not tracemalloc.is_tracing()
+    if is_trace:
+        tracemalloc.start(get_profile_config(config).get("frames", FRAMES))
+
+    try:
+        yield
+    finally:
+        _state["session"] = None
+        if profile is not None:
+            profile.disable()
+
+        snapshot = None
+        if is_trace:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        # NOTE: レポートの作成にかかった時間も、プロファイルの負荷として記録する
+        with rainfall.metrics.measure("profile"):
+            try:
+                write_report(config, session, snapshot)
+            except Exception:
+                logging.exception("Failed to write profile")
+
+
+def clear():
+    _state["enabled"] = False
+    _state["session"] = None
+    _state["rss"] = None
+    _state["prefix"] = None
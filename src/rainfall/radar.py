@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+雨雲レーダーの画像を先読みして手元にキャッシュし、通知に使える最新の画像の URL を返します。
+
+Usage:
+  radar.py [-c CONFIG] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -D                : デバッグモードで動作します。
+"""
+
+import concurrent.futures
+import dataclasses
+import datetime
+import functools
+import hashlib
+import http.server
+import logging
+import pathlib
+import threading
+import time
+
+import my_lib.time
+import rainfall.breaker
+import requests
+
+SLOT_SEC = 5 * 60  # NOTE: レーダー画像は 5分毎に公開される
+DELAY_SEC = 10 * 60  # NOTE: キャッシュが無い場合に、公開済みとみなす遅れ
+LOOKBACK_SLOT = 6  # NOTE: 最新の画像を探すときに遡る枠の数
+MAX_AGE_SEC = 30 * 60  # NOTE: これより古い画像は、通知に使わない
+CACHE_SIZE = 12
+CACHE_BYTES = 16 * 1024 * 1024
+TIMEOUT_SEC = 5
+
+
+@dataclasses.dataclass
+class Frame:
+    slot: datetime.datetime
+    url: str
+    path: pathlib.Path
+    size: int
+
+
+_frame_map = {}  # NOTE: 画像の URL のテンプレート毎に、枠の古い順に並べた画像
+_future_map = {}
+_slot_map = {}  # NOTE: 枠毎の先読みで、最後に先読みした枠
+_server = None
+_lock = threading.Lock()
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="radar")
+_session = requests.Session()
+
+
+def is_enabled(config):
+    return "cache" in config["rain_cloud"]["img"]
+
+
+def get_cache_config(config):
+    return config["rain_cloud"]["img"]["cache"]
+
+
+def get_key(config):
+    return hashlib.sha1(config["rain_cloud"]["img"]["url_tmpl"].encode()).hexdigest()[:12]  # noqa: S324
+
+
+def get_breaker_name(config):
+    return f"radar.{get_key(config)}"
+
+
+def get_slot(timestamp):
+    return datetime.datetime.fromtimestamp((timestamp // SLOT_SEC) * SLOT_SEC, tz=my_lib.time.get_zoneinfo())
+
+
+def get_slot_url(config, slot):
+    return slot.strftime(config["rain_cloud"]["img"]["url_tmpl"]).format(slot.minute // 5 * 5)
+
+
+def get_fallback_url(config):
+    # MEMO: 10分遡って5分単位に丸める
+    return get_slot_url(config, get_slot(time.time() - DELAY_SEC))
+
+
+def get_frame_path(config, slot):
+    return pathlib.Path(get_cache_config(config)["dir"]) / "{}.{}.jpg".format(
+        get_key(config), slot.strftime("%Y%m%d%H%M")
+    )
+
+
+def load_frame_list(config):
+    # NOTE: 再起動前にキャッシュした画像も、サイズの上限に含める
+    frame_list = []
+    for path in sorted(pathlib.Path(get_cache_config(config)["dir"]).glob(f"{get_key(config)}.*.jpg")):
+        try:
+            slot = datetime.datetime.strptime(path.name.split(".")[1], "%Y%m%d%H%M").replace(
+                tzinfo=my_lib.time.get_zoneinfo()
+            )
+        except ValueError:
+            continue
+        frame_list.append(
+            Frame(slot=slot, url=get_slot_url(config, slot), path=path, size=path.stat().st_size)
+        )
+
+    return frame_list
+
+
+def get_frame_list(config):
+    key = get_key(config)
+
+    with _lock:
+        if key not in _frame_map:
+            _frame_map[key] = load_frame_list(config)
+        return _frame_map[key]
+
+
+def evict(config):
+    cache_config = get_cache_config(config)
+    size = cache_config.get("size", CACHE_SIZE)
+    max_bytes = cache_config.get("max_bytes", CACHE_BYTES)
+
+    frame_list = get_frame_list(config)
+    with _lock:
+        while (len(frame_list) > size) or (sum(frame.size for frame in frame_list) > max_bytes):
+            frame = frame_list.pop(0)
+            frame.path.unlink(missing_ok=True)
+            logging.debug("Radar frame evicted: %s", frame.path)
+
+
+def store(config, slot, url, content):
+    path = get_frame_path(config, slot)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_bytes(content)
+    tmp_path.replace(path)
+
+    frame_list = get_frame_list(config)
+    with _lock:
+        frame_list[:] = [frame for frame in frame_list if frame.slot != slot]
+        frame_list.append(Frame(slot=slot, url=url, path=path, size=len(content)))
+        frame_list.sort(key=lambda frame: frame.slot)
+
+    evict(config)
+
+
+def get_latest(config):
+    frame_list = get_frame_list(config)
+    with _lock:
+        if len(frame_list) == 0:
+            return None
+        frame = frame_list[-1]
+
+    if time.time() - frame.slot.timestamp() > MAX_AGE_SEC:
+        return None
+
+    return frame
+
+
+def get_history(config):
+    # NOTE: 雨雲の動きを予測する場合は、直前の枠の画像も必要
+    return 2 if "nowcast" in config["rain_cloud"] else 1
+
+
+def fetch_slot(config, slot):
+    url = get_slot_url(config, slot)
+
+    with rainfall.breaker.guard(get_breaker_name(config)):
+        res = _session.head(url, timeout=TIMEOUT_SEC, allow_redirects=True)
+        if res.status_code != 200:
+            return False
+
+        res = _session.get(url, timeout=TIMEOUT_SEC)
+        res.raise_for_status()
+
+    logging.info("Radar frame fetched: %s", url)
+    store(config, slot, url, res.content)
+
+    return True
+
+
+def prefetch(config):
+    latest = get_latest(config)
+    newest_slot = get_slot(time.time())
+
+    # NOTE: 新しい枠から順に、公開済みかどうかを HEAD で確かめ、最初に見つかった画像だけを取得する
+    for i in range(LOOKBACK_SLOT):
+        slot = newest_slot - datetime.timedelta(seconds=SLOT_SEC * i)
+        if (latest is not None) and (slot <= latest.slot):
+            logging.debug("Radar frame is up to date: %s", latest.slot)
+            return latest
+
+        if not fetch_slot(config, slot):
+            continue
+
+        cached = {frame.slot for frame in get_frame_list(config)}
+        for j in range(1, get_history(config)):
+            prev_slot = slot - datetime.timedelta(seconds=SLOT_SEC * j)
+            if prev_slot not in cached:
+                fetch_slot(config, prev_slot)
+
+        return get_latest(config)
+
+    logging.warning("No radar frame available in the last %d min", LOOKBACK_SLOT * SLOT_SEC // 60)
+
+    return latest
+
+
+def prefetch_safe(config):
+    try:
+        return prefetch(config)
+    except Exception:
+        logging.warning("Failed to prefetch radar frame")
+        return None
+
+
+def request(config):
+    # NOTE: 雨が降りそうな間だけ呼ばれる。先読みが終わっていない場合は、重ねて行わない
+    if not is_enabled(config):
+        return
+
+    key = get_key(config)
+    with _lock:
+        future = _future_map.get(key)
+        if (future is not None) and not future.done():
+            return
+        _future_map[key] = _executor.submit(prefetch_safe, config)
+
+
+def request_every_slot(config):
+    # NOTE: 雨が降りそうでない間も先読みする場合に、公開の間隔より頻繁には問い合わせない
+    if not is_enabled(config):
+        return
+
+    key = get_key(config)
+    slot = get_slot(time.time())
+    with _lock:
+        if _slot_map.get(key) == slot:
+            return
+        _slot_map[key] = slot
+
+    request(config)
+
+
+def join():
+    with _lock:
+        future_list = list(_future_map.values())
+
+    concurrent.futures.wait(future_list)
+
+
+def get_frame_url(config, frame):
+    # NOTE: 手元で配信している場合は、キャッシュした画像を返す
+    base_url = get_cache_config(config).get("url")
+    if base_url is None:
+        return frame.url
+
+    return base_url.rstrip("/") + "/" + frame.path.name
+
+
+def get_image_url(config):
+    if not is_enabled(config):
+        return get_fallback_url(config)
+
+    if get_latest(config) is None:
+        # NOTE: 先読みしていなかった場合は、先読みと重ならないよう同じ経路で取得する
+        request(config)
+
+    with _lock:
+        future = _future_map.get(get_key(config))
+    if future is not None:
+        try:
+            future.result(timeout=TIMEOUT_SEC)
+        except concurrent.futures.TimeoutError:
+            logging.warning("Timeout waiting for radar prefetch")
+
+    frame = get_latest(config)
+    if frame is None:
+        return get_fallback_url(config)
+
+    return get_frame_url(config, frame)
+
+
+class HttpHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):  # noqa: A002
+        logging.debug(format, *args)
+
+
+def start(config):
+    global _server  # noqa: PLW0603
+
+    if not is_enabled(config) or ("port" not in get_cache_config(config)):
+        return
+
+    cache_config = get_cache_config(config)
+    pathlib.Path(cache_config["dir"]).mkdir(parents=True, exist_ok=True)
+
+    server = http.server.ThreadingHTTPServer(
+        (cache_config.get("host", "0.0.0.0"), cache_config["port"]),  # noqa: S104
+        functools.partial(HttpHandler, directory=cache_config["dir"]),
+    )
+    threading.Thread(target=server.serve_forever, name="radar-http", daemon=True).start()
+    logging.info("Serving radar frames on %s:%d", *server.server_address)
+
+    with _lock:
+        _server = server
+
+
+def stop():
+    global _server  # noqa: PLW0603
+
+    with _lock:
+        server = _server
+        _server = None
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def clear(wait=True):
+    # NOTE: 待たない場合、終わっていない先読みの画像はキャッシュのファイルから読み込み直される
+    if wait:
+        join()
+    with _lock:
+        _frame_map.clear()
+        _future_map.clear()
+        _slot_map.clear()
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    request(config)
+    logging.info(get_image_url(config))
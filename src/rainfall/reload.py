@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+設定ファイルの変更を監視し、監視ループを止めずに新しい設定に切り替えます。
+
+設定の読み込みと検証は別スレッドで行い、切り替えは監視の周期の合間に行います。
+変更された項目に関係するキャッシュやサーバーだけを作り直します。
+"""
+
+import itertools
+import logging
+import pathlib
+import signal
+import sys
+import threading
+
+import rainfall.breaker
+import rainfall.forecast
+import rainfall.ingest
+import rainfall.monitor
+import rainfall.nowcast
+import rainfall.radar
+import rainfall.sensor
+import rainfall.shadow
+import rainfall.site
+import rainfall.status
+
+POLL_SEC = 2  # NOTE: 設定ファイルの更新日時を確認する間隔
+
+
+def reset_sensor(config):  # noqa: ARG001
+    # NOTE: 保存したデータがある場合は、作り直した後にそこから復元される
+    rainfall.sensor.close()
+    rainfall.sensor.clear()
+
+
+def reset_forecast(config):  # noqa: ARG001
+    rainfall.forecast.clear()
+
+
+def reset_voice(config):
+    # NOTE: 音声関係のライブラリを読み込んでいない場合は、キャッシュも無い
+    voice = sys.modules.get("rainfall.voice")
+    if voice is not None:
+        voice.clear()
+
+    for site_config in rainfall.site.get_config_list(config):
+        rainfall.monitor.init_voice(site_config)
+
+
+def reset_radar(config):
+    rainfall.radar.stop()
+    # NOTE: 監視の周期の合間に呼ばれるので、先読みの終わりは待たない
+    rainfall.radar.clear(wait=False)
+    rainfall.nowcast.clear()
+    rainfall.radar.start(config)
+
+
+def reset_nowcast(config):
+    rainfall.nowcast.clear()
+
+    for site_config in rainfall.site.get_config_list(config):
+        rainfall.monitor.init_nowcast(site_config)
+
+
+def reset_ingest(config):
+    rainfall.ingest.stop()
+    rainfall.ingest.start(config)
+
+
+def reset_status(config):
+    rainfall.status.stop()
+    rainfall.status.start(config)
+
+
+def reset_shadow(config):  # noqa: ARG001
+    rainfall.shadow.clear()
+
+
+def reset_breaker(config):
+    rainfall.breaker.init(config)
+
+
+# NOTE: 設定の項目と、その項目が変わった場合に作り直すもの。地点毎の設定も含めて比較する
+RESET_LIST = [
+    (("influxdb",), reset_sensor),
+    (("sensor",), reset_sensor),
+    (("store",), reset_sensor),
+    (("weather", "forecast"), reset_forecast),
+    # NOTE: 合成済みの音声やチャイムが変わる項目のみ。通知する時間帯などが変わってもキャッシュは消さない
+    (("voice", "server"), reset_voice),
+    (("notify", "voice", "chime"), reset_voice),
+    (("notify", "voice", "cache"), reset_voice),
+    (("rain_cloud", "img"), reset_radar),
+    (("rain_cloud", "nowcast"), reset_nowcast),
+    (("ingest",), reset_ingest),
+    (("influxdb",), reset_ingest),
+    (("sensor",), reset_ingest),
+    (("store",), reset_ingest),
+    (("status",), reset_status),
+    (("shadow",), reset_shadow),
+    (("watch", "breaker"), reset_breaker),
+]
+
+_watcher = {"thread": None, "stop": None}
+_pending = {"config": None}
+_hup = threading.Event()
+_lock = threading.Lock()
+
+
+def get_stamp(config_file):
+    try:
+        stat = pathlib.Path(config_file).stat()
+    except OSError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def get_value(config, path):
+    for key in path:
+        if not isinstance(config, dict):
+            return None
+        config = config.get(key)
+
+    return config
+
+
+def is_changed(old_list, new_list, path):
+    return any(
+        get_value(old, path) != get_value(new, path) for old, new in itertools.zip_longest(old_list, new_list)
+    )
+
+
+def get_reset_list(old, new):
+    old_list = rainfall.site.get_config_list(old)
+    new_list = rainfall.site.get_config_list(new)
+
+    reset_list = []
+    for path, func in RESET_LIST:
+        if (func not in reset_list) and is_changed(old_list, new_list, path):
+            logging.info("Config changed: %s", ".".join(path))
+            reset_list.append(func)
+
+    return reset_list
+
+
+def load(config_file, schema_file):
+    import my_lib.config
+
+    try:
+        return my_lib.config.load(config_file, schema_file)
+    except Exception:
+        # NOTE: 書きかけや誤りのある設定は使わず、今の設定のまま監視を続ける
+        logging.exception("Failed to load config. Keeping the current config: %s", config_file)
+        return None
+
+
+def watch_worker(config_file, schema_file, stop_event):
+    stamp = get_stamp(config_file)
+
+    while not stop_event.is_set():
+        _hup.wait(POLL_SEC)
+        if stop_event.is_set():
+            break
+
+        new_stamp = get_stamp(config_file)
+        if (new_stamp == stamp) and not _hup.is_set():
+            continue
+        _hup.clear()
+        stamp = new_stamp
+
+        logging.info("Reloading config: %s", config_file)
+        config = load(config_file, schema_file)
+        if config is None:
+            continue
+
+        with _lock:
+            _pending["config"] = config
+
+
+def handle_hup(signum, frame):  # noqa: ARG001
+    _hup.set()
+
+
+def start(config_file, schema_file):
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=watch_worker, args=(config_file, schema_file, stop_event), name="reload", daemon=True
+    )
+
+    with _lock:
+        _watcher["thread"] = thread
+        _watcher["stop"] = stop_event
+    thread.start()
+
+    try:
+        signal.signal(signal.SIGHUP, handle_hup)
+    except ValueError:
+        # NOTE: メインスレッド以外からは登録できないので、ファイルの監視のみで切り替える
+        logging.debug("SIGHUP handler is not installed")
+
+
+def stop():
+    with _lock:
+        thread, stop_event = _watcher["thread"], _watcher["stop"]
+        _watcher["thread"] = None
+        _watcher["stop"] = None
+
+    if thread is None:
+        return
+
+    stop_event.set()
+    _hup.set()
+    thread.join()
+    _hup.clear()
+
+
+def apply(config):
+    # NOTE: 監視の周期の合間に呼ばれ、新しい設定があればそれに切り替える
+    with _lock:
+        new_config = _pending["config"]
+        _pending["config"] = None
+
+    if (new_config is None) or (new_config == config):
+        return config
+
+    for func in get_reset_list(config, new_config):
+        func(new_config)
+
+    logging.info("Config reloaded")
+
+    return new_config
+
+
+def clear():
+    stop()
+    with _lock:
+        _pending["config"] = None
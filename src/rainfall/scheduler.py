@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""天気予報やセンサーの状態に応じて、監視間隔を決めます。"""
+
+import logging
+
+BACKOFF_RATIO = 2  # NOTE: 晴れている間は、監視間隔をこの比率で伸ばしていく
+RECONCILE_SEC = 300  # NOTE: プッシュされたデータで判定する場合に、InfluxDB と突き合わせる間隔
+
+
+def get_interval_range(config):
+    watch_config = config["watch"]
+    adaptive_config = watch_config.get("adaptive")
+
+    if adaptive_config is None:
+        return watch_config["interval_sec"], watch_config["interval_sec"]
+
+    return adaptive_config["min_sec"], adaptive_config["max_sec"]
+
+
+def get_reconcile_interval(config):
+    if "ingest" not in config:
+        return None
+
+    return config["ingest"].get("reconcile_sec", RECONCILE_SEC)
+
+
+def get_liveness_interval(config):
+    # NOTE: 監視間隔が伸びても Liveness のチェックに引っかからないよう、最大値を使う
+    return max(get_interval_range(config)[1], get_reconcile_interval(config) or 0)
+
+
+def is_rain_likely(result):
+    snapshot = result["snapshot"]
+
+    # NOTE: 予報が取得できなかった場合は、降りそうなものとして扱う
+    if result["precip_sum"] is None:
+        return True
+
+    return (result["precip_sum"] >= 0.1) or snapshot.raining or (snapshot.raining_sum > 0)
+
+
+def next_interval(config, result_list, interval=None):
+    # NOTE: result_list は地点毎の監視結果
+    min_sec, max_sec = get_interval_range(config)
+
+    reconcile_sec = get_reconcile_interval(config)
+    if reconcile_sec is not None:
+        # NOTE: 雨の降り始めはプッシュで検知するので、問い合わせは取りこぼしの補完のみ
+        return reconcile_sec
+    if min_sec == max_sec:
+        return min_sec
+    if any((result is None) or is_rain_likely(result) for result in result_list):
+        # NOTE: いずれかの地点で雨が降りそうな場合や、状況が分からない場合は、間隔を詰めて監視する
+        return min_sec
+
+    if interval is None:
+        interval = config["watch"]["interval_sec"]
+
+    interval = min(max(interval * BACKOFF_RATIO, min_sec), max_sec)
+    logging.debug("No rain expected. Next watch in %d sec", interval)
+
+    return interval
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+雨量計のセンサーデータを差分で取得し、手元で積算します。
+
+Usage:
+  sensor.py [-c CONFIG] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -D                : デバッグモードで動作します。
+"""
+
+import atexit
+import dataclasses
+import datetime
+import logging
+import pathlib
+import threading
+import time
+
+import influxdb_client
+import my_lib.time
+import numpy as np
+import rainfall.breaker
+
+FIELD_LIST = ["raining", "rain", "solar_rad"]
+BUFFER_SIZE = 4096  # NOTE: フィールド毎に保持するデータ数
+BACKFILL_MIN = 60  # NOTE: 起動直後に遡って取得する期間[分]
+TIME_TOLERANCE_SEC = 1e-3  # NOTE: 時刻の精度の違いを吸収して、同じデータとみなす差
+
+# NOTE: 前回取得したデータより新しいものだけを、同じバケットのセンサー・全フィールド分まとめて
+# 1 回のクエリで取得する
+FLUX_POINTS_QUERY = """
+from(bucket: "{bucket}")
+    |> range(start: {start})
+    |> filter(fn: (r) => {cond})
+    |> map(fn: (r) => ({{ r with _value: float(v: r._value) }}))
+    |> keep(columns: ["_time", "_measurement", "hostname", "_field", "_value"])
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    raining_start: datetime.datetime
+    raining_sum: float
+    solar_rad: float | None
+    raining: bool = False
+
+
+def open_store(path, size):
+    # NOTE: 先頭の行に (これまでに追加したデータ数, 容量) を、以降の行に (時刻, 値) を並べる
+    if path.exists():
+        try:
+            data = np.lib.format.open_memmap(path, mode="r+")
+            if (data.dtype == np.float64) and (data.shape == (size + 1, 2)) and (data[0, 1] == size):
+                return data
+        except ValueError:
+            pass
+        logging.warning("Sensor store has an unexpected layout. Recreating: %s", path)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(size + 1, 2))
+    data[0] = [0, size]
+
+    return data
+
+
+class RingBuffer:
+    def __init__(self, size=BUFFER_SIZE, path=None):
+        """最大 size 点の時刻と値の組を保持するバッファを作ります。"""
+        # NOTE: path を指定した場合は、ファイルをメモリにマップして再起動後も使えるようにする
+        self.data = np.zeros((size + 1, 2), dtype=np.float64) if path is None else open_store(path, size)
+        self.time = self.data[1:, 0]
+        self.value = self.data[1:, 1]
+
+    @property
+    def total(self):
+        # NOTE: これまでに追加したデータ数 (次に書き込むデータの通し番号)
+        return int(self.data[0, 0])
+
+    @total.setter
+    def total(self, total):
+        self.data[0, 0] = total
+
+    @property
+    def count(self):
+        return min(self.total, len(self.time))
+
+    def last_time(self):
+        if self.total == 0:
+            return None
+        return self.time[(self.total - 1) % len(self.time)]
+
+    def append(self, time_array, value_array):
+        size = len(self.time)
+        index = (self.total + np.arange(len(time_array))) % size
+
+        self.time[index[-size:]] = time_array[-size:]
+        self.value[index[-size:]] = value_array[-size:]
+        self.total += len(time_array)
+
+    def merge(self, time_array, value_array):
+        # NOTE: 最新のデータより古いデータを、時刻の順に差し込む。容量を超えた分は古い方から捨てる
+        view_time, view_value = self.view()
+        time_array = np.concatenate([view_time, time_array])
+        value_array = np.concatenate([view_value, value_array])
+        order = np.argsort(time_array, kind="stable")
+
+        size = len(self.time)
+        total = self.total + len(time_array) - len(view_time)
+        keep = min(len(time_array), size)
+        index = np.arange(total - keep, total) % size
+
+        self.time[index] = time_array[order][-keep:]
+        self.value[index] = value_array[order][-keep:]
+        self.total = total
+
+    def contains(self, time_array):
+        view_time = self.view()[0]
+        if len(view_time) == 0:
+            return np.zeros(len(time_array), dtype=bool)
+
+        return np.isclose(time_array[:, None], view_time[None, :], rtol=0, atol=TIME_TOLERANCE_SEC).any(
+            axis=1
+        )
+
+    def at(self, seq):
+        return self.time[seq % len(self.time)], self.value[seq % len(self.time)]
+
+    def view(self):
+        index = np.arange(self.total - self.count, self.total) % len(self.time)
+        return self.time[index], self.value[index]
+
+    def get(self, start, stop):
+        # NOTE: start < t <= stop のデータを古い順に返す
+        time_array, value_array = self.view()
+        lower = np.searchsorted(time_array, start, side="right")
+        upper = np.searchsorted(time_array, stop, side="right")
+
+        return time_array[lower:upper], value_array[lower:upper]
+
+
+class Accumulator:
+    def __init__(self, sum_min, store_dir=None):
+        """フィールド毎のバッファを用意し、sum_min 分間の雨量を積算します。"""
+        self.buffer = {
+            field: RingBuffer(path=None if store_dir is None else store_dir / f"{field}.npy")
+            for field in FIELD_LIST
+        }
+        self.sum_sec = sum_min * 60
+        self.rain_sum = 0.0
+        self.window_seq = 0  # NOTE: 積算期間内で最も古い rain データの通し番号
+        self.raining_last = None
+        self.raining_start = None
+        # NOTE: InfluxDB から取得済みのデータの最新の時刻。プッシュされたデータとは別に管理し、
+        # プッシュが抜けた分も次の問い合わせで取得できるようにする
+        self.cursor = dict.fromkeys(FIELD_LIST)
+        # NOTE: 定期的な問い合わせと、プッシュされたデータの受信の両方から更新される
+        self.lock = threading.Lock()
+
+        self.restore()
+
+    def restore(self):
+        # NOTE: 再起動前のデータがある場合は、降り始めの時刻などをそこから求め直す。
+        # 保持するデータ数は一定なので、再起動にかかる時間は蓄積した期間によらない
+        time_array, value_array = self.buffer["raining"].view()
+        if len(time_array) != 0:
+            self.update_raining_start(time_array, value_array)
+
+        # NOTE: 次の判定で積算雨量を計算し直す
+        self.window_seq = -1
+
+        # NOTE: 再起動前に取得した範囲は分からないので、保存しているデータの後から取得する
+        self.cursor = {field: self.buffer[field].last_time() for field in FIELD_LIST}
+
+    def since(self, field):
+        return self.buffer[field].last_time()
+
+    def append(self, field, point_list):
+        buffer = self.buffer[field]
+        time_array = np.array([point[0].timestamp() for point in point_list], dtype=np.float64)
+        value_array = np.array([point[1] for point in point_list], dtype=np.float64)
+
+        order = np.argsort(time_array, kind="stable")
+        time_array = time_array[order]
+        value_array = value_array[order]
+
+        # NOTE: 最新のデータより古いものは、まだ持っていない場合だけ差し込む
+        last_time = buffer.last_time()
+        if last_time is not None:
+            fresh = time_array > last_time
+            late = ~fresh
+            late[late] = ~buffer.contains(time_array[late])
+            if late.any():
+                self.merge(field, time_array[late], value_array[late])
+            time_array = time_array[fresh]
+            value_array = value_array[fresh]
+
+        if len(time_array) == 0:
+            return
+
+        if field == "raining":
+            self.update_raining_start(time_array, value_array)
+        elif field == "rain":
+            self.rain_sum += value_array.sum()
+
+        buffer.append(time_array, value_array)
+
+    def merge(self, field, time_array, value_array):
+        logging.debug("Merging %d late points: %s", len(time_array), field)
+        self.buffer[field].merge(time_array, value_array)
+
+        # NOTE: 差し込んだ位置より後の判定が変わるので、保持しているデータから求め直す
+        if field == "raining":
+            self.raining_last = None
+            self.update_raining_start(*self.buffer[field].view())
+        elif field == "rain":
+            self.window_seq = -1
+
+    def reconcile(self, field, point_list):
+        self.append(field, point_list)
+
+        if len(point_list) != 0:
+            last_time = max(point[0].timestamp() for point in point_list)
+            self.cursor[field] = max(self.cursor[field] or 0, last_time)
+
+    def update_raining_start(self, time_array, value_array):
+        raining = value_array > 0.5
+        # NOTE: 最初のデータは前の値が分からないので、降り始めとはみなさない
+        prev = raining[:1] if self.raining_last is None else np.array([self.raining_last])
+        rising = np.flatnonzero(raining & ~np.concatenate([prev, raining[:-1]]))
+
+        if len(rising) != 0:
+            self.raining_start = time_array[rising[-1]]
+        self.raining_last = bool(raining[-1])
+
+    def update_rain_sum(self, now):
+        buffer = self.buffer["rain"]
+
+        if self.window_seq < buffer.total - buffer.count:
+            # NOTE: 積算期間内のデータが上書きされてしまった場合は、計算し直す
+            time_array, value_array = buffer.view()
+            lower = np.searchsorted(time_array, now - self.sum_sec, side="right")
+            self.window_seq = buffer.total - buffer.count + int(lower)
+            self.rain_sum = float(value_array[lower:].sum())
+            return
+
+        while self.window_seq < buffer.total:
+            point_time, point_value = buffer.at(self.window_seq)
+            if point_time > now - self.sum_sec:
+                break
+            self.rain_sum -= point_value
+            self.window_seq += 1
+
+        if self.window_seq == buffer.total:
+            # NOTE: 誤差が蓄積しないよう、期間内にデータが無くなったらリセットする
+            self.rain_sum = 0.0
+
+    def window_sum(self, field, minutes, now):
+        return float(self.buffer[field].get(now - minutes * 60, now)[1].sum())
+
+    def last_value(self, field, start, stop):
+        value_array = self.buffer[field].get(start, stop)[1]
+
+        return float(value_array[-1]) if len(value_array) != 0 else None
+
+    def snapshot(self, now):
+        self.update_rain_sum(now)
+
+        # NOTE: まだデータがない場合は、一年前に降り始めたことにする
+        raining_start = self.raining_start if self.raining_start is not None else now - 365 * 24 * 60 * 60
+
+        return Snapshot(
+            raining_start=datetime.datetime.fromtimestamp(raining_start, tz=my_lib.time.get_zoneinfo()),
+            raining_sum=max(self.rain_sum, 0.0),
+            solar_rad=self.last_value("solar_rad", raining_start - 10 * 60, raining_start + 60),
+            raining=bool(self.raining_last),
+        )
+
+
+_client_map = {}
+_client_lock = threading.Lock()
+
+_accumulator_map = {}
+_accumulator_lock = threading.Lock()
+
+
+def get_client(db_config):
+    # NOTE: 接続を使い回すため、クライアントは接続先毎に共有する
+    key = (db_config["url"], db_config["org"], db_config["token"])
+
+    with _client_lock:
+        if key not in _client_map:
+            _client_map[key] = influxdb_client.InfluxDBClient(
+                url=db_config["url"], org=db_config["org"], token=db_config["token"]
+            )
+        return _client_map[key]
+
+
+@atexit.register
+def close():
+    with _client_lock:
+        for client in _client_map.values():
+            client.close()
+        _client_map.clear()
+
+
+def get_sensor_key(config):
+    return (config["sensor"]["rain_fall"]["measure"], config["sensor"]["rain_fall"]["hostname"])
+
+
+def get_breaker_name(db_config):
+    # NOTE: 地点毎に接続先が異なる場合に、1 つの接続先の障害で他の地点の問い合わせまで止めない
+    return f"influxdb.{db_config['url']}"
+
+
+def get_bucket_key(config):
+    db_config = config["influxdb"]
+
+    return (db_config["url"], db_config["org"], db_config["token"], db_config["bucket"])
+
+
+def get_store_dir(config):
+    if "store" not in config:
+        return None
+
+    return pathlib.Path(config["store"]["dir"]) / "{}.{}".format(*get_sensor_key(config))
+
+
+def get_accumulator(config, sum_min):
+    key = (config["influxdb"]["url"], config["influxdb"]["bucket"], *get_sensor_key(config))
+
+    with _accumulator_lock:
+        if key not in _accumulator_map:
+            _accumulator_map[key] = Accumulator(sum_min, get_store_dir(config))
+        return _accumulator_map[key]
+
+
+def get_last_time(config, sum_min):
+    accumulator = get_accumulator(config, sum_min)
+
+    with accumulator.lock:
+        time_list = [accumulator.since(field) for field in FIELD_LIST]
+
+    time_list = [last_time for last_time in time_list if last_time is not None]
+
+    return max(time_list) if len(time_list) != 0 else None
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%S.%fZ"
+    )
+
+
+def query(db_config, target_map, timeout=None):
+    # NOTE: target_map は (measurement, hostname) 毎のフィールド別の取得開始時刻
+    cond_list = [
+        f'(r._measurement == "{measure}" and r.hostname == "{hostname}" '
+        f'and r._field == "{field}" and r._time > time(v: "{format_time(since)}"))'
+        for (measure, hostname), since_map in target_map.items()
+        for field, since in since_map.items()
+    ]
+    flux = FLUX_POINTS_QUERY.format(
+        bucket=db_config["bucket"],
+        start=f'time(v: "{format_time(min(min(since_map.values()) for since_map in target_map.values()))}")',
+        cond=" or ".join(cond_list),
+    )
+
+    point_map = {key: {field: [] for field in since_map} for key, since_map in target_map.items()}
+    try:
+        # NOTE: 応答しない場合は期限で打ち切って失敗として数える。打ち切った後に終わっても数えない
+        table_list = rainfall.breaker.call(
+            get_breaker_name(db_config), timeout, get_client(db_config).query_api().query, flux
+        )
+    except rainfall.breaker.OpenError:
+        logging.warning("Skipping sensor query. Using cached data.")
+        return point_map
+    except Exception:
+        logging.exception("Failed to fetch sensor data")
+        return point_map
+
+    for table in table_list:
+        for record in table.records:
+            key = (record.get_measurement(), record.values["hostname"])
+            if key in point_map:
+                point_map[key][record.get_field()].append((record.get_time(), record.get_value()))
+
+    return point_map
+
+
+def fetch_point(config_list, sum_min, now, timeout=None):
+    # NOTE: 同じバケットの地点はまとめて問い合わせる。同じセンサーを参照する地点は積算結果を共有する
+    group_map = {}
+    for config in config_list:
+        group_map.setdefault(get_bucket_key(config), {})[get_sensor_key(config)] = config
+
+    for sensor_map in group_map.values():
+        target_map = {}
+        for key, config in sensor_map.items():
+            accumulator = get_accumulator(config, sum_min)
+            target_map[key] = {}
+            with accumulator.lock:
+                for field in FIELD_LIST:
+                    # NOTE: 前回 InfluxDB から取得した分の後から取得する。プッシュされたデータの
+                    # 時刻から取得すると、その前に抜けたデータを取り戻せない
+                    since = accumulator.cursor[field]
+                    target_map[key][field] = max(since or 0, now - BACKFILL_MIN * 60)
+
+        db_config = next(iter(sensor_map.values()))["influxdb"]
+        for key, point_map in query(db_config, target_map, timeout).items():
+            reconcile(get_accumulator(sensor_map[key], sum_min), point_map)
+
+
+def fetch_snapshot_list(config_list, sum_min, fetch=True, timeout=None):
+    now = time.time()
+
+    # NOTE: fetch が False の場合は問い合わせず、手元に積算済みのデータ (プッシュされたデータ) を使う
+    if fetch:
+        fetch_point(config_list, sum_min, now, timeout)
+
+    snapshot_list = []
+    for config in config_list:
+        accumulator = get_accumulator(config, sum_min)
+        with accumulator.lock:
+            snapshot_list.append(accumulator.snapshot(now))
+
+    return snapshot_list
+
+
+def append(accumulator, point_map):
+    with accumulator.lock:
+        for field, point_list in point_map.items():
+            accumulator.append(field, point_list)
+
+
+def reconcile(accumulator, point_map):
+    with accumulator.lock:
+        for field, point_list in point_map.items():
+            accumulator.reconcile(field, point_list)
+
+
+def fetch_snapshot(config, sum_min):
+    return fetch_snapshot_list([config], sum_min)[0]
+
+
+def clear():
+    with _accumulator_lock:
+        _accumulator_map.clear()
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    logging.info(fetch_snapshot(config, 3))
+    logging.info(fetch_snapshot(config, 3))
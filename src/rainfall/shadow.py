@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+判定条件を変えた場合に通知していたかどうかを、実際のセンサーデータで並行して評価します。
+
+監視で取得したデータをそのまま使うので、問い合わせや通知は増えません。
+"""
+
+import collections
+import dataclasses
+import datetime
+import logging
+import threading
+import time
+
+import my_lib.time
+import rainfall.monitor
+import rainfall.state
+
+LOG_SIZE = 100  # NOTE: 判定条件毎に残す、通知していたはずの記録の数
+COUNT_KEY_LIST = ["line", "voice", "suppressed_solar", "suppressed_continuous"]
+
+
+@dataclasses.dataclass
+class Variant:
+    name: str
+    param: dict
+    state: rainfall.state.NotificationState
+    count: dict = dataclasses.field(default_factory=lambda: dict.fromkeys(COUNT_KEY_LIST, 0))
+    log: collections.deque = dataclasses.field(default_factory=lambda: collections.deque(maxlen=LOG_SIZE))
+
+
+_variant_map = {}
+_lock = threading.Lock()
+
+
+def is_enabled(config):
+    return len(config.get("shadow", [])) != 0
+
+
+def get_variant_list(config, default_param, process_start):
+    key = rainfall.state.get_key(config)
+
+    with _lock:
+        if key not in _variant_map:
+            # NOTE: 通知の状態はメモリ上でのみ管理し、本番のフットプリントには触れない
+            _variant_map[key] = [
+                Variant(
+                    name=shadow_config["name"],
+                    param={name: shadow_config.get(name, value) for name, value in default_param.items()},
+                    state=rainfall.state.NotificationState(process_start=process_start, footprint={}),
+                )
+                for shadow_config in config["shadow"]
+            ]
+
+        return _variant_map[key]
+
+
+def record(variant, mode, snapshot, raining_sum, precip_sum):
+    variant.count[mode] += 1
+    variant.log.append(
+        {
+            "time": time.time(),
+            "mode": mode,
+            "raining_start": snapshot.raining_start.timestamp(),
+            "raining_sum": raining_sum,
+            "precip_sum": precip_sum,
+        }
+    )
+    logging.info(
+        "[shadow: %s] Would notify by %s (raining_start: %s, sum: %.2fmm)",
+        variant.name,
+        mode.upper(),
+        snapshot.raining_start.strftime("%Y/%m/%d %H:%M"),
+        raining_sum,
+    )
+
+
+def is_notify_done(variant, snapshot, mode, now):
+    # NOTE: 本番と同じ判定を、変えた条件で行う
+    reason = rainfall.monitor.get_skip_reason(snapshot, variant.state, mode, variant.param, now)
+
+    if reason in ["continuous", "solar"]:
+        variant.count[{"continuous": "suppressed_continuous", "solar": "suppressed_solar"}[reason]] += 1
+        variant.state.update(mode)
+
+    return reason is not None
+
+
+def evaluate_variant(variant, snapshot, raining_sum, precip_sum, is_voice_hour, now):
+    if not is_notify_done(variant, snapshot, "line", now):
+        variant.state.update("line")
+        record(variant, "line", snapshot, raining_sum, precip_sum)
+
+    if is_notify_done(variant, snapshot, "voice", now):
+        return
+    voice_threshold = variant.param["voice_threshold"]
+    if (raining_sum < voice_threshold) and ((precip_sum or 0) < voice_threshold):
+        return
+    if not is_voice_hour:
+        return
+
+    variant.state.update("voice")
+    record(variant, "voice", snapshot, raining_sum, precip_sum)
+
+
+def evaluate(config, snapshot, precip_sum, is_voice_hour, accumulator, default_param, process_start):
+    # NOTE: 積算期間が同じ場合は、監視で求めた雨量をそのまま使う
+    now = time.time()
+    raining_sum_map = {default_param["sum_min"]: snapshot.raining_sum}
+
+    for variant in get_variant_list(config, default_param, process_start):
+        sum_min = variant.param["sum_min"]
+        if sum_min not in raining_sum_map:
+            with accumulator.lock:
+                raining_sum_map[sum_min] = accumulator.window_sum("rain", sum_min, now)
+
+        evaluate_variant(variant, snapshot, raining_sum_map[sum_min], precip_sum, is_voice_hour, now)
+
+
+def get_stat(config):
+    key = rainfall.state.get_key(config)
+
+    with _lock:
+        variant_list = list(_variant_map.get(key, []))
+
+    return {
+        variant.name: {
+            "param": dict(variant.param),
+            "count": dict(variant.count),
+            "log": [
+                {
+                    **entry,
+                    "time": datetime.datetime.fromtimestamp(
+                        entry["time"], tz=my_lib.time.get_zoneinfo()
+                    ).isoformat(),
+                    "raining_start": datetime.datetime.fromtimestamp(
+                        entry["raining_start"], tz=my_lib.time.get_zoneinfo()
+                    ).isoformat(),
+                }
+                for entry in variant.log
+            ],
+        }
+        for variant in variant_list
+    }
+
+
+def clear():
+    with _lock:
+        _variant_map.clear()
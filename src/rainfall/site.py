@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""複数の地点を監視する場合に、地点毎の設定を組み立てます。"""
+
+import copy
+import threading
+
+SITE_KEY = "site"
+
+_cache = {"config": None, "config_list": []}
+_cache_lock = threading.Lock()
+
+
+def merge(base, override):
+    merged = copy.deepcopy(base)
+
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+
+    return merged
+
+
+def make_config(config, site):
+    base = {key: value for key, value in config.items() if key != SITE_KEY}
+    site_config = merge(base, site)
+
+    # NOTE: フットプリントを指定していない地点は、地点名を付けて他の地点と区別する
+    footprint = site.get("notify", {}).get("footprint", {})
+    for mode, footprint_config in site_config["notify"]["footprint"].items():
+        if "file" not in footprint.get(mode, {}):
+            footprint_config["file"] = "{}.{}".format(footprint_config["file"], site["name"])
+
+    return site_config
+
+
+def get_config_list(config):
+    if SITE_KEY not in config:
+        return [config]
+
+    with _cache_lock:
+        # NOTE: 毎周期作り直さないよう、元の設定が同じ間は使い回す
+        if _cache["config"] is not config:
+            _cache["config"] = config
+            _cache["config_list"] = [make_config(config, site) for site in config[SITE_KEY]]
+
+        return _cache["config_list"]
+
+
+def get_name(config):
+    return config.get("name")
+
+
+def clear():
+    with _cache_lock:
+        _cache["config"] = None
+        _cache["config_list"] = []
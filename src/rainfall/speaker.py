@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""音声データを複数のスピーカーで同時に再生します。"""
+
+import concurrent.futures
+import dataclasses
+import logging
+import subprocess
+import time
+
+import rainfall.breaker
+import rainfall.metrics
+import rainfall.voice
+import requests
+
+PREPARE_SEC = 0.5  # NOTE: 各スピーカーの準備が整うよう、再生開始をこれだけ遅らせる
+MARGIN_SEC = 10  # NOTE: 再生時間にこれを加えた時間内に終わらないスピーカーは、失敗とみなす
+WORKER_MAX = 8
+CHUNK_FRAMES = 1024
+
+ALSA_FORMAT_MAP = {1: "U8", 2: "S16_LE", 4: "S32_LE"}
+
+
+@dataclasses.dataclass(frozen=True)
+class Clip:
+    wav: bytes
+    params: object  # NOTE: wave.Wave_read.getparams() の値
+    pcm: object  # NOTE: (フレーム数, チャンネル数) の numpy 配列
+    duration_sec: float
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    success: bool
+    latency: float | None = None  # NOTE: 共通の再生開始時刻から、実際に再生を始めるまでの遅れ[秒]
+
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_MAX, thread_name_prefix="speaker")
+
+
+def make_clip(wav_data):
+    params, pcm = rainfall.voice.decode(wav_data)
+
+    return Clip(wav=wav_data, params=params, pcm=pcm, duration_sec=len(pcm) / params.framerate)
+
+
+def is_enabled(config):
+    return "sink" in config["notify"]["voice"]
+
+
+def get_breaker_name(sink):
+    return f"speaker.{sink['name']}"
+
+
+def wait_until(start_at):
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+    return time.time() - start_at
+
+
+def write_pcm(clip):
+    import pyaudio
+
+    audio = pyaudio.PyAudio()
+    try:
+        stream = audio.open(
+            format=audio.get_format_from_width(clip.params.sampwidth),
+            channels=clip.params.nchannels,
+            rate=clip.params.framerate,
+            output=True,
+            frames_per_buffer=CHUNK_FRAMES,
+        )
+        try:
+            stream.write(clip.pcm.tobytes())
+        finally:
+            stream.stop_stream()
+            stream.close()
+    finally:
+        audio.terminate()
+
+
+def play_default(sink, clip_list, start_at):  # noqa: ARG001
+    # NOTE: デコード済みの PCM をそのまま書き込み、スピーカー毎に WAV を読み直さない
+    latency = wait_until(start_at)
+    for clip in clip_list:
+        write_pcm(clip)
+
+    return latency
+
+
+def play_alsa(sink, clip_list, start_at):
+    latency = None
+    for clip in clip_list:
+        # NOTE: プロセスの起動を待たずに済むよう、先に起動してから開始時刻を待つ
+        proc = subprocess.Popen(  # noqa: S603
+            [  # noqa: S607
+                "aplay",
+                "-q",
+                "-D",
+                sink["device"],
+                "-t",
+                "raw",
+                "-f",
+                ALSA_FORMAT_MAP[clip.params.sampwidth],
+                "-c",
+                str(clip.params.nchannels),
+                "-r",
+                str(clip.params.framerate),
+                "-",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if latency is None:
+            latency = wait_until(start_at)
+
+        try:
+            _, stderr = proc.communicate(clip.pcm.tobytes(), timeout=clip.duration_sec + MARGIN_SEC)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+
+        if proc.returncode != 0:
+            raise RuntimeError(f"aplay failed: {stderr.decode().strip()}")  # noqa: TRY003, EM102
+
+    return latency
+
+
+def play_http(sink, clip_list, start_at):
+    # NOTE: ネットワーク越しのスピーカーには開始時刻を渡し、時刻を合わせて再生してもらう。
+    #       受け側がフォーマットを知らないので、元の WAV をそのまま送る
+    latency = None
+    for clip in clip_list:
+        if latency is None:
+            latency = max(time.time() - start_at, 0)
+
+        res = requests.post(
+            sink["url"],
+            data=clip.wav,
+            headers={"Content-Type": "audio/wav", "X-Start-At": f"{start_at:.3f}"},
+            timeout=clip.duration_sec + MARGIN_SEC,
+        )
+        res.raise_for_status()
+        start_at += clip.duration_sec
+
+    return latency
+
+
+PLAY_MAP = {
+    "default": play_default,
+    "alsa": play_alsa,
+    "http": play_http,
+}
+
+
+def play_sink(sink, clip_list, start_at):
+    with rainfall.breaker.guard(get_breaker_name(sink)):
+        latency = PLAY_MAP[sink["type"]](sink, clip_list, start_at)
+
+    rainfall.metrics.observe(f"play.{sink['name']}", time.time() - start_at)
+
+    return latency
+
+
+def play(config, wav_list):
+    # NOTE: デコードは 1 回だけ行い、同じデータを全てのスピーカーで共有する
+    clip_list = [make_clip(wav_data) for wav_data in wav_list]
+    sink_list = config["notify"]["voice"]["sink"]
+    duration_sec = sum(clip.duration_sec for clip in clip_list)
+
+    start_at = time.time() + PREPARE_SEC
+    future_map = {_executor.submit(play_sink, sink, clip_list, start_at): sink for sink in sink_list}
+
+    # NOTE: 遅いスピーカーがあっても、他のスピーカーの再生は待たせない
+    _, pending = concurrent.futures.wait(future_map, timeout=PREPARE_SEC + duration_sec + MARGIN_SEC)
+
+    result_list = []
+    for future, sink in future_map.items():
+        if future in pending:
+            logging.warning("Speaker timed out: %s", sink["name"])
+            rainfall.breaker.get(get_breaker_name(sink)).record_failure()
+            result_list.append(Result(name=sink["name"], success=False))
+            continue
+
+        try:
+            latency = future.result()
+        except rainfall.breaker.OpenError:
+            logging.warning("Skipping speaker: %s (failed repeatedly)", sink["name"])
+            result_list.append(Result(name=sink["name"], success=False))
+            continue
+        except Exception:
+            logging.exception("Failed to play voice: %s", sink["name"])
+            result_list.append(Result(name=sink["name"], success=False))
+            continue
+
+        logging.info("Voice played: %s (latency: %.3f sec)", sink["name"], latency)
+        result_list.append(Result(name=sink["name"], success=True, latency=latency))
+
+    return result_list
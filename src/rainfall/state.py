@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""通知の状態をメモリ上で管理し、変化した時だけフットプリントに書き出します。"""
+
+import dataclasses
+import datetime
+import threading
+import time
+
+import my_lib.footprint
+
+MODE_LIST = ["line", "voice"]
+
+
+@dataclasses.dataclass
+class NotificationState:
+    process_start: datetime.datetime
+    footprint: dict  # NOTE: モード毎のフットプリントのファイル。None の場合はメモリ上でのみ管理する
+    last: dict = dataclasses.field(default_factory=dict)  # NOTE: モード毎の最後に通知した時刻
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def elapsed(self, mode):
+        with self.lock:
+            last = self.last.get(mode)
+
+        # NOTE: 通知したことがない場合は、my_lib.footprint.elapsed と同様に十分大きな値を返す
+        return time.time() - (last if last is not None else 0)
+
+    def update(self, mode):
+        now = time.time()
+
+        with self.lock:
+            self.last[mode] = now
+
+        if self.footprint.get(mode) is not None:
+            my_lib.footprint.update(self.footprint[mode])
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "process_start": self.process_start,
+                "last": dict(self.last),
+            }
+
+
+_state_map = {}
+_state_lock = threading.Lock()
+
+
+def get_key(config):
+    return tuple(config["notify"]["footprint"][mode]["file"] for mode in MODE_LIST)
+
+
+def load(config, process_start):
+    footprint = {mode: config["notify"]["footprint"][mode]["file"] for mode in MODE_LIST}
+    last = {}
+    for mode, path in footprint.items():
+        if my_lib.footprint.exists(path):
+            last[mode] = time.time() - my_lib.footprint.elapsed(path)
+
+    state = NotificationState(process_start=process_start, footprint=footprint, last=last)
+
+    with _state_lock:
+        _state_map[get_key(config)] = state
+
+    return state
+
+
+def get(config):
+    with _state_lock:
+        return _state_map.get(get_key(config))
+
+
+def clear():
+    with _state_lock:
+        _state_map.clear()
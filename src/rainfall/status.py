@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+直近の監視結果を HTTP で返します。
+
+監視の周期毎に応答を組み立てておき、リクエストにはそれをそのまま返すので、
+InfluxDB や天気予報には問い合わせません。
+"""
+
+import datetime
+import http.server
+import json
+import logging
+import threading
+import time
+
+import my_lib.time
+import rainfall.metrics
+import rainfall.monitor
+import rainfall.scheduler
+import rainfall.shadow
+import rainfall.site
+import rainfall.state
+
+EMPTY = {"time": None, "status": b"{}", "metrics": b"", "site_map": {}, "liveness_sec": None}
+
+# NOTE: 監視の周期毎に丸ごと置き換え、書き換えはしない。参照するだけなのでロックは不要
+_latest = EMPTY
+_server = None
+
+
+def is_enabled(config):
+    return "status" in config
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return None
+
+    return datetime.datetime.fromtimestamp(timestamp, tz=my_lib.time.get_zoneinfo()).isoformat()
+
+
+def make_site(config, result, now):
+    snapshot = result["snapshot"]
+    state = rainfall.state.get(config)
+    last = state.snapshot()["last"] if state is not None else {}
+
+    site = {
+        "name": rainfall.site.get_name(config),
+        "time": format_time(now),
+        "raining": bool(snapshot.raining),
+        "raining_start": snapshot.raining_start.isoformat(),
+        "raining_sum": float(snapshot.raining_sum),
+        "precip_sum": result["precip_sum"],
+        "solar_rad": float(snapshot.solar_rad) if snapshot.solar_rad is not None else None,
+        "nowcast": result["nowcast"],
+        "last_notify": {mode: format_time(last.get(mode)) for mode in rainfall.state.MODE_LIST},
+    }
+    if rainfall.shadow.is_enabled(config):
+        # NOTE: 判定条件を変えた場合に通知していたはずの記録も返す
+        site["shadow"] = rainfall.shadow.get_stat(config)
+
+    return site
+
+
+def publish(config, result_list, cycle, start_time):
+    global _latest  # noqa: PLW0603
+
+    if not is_enabled(config):
+        return
+
+    now = time.time()
+
+    # NOTE: 期限内に終わらなかった地点は、前回の結果のままにする
+    site_map = dict(_latest["site_map"])
+    for site_config, result in zip(rainfall.site.get_config_list(config), result_list, strict=True):
+        if result is not None:
+            site_map[rainfall.state.get_key(site_config)] = make_site(site_config, result, now)
+
+    status = {
+        "time": format_time(now),
+        "cycle": {
+            "count": cycle,
+            "start": format_time(start_time),
+            "elapsed_sec": now - start_time,
+            "p95_sec": rainfall.metrics.quantile("cycle", 0.95),
+        },
+        "site": list(site_map.values()),
+    }
+
+    _latest = {
+        "time": now,
+        "status": json.dumps(status, ensure_ascii=False).encode(),
+        "metrics": rainfall.metrics.format_text().encode(),
+        "site_map": site_map,
+        # NOTE: 監視間隔が最も伸びた場合でも、次の周期が期限内に終われば生きているとみなす
+        "liveness_sec": rainfall.scheduler.get_liveness_interval(config)
+        + rainfall.monitor.get_cycle_deadline(config),
+    }
+
+
+def is_alive():
+    latest = _latest
+
+    return (latest["time"] is not None) and (time.time() - latest["time"] <= latest["liveness_sec"])
+
+
+class HttpHandler(http.server.BaseHTTPRequestHandler):
+    def send_body(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        latest = _latest
+        path = self.path.split("?")[0]
+
+        if path in ["/", "/status"]:
+            self.send_body(200, "application/json; charset=utf-8", latest["status"])
+        elif path == "/metrics":
+            self.send_body(200, "text/plain; version=0.0.4", latest["metrics"])
+        elif path == "/healthz":
+            if is_alive():
+                self.send_body(200, "text/plain", b"OK\n")
+            else:
+                self.send_body(503, "text/plain", b"NG\n")
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):  # noqa: A002
+        logging.debug(format, *args)
+
+
+def start(config):
+    global _server  # noqa: PLW0603
+
+    if not is_enabled(config):
+        return
+
+    status_config = config["status"]
+    server = http.server.ThreadingHTTPServer(
+        (status_config.get("host", "0.0.0.0"), status_config["port"]),  # noqa: S104
+        HttpHandler,
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="status-http", daemon=True).start()
+    logging.info("Serving status on %s:%d", *server.server_address)
+
+    _server = server
+
+
+def stop():
+    global _server  # noqa: PLW0603
+
+    server = _server
+    _server = None
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def get_address():
+    server = _server
+
+    return server.server_address if server is not None else None
+
+
+def clear():
+    global _latest  # noqa: PLW0603
+
+    stop()
+    _latest = EMPTY
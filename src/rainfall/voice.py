@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""音声通知用の音声データを合成・加工します。"""
+
+import collections
+import hashlib
+import io
+import json
+import logging
+import pathlib
+import threading
+import wave
+
+import my_lib.voice
+import numpy as np
+import rainfall.breaker
+import rainfall.metrics
+
+DTYPE_MAP = {1: np.uint8, 2: np.int16, 4: np.int32}
+CACHE_SIZE = 32
+
+_chime_cache = {}
+_chime_lock = threading.Lock()
+
+_synth_cache = collections.OrderedDict()
+_synth_lock = threading.Lock()
+_synth_inflight = {}
+_presynth_thread = None
+
+
+def get_breaker_name(config):
+    return f"voice.{config['voice']['server']['url']}"
+
+
+def decode(wav_data):
+    with wave.open(io.BytesIO(wav_data), "rb") as wav_file:
+        params = wav_file.getparams()
+        frames = wav_file.readframes(params.nframes)
+
+    pcm = np.frombuffer(frames, dtype=DTYPE_MAP[params.sampwidth]).reshape(-1, params.nchannels)
+
+    return params, pcm
+
+
+def encode(params, pcm):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav_file:
+        wav_file.setnchannels(params.nchannels)
+        wav_file.setsampwidth(params.sampwidth)
+        wav_file.setframerate(params.framerate)
+        wav_file.writeframes(pcm.tobytes())
+
+    return buf.getvalue()
+
+
+def load_chime(chime_config):
+    # NOTE: チャイムは毎回同じなので、デコードしたものを使い回す
+    path = pathlib.Path(chime_config["file"])
+
+    with _chime_lock:
+        if path not in _chime_cache:
+            logging.info("Load chime: %s", path)
+            with path.open("rb") as file:
+                _chime_cache[path] = decode(my_lib.voice.convert_wav_data(file.read()))
+
+        return _chime_cache[path]
+
+
+def mix(base, overlay, offset_sec):
+    base_params, base_pcm = base
+    _, overlay_pcm = overlay
+
+    offset = int(round(offset_sec * base_params.framerate))
+    length = max(len(base_pcm), offset + len(overlay_pcm))
+    dtype = base_pcm.dtype
+
+    # NOTE: 8bit は符号なしなので、中心をずらしてから足し合わせる
+    center = 128 if dtype == np.uint8 else 0
+    info = np.iinfo(dtype)
+
+    mixed = np.zeros((length, base_params.nchannels), dtype=np.int64)
+    mixed[: len(base_pcm)] += base_pcm.astype(np.int64) - center
+    mixed[offset : offset + len(overlay_pcm)] += overlay_pcm.astype(np.int64) - center
+
+    return np.clip(mixed + center, info.min, info.max).astype(dtype)
+
+
+def add_chime(config, message_wav):
+    chime_config = config["notify"]["voice"]["chime"]
+    chime = load_chime(chime_config)
+    message = decode(message_wav)
+
+    if chime[0][:3] != message[0][:3]:
+        logging.warning(
+            "Chime and message have different formats. Playing them in sequence. (chime: %s, message: %s)",
+            chime[0][:3],
+            message[0][:3],
+        )
+        return [encode(*chime), message_wav]
+
+    # NOTE: チャイムの再生開始から指定時間後にメッセージが始まるよう、1 つの音声データに合成する
+    return [encode(chime[0], mix(chime, message, chime_config["duration"]))]
+
+
+def get_cache_config(config):
+    return config["notify"]["voice"].get("cache", {})
+
+
+def get_cache_key(config, message):
+    # NOTE: 同じメッセージでも、音声合成サーバーや話者などの設定が変われば合成し直す
+    return hashlib.sha256(
+        json.dumps([config["voice"], message], ensure_ascii=False, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def get_cache_path(config, message):
+    cache_dir = get_cache_config(config).get("dir")
+    if cache_dir is None:
+        return None
+
+    return pathlib.Path(cache_dir) / (get_cache_key(config, message) + ".wav")
+
+
+def cache_get(config, message):
+    key = get_cache_key(config, message)
+    with _synth_lock:
+        if key in _synth_cache:
+            _synth_cache.move_to_end(key)
+            return _synth_cache[key]
+
+    path = get_cache_path(config, message)
+    if (path is not None) and path.exists():
+        wav_data = path.read_bytes()
+        cache_put(config, message, wav_data, store=False)
+        return wav_data
+
+    return None
+
+
+def cache_put(config, message, wav_data, store=True):
+    key = get_cache_key(config, message)
+    with _synth_lock:
+        _synth_cache[key] = wav_data
+        _synth_cache.move_to_end(key)
+        while len(_synth_cache) > get_cache_config(config).get("size", CACHE_SIZE):
+            _synth_cache.popitem(last=False)
+
+    path = get_cache_path(config, message)
+    if store and (path is not None) and isinstance(wav_data, bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(wav_data)
+
+
+def synthesize(config, message, timeout=None):
+    wav_data = cache_get(config, message)
+    if wav_data is not None:
+        logging.debug("Voice cache hit: %s", message)
+        return wav_data
+
+    key = get_cache_key(config, message)
+    with _synth_lock:
+        inflight = _synth_inflight.get(key)
+        if inflight is None:
+            _synth_inflight[key] = threading.Event()
+
+    if inflight is not None:
+        # NOTE: 同じメッセージを合成中の場合は、それを待つ
+        inflight.wait()
+        wav_data = cache_get(config, message)
+        if wav_data is not None:
+            return wav_data
+        return synthesize(config, message, timeout)
+
+    try:
+        logging.info("Synthesize voice: %s", message)
+        with rainfall.metrics.measure("synthesize"):
+            wav_data = rainfall.breaker.call(
+                get_breaker_name(config), timeout, my_lib.voice.synthesize, config, message
+            )
+        if wav_data:
+            cache_put(config, message, wav_data)
+    finally:
+        with _synth_lock:
+            _synth_inflight.pop(key).set()
+
+    return wav_data
+
+
+def presynthesize_worker(config, message_list, timeout):
+    for message in message_list:
+        try:
+            synthesize(config, message, timeout)
+        except Exception:
+            logging.exception("Failed to pre-synthesize voice: %s", message)
+            break
+
+
+def presynthesize(config, message_list, timeout=None):
+    global _presynth_thread  # noqa: PLW0603
+
+    with _synth_lock:
+        message_list = [
+            message for message in message_list if get_cache_key(config, message) not in _synth_cache
+        ]
+        if (len(message_list) == 0) or ((_presynth_thread is not None) and _presynth_thread.is_alive()):
+            return
+
+        _presynth_thread = threading.Thread(
+            target=presynthesize_worker, args=(config, message_list, timeout), name="presynth", daemon=True
+        )
+        _presynth_thread.start()
+
+
+def join():
+    with _synth_lock:
+        thread = _presynth_thread
+
+    if thread is not None:
+        thread.join()
+
+
+def init(config):
+    if "chime" in config["notify"]["voice"]:
+        load_chime(config["notify"]["voice"]["chime"])
+
+
+def clear():
+    with _chime_lock:
+        _chime_cache.clear()
+    with _synth_lock:
+        _synth_cache.clear()
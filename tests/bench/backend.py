@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用に、InfluxDB と天気予報のサーバーを手元で模擬します。
+
+センサーデータはシナリオファイルから生成した時系列を、現在時刻 (time-machine で
+動かす仮想時刻) までの分だけ返します。
+"""
+
+import datetime
+import http.server
+import json
+import pathlib
+import re
+import threading
+import time
+
+import numpy as np
+import rainfall.sensor
+import requests
+import yaml
+
+SCENARIO_DIR = pathlib.Path(__file__).parent / "scenario"
+
+# NOTE: rainfall.sensor.FLUX_POINTS_QUERY のセンサー・フィールド毎の条件
+FIELD_COND_PATTERN = re.compile(
+    r'r\._measurement == "([^"]+)" and r\.hostname == "([^"]+)" '
+    r'and r\._field == "(\w+)" and r\._time > time\(v: "([^"]+)"\)'
+)
+
+CSV_HEADER = [
+    "#datatype,string,long,dateTime:RFC3339,string,string,string,double",
+    "#group,false,false,false,true,true,true,false",
+    "#default,_result,,,,,,",
+    ",result,table,_time,_measurement,hostname,_field,_value",
+]
+
+
+def load_scenario(name):
+    with (SCENARIO_DIR / f"{name}.yaml").open() as file:
+        return yaml.safe_load(file)
+
+
+def list_scenario():
+    return sorted(path.stem for path in SCENARIO_DIR.glob("*.yaml"))
+
+
+def make_timeline(scenario, start):
+    # NOTE: 起動直後の遡り取得の分も含めて生成する
+    time_array = start + np.arange(
+        -rainfall.sensor.BACKFILL_MIN * 60, scenario["duration_min"] * 60 + 1, scenario["step_sec"]
+    )
+    minute = (time_array - start) / 60
+
+    raining = np.zeros(len(time_array))
+    rain = np.zeros(len(time_array))
+    solar_rad = np.full(len(time_array), float(scenario["solar_rad"]))
+
+    for event in scenario["event"]:
+        in_event = (minute >= event["start_min"]) & (minute < event["end_min"])
+        raining[in_event] = 1
+        rain[in_event] = event["rain"]
+        if "solar_rad" in event:
+            solar_rad[in_event] = event["solar_rad"]
+
+    return {
+        "raining": (time_array, raining),
+        "rain": (time_array, rain),
+        "solar_rad": (time_array, solar_rad),
+    }
+
+
+def parse_time(time_str):
+    return (
+        datetime.datetime.strptime(time_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+        .replace(tzinfo=datetime.timezone.utc)
+        .timestamp()
+    )
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    backend = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if not self.path.startswith("/api/v2/query"):
+            self.send_error(404)
+            return
+
+        self.reply(
+            "influxdb", body, "text/csv; charset=utf-8", self.backend.render_csv(json.loads(body)["query"])
+        )
+
+    def do_GET(self):
+        if not self.path.startswith("/forecast"):
+            self.send_error(404)
+            return
+
+        self.reply("forecast", b"", "application/json", json.dumps(self.backend.forecast))
+
+    def reply(self, kind, body, content_type, content):
+        content = content.encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+        self.backend.count(kind, len(body), len(content))
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+class Backend:
+    def __init__(self, scenario, start):
+        """シナリオを start からの時系列に展開し、問い合わせに答えられるようにします。"""
+        self.timeline = make_timeline(scenario, start)
+        self.forecast = scenario["forecast"]
+        self.stat = {
+            "influxdb_query": 0,
+            "forecast_query": 0,
+            "bytes_received": 0,
+            "bytes_sent": 0,
+        }
+        self.lock = threading.Lock()
+
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), type("BackendHandler", (Handler,), {"backend": self})
+        )
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="backend", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def count(self, kind, received, sent):
+        with self.lock:
+            self.stat[f"{kind}_query"] += 1
+            self.stat["bytes_received"] += received
+            self.stat["bytes_sent"] += sent
+
+    def render_csv(self, flux):
+        now = time.time()
+
+        line_list = list(CSV_HEADER)
+        # NOTE: どの地点を問い合わせても、シナリオの時系列を返す
+        for table, (measure, hostname, field, since) in enumerate(FIELD_COND_PATTERN.findall(flux)):
+            time_array, value_array = self.timeline[field]
+            index = (time_array > parse_time(since)) & (time_array <= now)
+
+            line_list.extend(
+                f",,{table},{rainfall.sensor.format_time(t)},{measure},{hostname},{field},{v:g}"
+                for t, v in zip(time_array[index], value_array[index], strict=True)
+            )
+
+        return "\r\n".join(line_list) + "\r\n"
+
+    def get_weather_yahoo(self, forecast_config):
+        # NOTE: Yahoo の HTML の解析は my_lib 側の責務なので、ここでは解析後の形式で返す
+        res = requests.get(forecast_config["url"], timeout=5)
+        res.raise_for_status()
+
+        return {
+            day: {"data": [{"precip": precip} for precip in precip_list]}
+            for day, precip_list in res.json().items()
+        }
@@ -55,12 +55,38 @@ def config():
 def _clear(config):
     import my_lib.footprint
     import my_lib.notify.slack
+    import rainfall.breaker
+    import rainfall.forecast
+    import rainfall.metrics
+    import rainfall.nowcast
+    import rainfall.profiler
+    import rainfall.radar
+    import rainfall.reload
+    import rainfall.sensor
+    import rainfall.shadow
+    import rainfall.site
+    import rainfall.state
+    import rainfall.status
+    import rainfall.voice
 
     my_lib.footprint.clear(config["liveness"]["file"]["watch"])
     my_lib.footprint.clear(config["notify"]["footprint"]["line"]["file"])
     my_lib.footprint.clear(config["notify"]["footprint"]["voice"]["file"])
 
     my_lib.notify.line.hist_clear()
+    rainfall.breaker.clear()
+    rainfall.forecast.clear()
+    rainfall.metrics.clear()
+    rainfall.nowcast.clear()
+    rainfall.profiler.clear()
+    rainfall.radar.clear()
+    rainfall.reload.clear()
+    rainfall.sensor.clear()
+    rainfall.shadow.clear()
+    rainfall.site.clear()
+    rainfall.state.clear()
+    rainfall.status.clear()
+    rainfall.voice.clear()
 
 
 def move_to(time_machine, hour, minutes=0):
@@ -83,29 +109,37 @@ def check_notify_line(message, index=-1):
         assert notify_hist[index].find(message) != -1, f"「{message}」が Line で通知されていません。"
 
 
+def make_query(point_map):
+    # NOTE: 問い合わせ対象のセンサー毎に同じデータを返す
+    return lambda db_config, target_map, timeout=None: {key: point_map for key in target_map}
+
+
 def sensor_mock(mocker, last_event, raining_sum, precip_sum, solar_rad):
+    import my_lib.time
+
     mocker.patch(
-        "my_lib.sensor_data.fetch_data",
-        return_value={
-            "value": [solar_rad],
-            "time": [],
-            "valid": True,
-        },
+        "rainfall.sensor.query",
+        side_effect=make_query(
+            {
+                "raining": [(last_event - datetime.timedelta(minutes=1), 0), (last_event, 1)],
+                "rain": [(my_lib.time.now(), raining_sum)],
+                "solar_rad": [(last_event, solar_rad)],
+            }
+        ),
     )
-    mocker.patch("my_lib.sensor_data.get_minute_sum", return_value=raining_sum)
-    mocker.patch("my_lib.sensor_data.get_last_event", return_value=last_event)
     mocker.patch("rainfall.monitor.check_forecast", return_value=precip_sum)
 
 
 def check_liveness(config):
     import healthz
+    import rainfall.scheduler
 
     liveness = healthz.check_liveness(
         [
             {
                 "name": name,
                 "liveness_file": pathlib.Path(config["liveness"]["file"][name]),
-                "interval": config[name]["interval_sec"],
+                "interval": rainfall.scheduler.get_liveness_interval(config),
             }
             for name in ["watch"]
         ]
@@ -260,3 +294,1440 @@ def test_basic_without_rainfall(config, mocker):
     app.do_work(config, 1)
 
     check_notify_line(None)
+
+
+def tenki_html(day_map):
+    table_list = []
+    for table_id, precip_list in day_map.items():
+        hour_row = "".join(f"<td><span>{hour:02d}</span></td>" for hour in range(1, 25))
+        precip_row = "".join(f"<td><span>{precip}</span></td>" for precip in precip_list)
+        table_list.append(
+            f'<table id="{table_id}"><tr class="hour"><th>時刻</th>{hour_row}</tr>'
+            f'<tr class="precipitation"><th>降水量</th>{precip_row}</tr></table>'
+        )
+
+    return "<html><body>{}</body></html>".format("".join(table_list))
+
+
+def test_forecast_cache(config, mocker, time_machine):
+    import rainfall.forecast
+    import rainfall.monitor
+
+    # NOTE: tenki.jp が壊れていても、Yahoo の予報を使う
+    mocker.patch.dict(
+        rainfall.forecast.PROVIDER_MAP["tenki"], {"fetch": mocker.Mock(side_effect=RuntimeError("Broken"))}
+    )
+
+    weather_info = {
+        "today": {"data": [{"precip": i} for i in range(8)]},
+        "tomorrow": {"data": [{"precip": 10 + i} for i in range(8)]},
+    }
+    weather_mock = mocker.patch("my_lib.weather.get_weather_yahoo", return_value=weather_info)
+
+    move_to(time_machine, 12)
+
+    assert rainfall.monitor.check_forecast(config, 12) == 4
+    assert rainfall.monitor.check_forecast(config, 13) == pytest.approx(4 + 1 / 3)
+    # NOTE: TTL 内はキャッシュが使われる
+    assert weather_mock.call_count == 1
+
+    # NOTE: TTL を過ぎて取得に失敗した場合は、古いデータが使われる
+    move_to(time_machine, 23)
+    weather_mock.side_effect = RuntimeError("Failed to fetch")
+
+    assert rainfall.monitor.check_forecast(config, 23) == pytest.approx(7 * 1 / 3 + 10 * 2 / 3)
+    assert weather_mock.call_count == 2
+
+
+def test_forecast_provider(config, mocker, time_machine):
+    import time
+
+    import numpy as np
+    import rainfall.forecast
+    import rainfall.monitor
+
+    move_to(time_machine, 12)
+
+    hourly = rainfall.forecast.parse_tenki(
+        tenki_html(
+            {
+                "forecast-point-1h-today": ["---"] * 12 + [1] * 12,
+                "forecast-point-1h-tomorrow": [0.5] * 24,
+            }
+        )
+    )
+    assert np.isnan(hourly[:12]).all()
+    assert hourly[12] == 1
+    assert hourly[47] == 0.5
+
+    def yahoo_slow(forecast_config, deadline):
+        time.sleep(1)
+        return np.full(rainfall.forecast.HOURS, 3.0)
+
+    tenki_mock = mocker.Mock(return_value=np.full(rainfall.forecast.HOURS, 1.0))
+    mocker.patch.dict(rainfall.forecast.PROVIDER_MAP["tenki"], {"fetch": tenki_mock})
+    mocker.patch.dict(rainfall.forecast.PROVIDER_MAP["yahoo"], {"fetch": yahoo_slow})
+
+    # NOTE: 1時間毎の予報が揃っていれば、遅い予報は待たない
+    start = time.perf_counter()
+    assert rainfall.monitor.check_forecast(config, 12) == pytest.approx(3)
+    assert time.perf_counter() - start < 0.5
+
+    # NOTE: 欠損している時間は、刻みの粗い予報で補う
+    rainfall.forecast.clear()
+    tenki_mock.return_value = hourly
+    assert rainfall.monitor.check_forecast(config, 10) == pytest.approx(3 + 3 + 1)
+
+    # NOTE: 期限内に揃わない予報は使わない
+    rainfall.forecast.clear()
+    tenki_mock.side_effect = RuntimeError("Broken")
+    config = {**config, "weather": {"forecast": {**config["weather"]["forecast"], "deadline_sec": 0.2}}}
+    with pytest.raises(RuntimeError):
+        rainfall.monitor.check_forecast(config, 12)
+
+
+def test_forecast_breaker(config, mocker, time_machine):
+    import numpy as np
+    import rainfall.breaker
+    import rainfall.forecast
+    import rainfall.monitor
+
+    move_to(time_machine, 12)
+
+    tenki_mock = mocker.Mock(side_effect=RuntimeError("Broken"))
+    yahoo_mock = mocker.Mock(side_effect=RuntimeError("Broken"))
+    mocker.patch.dict(rainfall.forecast.PROVIDER_MAP["tenki"], {"fetch": tenki_mock})
+    mocker.patch.dict(rainfall.forecast.PROVIDER_MAP["yahoo"], {"fetch": yahoo_mock})
+
+    for _ in range(rainfall.breaker.THRESHOLD):
+        with pytest.raises(RuntimeError):
+            rainfall.monitor.check_forecast(config, 12)
+    for name in ["tenki", "yahoo"]:
+        assert rainfall.breaker.get(rainfall.forecast.get_breaker_name(name)).state == "open"
+
+    # NOTE: 一定時間経って予報が取得できるようになったら、元に戻る
+    time_machine.shift(rainfall.breaker.COOLDOWN_SEC)
+    tenki_mock.side_effect = None
+    tenki_mock.return_value = np.full(rainfall.forecast.HOURS, 1.0)
+    yahoo_mock.side_effect = None
+    yahoo_mock.return_value = np.full(rainfall.forecast.HOURS, 3.0)
+
+    assert rainfall.monitor.check_forecast(config, 12) == pytest.approx(3)
+    assert rainfall.breaker.get(rainfall.forecast.get_breaker_name("tenki")).state == "closed"
+
+
+def test_forecast_hang(config, mocker, time_machine):
+    import threading
+
+    import numpy as np
+    import rainfall.forecast
+    import rainfall.monitor
+
+    move_to(time_machine, 12)
+
+    release = threading.Event()
+
+    def yahoo_hang(forecast_config, deadline):
+        release.wait()
+        return np.full(rainfall.forecast.HOURS, 3.0)
+
+    yahoo_mock = mocker.Mock(side_effect=yahoo_hang)
+    tenki_mock = mocker.Mock(return_value=np.full(rainfall.forecast.HOURS, 1.0))
+    mocker.patch.dict(rainfall.forecast.PROVIDER_MAP["tenki"], {"fetch": tenki_mock})
+    mocker.patch.dict(rainfall.forecast.PROVIDER_MAP["yahoo"], {"fetch": yahoo_mock})
+    config = {**config, "weather": {"forecast": {**config["weather"]["forecast"], "deadline_sec": 0.2}}}
+
+    # NOTE: 応答しない予報があっても、スレッドを使い切らずに他の予報を使い続ける
+    try:
+        for _ in range(8):
+            assert rainfall.monitor.check_forecast(config, 12) == pytest.approx(3)
+            time_machine.shift(rainfall.forecast.get_ttl(config))
+        assert yahoo_mock.call_count == 1
+        assert tenki_mock.call_count == 8
+    finally:
+        release.set()
+
+
+def test_forecast_inflight(config, mocker, time_machine):
+    import concurrent.futures
+    import threading
+    import time
+
+    import numpy as np
+    import rainfall.forecast
+
+    move_to(time_machine, 12)
+
+    release = threading.Event()
+
+    def fetch_slow(config):
+        release.wait(5)
+        return np.full(rainfall.forecast.HOURS, 1.0)
+
+    fetch_mock = mocker.patch("rainfall.forecast.fetch_hourly", side_effect=fetch_slow)
+
+    # NOTE: 同じ予報を使う地点が同時に取得しても、取得は一度だけ
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        try:
+            future_list = [executor.submit(rainfall.forecast.get_forecast, config) for _ in range(2)]
+            time.sleep(0.2)
+        finally:
+            release.set()
+        entry_list = [future.result() for future in future_list]
+
+    assert fetch_mock.call_count == 1
+    assert entry_list[0] is entry_list[1]
+    assert rainfall.forecast._inflight_map == {}
+
+
+def test_sensor_accumulator(config, mocker, time_machine):
+    import my_lib.time
+    import rainfall.sensor
+
+    move_to(time_machine, 12)
+    now = my_lib.time.now()
+
+    query_mock = mocker.patch(
+        "rainfall.sensor.query",
+        side_effect=make_query(
+            {
+                "raining": [
+                    (now - datetime.timedelta(minutes=m), 0 if m > 5 else 1) for m in range(10, -1, -1)
+                ],
+                "rain": [(now - datetime.timedelta(minutes=m), 0.1) for m in range(10, -1, -1)],
+                "solar_rad": [(now - datetime.timedelta(minutes=m), 100 * m) for m in range(10, -1, -1)],
+            }
+        ),
+    )
+
+    snapshot = rainfall.sensor.fetch_snapshot(config, 3)
+
+    assert snapshot.raining_start == now - datetime.timedelta(minutes=5)
+    assert snapshot.raining_sum == pytest.approx(0.3)
+    assert snapshot.solar_rad == 400
+
+    # NOTE: 2回目以降は、前回取得したデータより新しいものだけを問い合わせる
+    move_to(time_machine, 12, 2)
+    query_mock.side_effect = make_query({"raining": [], "rain": [], "solar_rad": []})
+
+    snapshot = rainfall.sensor.fetch_snapshot(config, 3)
+
+    assert query_mock.call_args.args[1][rainfall.sensor.get_sensor_key(config)]["rain"] == now.timestamp()
+    assert snapshot.raining_start == now - datetime.timedelta(minutes=5)
+    assert snapshot.raining_sum == pytest.approx(0.1)
+
+
+def test_sensor_reconcile(config, mocker, time_machine):
+    import my_lib.time
+    import rainfall.sensor
+
+    move_to(time_machine, 12)
+    now = my_lib.time.now()
+
+    def minute(m):
+        return now - datetime.timedelta(minutes=m)
+
+    # NOTE: 降り始めのデータのプッシュが抜けた後に、次のデータがプッシュされた場合
+    accumulator = rainfall.sensor.get_accumulator(config, 10)
+    rainfall.sensor.append(
+        accumulator,
+        {"raining": [(minute(3), 0), (minute(1), 1)], "rain": [(minute(3), 0.1), (minute(1), 0.1)]},
+    )
+
+    query_mock = mocker.patch(
+        "rainfall.sensor.query",
+        side_effect=make_query(
+            {
+                "raining": [(minute(3), 0), (minute(2), 1), (minute(1), 1)],
+                "rain": [(minute(3), 0.1), (minute(2), 0.5), (minute(1), 0.1)],
+                "solar_rad": [],
+            }
+        ),
+    )
+    snapshot = rainfall.sensor.fetch_snapshot(config, 10)
+
+    # NOTE: プッシュされたデータより前から問い合わせ、抜けていたデータを差し込む
+    since_map = query_mock.call_args.args[1][rainfall.sensor.get_sensor_key(config)]
+    assert since_map["rain"] < minute(3).timestamp()
+    assert snapshot.raining_start == minute(2)
+    assert snapshot.raining_sum == pytest.approx(0.7)
+    assert len(accumulator.buffer["rain"].view()[0]) == 3
+
+    # NOTE: 次は InfluxDB から取得した分の後から問い合わせる
+    move_to(time_machine, 12, 2)
+    rainfall.sensor.append(accumulator, {"rain": [(my_lib.time.now(), 0.1)]})
+    query_mock.side_effect = make_query({"raining": [], "rain": [], "solar_rad": []})
+    rainfall.sensor.fetch_snapshot(config, 10)
+
+    since_map = query_mock.call_args.args[1][rainfall.sensor.get_sensor_key(config)]
+    assert since_map["rain"] == minute(1).timestamp()
+
+
+def test_sensor_store(config, mocker, time_machine, tmp_path):
+    import copy
+
+    import my_lib.time
+    import numpy as np
+    import rainfall.monitor
+    import rainfall.sensor
+
+    config = copy.deepcopy(config)
+    config["store"] = {"dir": str(tmp_path)}
+
+    move_to(time_machine, 12)
+    now = my_lib.time.now()
+
+    query_mock = mocker.patch(
+        "rainfall.sensor.query",
+        side_effect=make_query(
+            {
+                "raining": [
+                    (now - datetime.timedelta(minutes=m), 0 if m > 5 else 1) for m in range(10, -1, -1)
+                ],
+                "rain": [(now - datetime.timedelta(minutes=m), 0.1) for m in range(10, -1, -1)],
+                "solar_rad": [(now - datetime.timedelta(minutes=m), 100 * m) for m in range(10, -1, -1)],
+            }
+        ),
+    )
+    snapshot = rainfall.sensor.fetch_snapshot(config, 3)
+
+    # NOTE: 再起動を模擬する。保存したファイルをそのままマップし、問い合わせずに同じ状態に戻る
+    rainfall.sensor.clear()
+    move_to(time_machine, 12, 2)
+    query_mock.side_effect = make_query({"raining": [], "rain": [], "solar_rad": []})
+
+    accumulator = rainfall.sensor.get_accumulator(config, 3)
+    assert isinstance(accumulator.buffer["rain"].data, np.memmap)
+    assert accumulator.since("rain") == now.timestamp()
+    assert query_mock.call_count == 1
+
+    restored = rainfall.sensor.fetch_snapshot(config, 3)
+
+    # NOTE: 停止していた間の分だけを問い合わせる
+    assert query_mock.call_args.args[1][rainfall.sensor.get_sensor_key(config)]["rain"] == now.timestamp()
+    assert restored.raining_start == snapshot.raining_start
+    assert restored.raining_sum == pytest.approx(0.1)
+
+    # NOTE: 再起動前から監視していたものとして扱うので、停止中に降り始めた雨も通知の対象になる
+    mocker.patch("rainfall.monitor.get_process_start", return_value=my_lib.time.now())
+    assert rainfall.monitor.get_watch_start(config).timestamp() == now.timestamp()
+
+
+def test_forecast_timeout(config, mocker, time_machine):
+    import time
+
+    import my_lib.time
+
+    def check_forecast(config, hour):
+        time.sleep(1)
+        return 1
+
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    mocker.patch("rainfall.monitor.check_forecast", side_effect=check_forecast)
+    mocker.patch("rainfall.monitor.FORECAST_TIMEOUT_SEC", 0.1)
+
+    move_to(time_machine, 12)
+
+    app.do_work(config, 1)
+
+    # NOTE: 予報の取得が間に合わなくても、通知は行う
+    check_notify_line("雨が降り始めました！")
+
+
+def test_notify_queue(config, mocker, time_machine):
+    import time
+
+    import my_lib.notify.line
+    import my_lib.time
+    import rainfall.monitor
+    import rainfall.notifier
+
+    def voice_play(wav_data):
+        time.sleep(1)
+        voice_play.done = True
+
+    voice_play.done = False
+
+    mocker.patch("my_lib.voice.play", side_effect=voice_play)
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+
+    move_to(time_machine, 12)
+
+    # NOTE: 音声の再生を待たずに監視処理は終わる
+    rainfall.monitor.watch(config)
+    assert not voice_play.done
+    assert rainfall.notifier.is_pending(config["notify"]["footprint"]["voice"]["file"])
+
+    # NOTE: 通知処理中に次の監視処理が行われても、重複して通知しない
+    rainfall.monitor.watch(config)
+    rainfall.notifier.join()
+
+    assert voice_play.done
+    assert len(my_lib.notify.line.hist_get()) == 1
+    assert rainfall.notifier.get_stat()["depth"] == 0
+
+
+def test_voice_chime(config, mocker, time_machine):
+    import copy
+    import wave
+
+    import my_lib.time
+    import numpy as np
+    import rainfall.voice
+
+    config = copy.deepcopy(config)
+    config["notify"]["voice"]["chime"] = {"file": "wav/chime.wav", "duration": 1.5}
+
+    with wave.open(config["notify"]["voice"]["chime"]["file"], "rb") as chime_file:
+        params = chime_file.getparams()
+        chime_pcm = np.frombuffer(chime_file.readframes(params.nframes), dtype=np.int16).reshape(
+            -1, params.nchannels
+        )
+    message_pcm = np.full((params.framerate * 10, params.nchannels), 1000, dtype=np.int16)
+
+    def voice_play(wav_data):
+        voice_play.wav_list.append(wav_data)
+
+    voice_play.wav_list = []
+
+    mocker.patch("my_lib.voice.play", side_effect=voice_play)
+    mocker.patch("my_lib.voice.synthesize", return_value=rainfall.voice.encode(params, message_pcm))
+    convert_mock = mocker.patch("my_lib.voice.convert_wav_data", side_effect=lambda wav_data: wav_data)
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+
+    move_to(time_machine, 12)
+
+    app.do_work(config, 1)
+
+    # NOTE: チャイムとメッセージは 1 つの音声データに合成して再生する
+    assert len(voice_play.wav_list) == 1
+
+    mixed_pcm = rainfall.voice.decode(voice_play.wav_list[0])[1]
+    offset = int(1.5 * params.framerate)
+
+    assert len(mixed_pcm) == offset + len(message_pcm)
+    assert (mixed_pcm[:offset] == chime_pcm[:offset]).all()
+    assert (
+        mixed_pcm[offset : offset + 100]
+        == np.clip(chime_pcm[offset : offset + 100].astype(np.int32) + 1000, -32768, 32767)
+    ).all()
+
+    # NOTE: チャイムのデコードは最初の 1 回だけ
+    rainfall.voice.add_chime(config, rainfall.voice.encode(params, message_pcm))
+    assert convert_mock.call_count == 1
+
+
+def test_voice_presynthesize(config, mocker, time_machine, tmp_path):
+    import copy
+
+    import my_lib.time
+    import rainfall.sensor
+    import rainfall.voice
+
+    def voice_play(wav_data):
+        voice_play.done = True
+
+    voice_play.done = False
+
+    mocker.patch("my_lib.voice.play", side_effect=voice_play)
+    synthesize_mock = mocker.patch("my_lib.voice.synthesize", side_effect=lambda config, message: message)
+
+    move_to(time_machine, 12)
+
+    # NOTE: 雨は降っていないが、予報で雨が見込まれている
+    sensor_mock(
+        mocker,
+        last_event=my_lib.time.now() - datetime.timedelta(days=1),
+        raining_sum=0,
+        precip_sum=1,
+        solar_rad=0,
+    )
+    app.do_work(config, 1)
+    rainfall.voice.join()
+
+    assert not voice_play.done
+    synthesize_count = synthesize_mock.call_count
+    assert synthesize_count != 0
+
+    # NOTE: 雨が降り始めたら、予め合成した音声を使う
+    rainfall.sensor.clear()
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=0.1, precip_sum=1, solar_rad=0)
+    app.do_work(config, 1)
+
+    assert voice_play.done
+    assert synthesize_mock.call_count == synthesize_count
+
+    # NOTE: 音声合成サーバーなどの設定が変わったら、同じメッセージでも合成し直す
+    config = copy.deepcopy(config)
+    config["notify"]["voice"]["cache"] = {"dir": str(tmp_path)}
+    synthesize_mock.side_effect = lambda config, message: message.encode()
+    rainfall.voice.synthesize(config, "テスト")
+    rainfall.voice.clear()
+    rainfall.voice.synthesize(config, "テスト")
+    assert synthesize_mock.call_count == synthesize_count + 1
+
+    config["voice"]["server"]["url"] = "http://other-voice-server:50021"
+    rainfall.voice.synthesize(config, "テスト")
+    assert synthesize_mock.call_count == synthesize_count + 2
+    assert len(list(tmp_path.glob("*.wav"))) == 2
+
+
+def test_voice_sink(config, mocker):
+    import copy
+    import time
+    import types
+
+    import numpy as np
+    import rainfall.breaker
+    import rainfall.metrics
+    import rainfall.monitor
+    import rainfall.sensor
+    import rainfall.speaker
+    import rainfall.voice
+
+    config = copy.deepcopy(config)
+    config["notify"]["voice"]["sink"] = [
+        {"name": "living", "type": "default"},
+        {"name": "kitchen", "type": "alsa", "device": "plughw:2,0"},
+        {"name": "garage", "type": "http", "url": "http://garage-speaker/play"},
+    ]
+
+    params = types.SimpleNamespace(nchannels=1, sampwidth=2, framerate=16000)
+    wav_data = rainfall.voice.encode(params, np.zeros((8000, 1), dtype=np.int16))
+
+    def write_pcm(clip):
+        write_pcm.time_list.append(time.time())
+
+    write_pcm.time_list = []
+
+    # NOTE: 台所のスピーカーは故障していて、車庫のスピーカーは応答しない
+    proc = mocker.Mock(returncode=1)
+    proc.communicate.return_value = (b"", b"No such device")
+    popen_mock = mocker.patch("subprocess.Popen", return_value=proc)
+    mocker.patch("requests.post", side_effect=lambda *args, **kwargs: time.sleep(3))
+    write_mock = mocker.patch("rainfall.speaker.write_pcm", side_effect=write_pcm)
+    mocker.patch("my_lib.voice.synthesize", return_value=wav_data)
+    mocker.patch("rainfall.speaker.MARGIN_SEC", 0.5)
+    decode_spy = mocker.spy(rainfall.voice, "decode")
+
+    start = time.time()
+    result_map = {result.name: result for result in rainfall.speaker.play(config, [wav_data])}
+
+    # NOTE: 遅いスピーカーがあっても、共通の開始時刻に再生を始め、全体も待たされない
+    assert time.time() - start < 3
+    assert result_map["living"].success
+    assert write_pcm.time_list[0] - start >= rainfall.speaker.PREPARE_SEC - 0.01
+    assert result_map["living"].latency < 0.1
+    assert not result_map["kitchen"].success
+    assert not result_map["garage"].success
+    assert popen_mock.call_args.args[0][3] == "plughw:2,0"
+
+    # NOTE: デコードは 1 回だけで、各スピーカーにはデコード済みの PCM とフォーマットを渡す
+    assert decode_spy.call_count == 1
+    clip = write_mock.call_args.args[0]
+    assert clip.params.framerate == 16000
+    assert clip.pcm.shape == (8000, 1)
+    assert popen_mock.call_args.args[0][4:-1] == ["-t", "raw", "-f", "S16_LE", "-c", "1", "-r", "16000"]
+    assert proc.communicate.call_args.args[0] == clip.pcm.tobytes()
+
+    stat = rainfall.breaker.get_stat()
+    assert stat["speaker.kitchen"]["failure_total"] == 1
+    assert stat["speaker.garage"]["failure_total"] == 1
+    assert 'rainfall_stage_seconds_count{stage="play.living"} 1' in rainfall.metrics.format_text()
+
+    # NOTE: 1 つでも再生できたら、通知済みとする
+    snapshot = rainfall.sensor.Snapshot(raining_start=None, raining_sum=1, solar_rad=0, raining=True)
+    assert rainfall.monitor.notify_voice_impl(config, snapshot, 1)
+
+    config["notify"]["voice"]["sink"] = config["notify"]["voice"]["sink"][1:]
+    assert not rainfall.monitor.notify_voice_impl(config, snapshot, 1)
+
+
+def test_notification_state(config, mocker, time_machine):
+    import my_lib.footprint
+    import my_lib.time
+    import rainfall.monitor
+
+    move_to(time_machine, 12)
+    my_lib.footprint.update(config["notify"]["footprint"]["line"]["file"])
+
+    elapsed_spy = mocker.spy(my_lib.footprint, "elapsed")
+    process_start_mock = mocker.patch("rainfall.monitor.get_process_start", return_value=my_lib.time.now())
+
+    state = rainfall.monitor.load_state(config)
+    load_count = elapsed_spy.call_count
+
+    move_to(time_machine, 12, 10)
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    for _ in range(3):
+        rainfall.monitor.watch(config, dummy_mode=True)
+        assert not rainfall.monitor.should_notify_line(config, rainfall.sensor.fetch_snapshot(config, 3))
+
+    # NOTE: 状態は起動時に一度だけ読み込み、判定ではフットプリントを読まない
+    assert elapsed_spy.call_count == load_count
+    assert process_start_mock.call_count == 1
+
+    # NOTE: 30分以内の連続した雨として扱われ、フットプリントに書き出される
+    assert state.elapsed("line") < 1
+    assert my_lib.footprint.elapsed(config["notify"]["footprint"]["line"]["file"]) < 1
+    assert state.snapshot()["last"]["line"] == pytest.approx(my_lib.time.now().timestamp(), abs=1)
+
+
+def test_adaptive_interval(config, mocker, time_machine):
+    import copy
+
+    import my_lib.time
+    import rainfall.monitor
+    import rainfall.scheduler
+
+    move_to(time_machine, 12)
+
+    # NOTE: 晴れている間は、監視間隔を伸ばしていく
+    mocker.patch(
+        "rainfall.sensor.query",
+        side_effect=make_query(
+            {
+                "raining": [
+                    (my_lib.time.now() - datetime.timedelta(minutes=m), 0) for m in range(10, -1, -1)
+                ],
+                "rain": [(my_lib.time.now() - datetime.timedelta(minutes=m), 0) for m in range(10, -1, -1)],
+                "solar_rad": [],
+            }
+        ),
+    )
+    mocker.patch("rainfall.monitor.check_forecast", return_value=0)
+    result = rainfall.monitor.watch(config, dummy_mode=True)
+
+    interval = None
+    interval_list = []
+    for _ in range(8):
+        interval = rainfall.scheduler.next_interval(config, [result], interval)
+        interval_list.append(interval)
+
+    assert interval_list == sorted(interval_list)
+    assert interval_list[0] > config["watch"]["adaptive"]["min_sec"]
+    assert interval_list[-1] == config["watch"]["adaptive"]["max_sec"]
+
+    # NOTE: 雨の予報が出ると、監視間隔を詰める
+    result["precip_sum"] = 1
+    assert (
+        rainfall.scheduler.next_interval(config, [result], interval) == config["watch"]["adaptive"]["min_sec"]
+    )
+
+    # NOTE: 設定が無い場合は、固定間隔
+    config = copy.deepcopy(config)
+    del config["watch"]["adaptive"]
+    assert rainfall.scheduler.next_interval(config, [result], interval) == config["watch"]["interval_sec"]
+    assert rainfall.scheduler.get_liveness_interval(config) == config["watch"]["interval_sec"]
+
+
+def test_radar(config, mocker, time_machine, tmp_path):
+    import copy
+    import datetime
+    import urllib.request
+
+    import my_lib.time
+    import rainfall.monitor
+    import rainfall.notifier
+    import rainfall.radar
+    import rainfall.sensor
+
+    config = copy.deepcopy(config)
+    config["rain_cloud"]["img"]["cache"] = {"dir": str(tmp_path), "size": 2, "port": 0}
+
+    move_to(time_machine, 12)
+
+    # NOTE: 画像は 7分遅れで公開されるものとする
+    def is_available(url):
+        return any(
+            url
+            == rainfall.radar.get_slot_url(
+                config, rainfall.radar.get_slot(my_lib.time.now().timestamp() - sec)
+            )
+            for sec in range(7 * 60, 60 * 60, rainfall.radar.SLOT_SEC)
+        )
+
+    def head(url, **kwargs):
+        return mock.Mock(status_code=200 if is_available(url) else 404)
+
+    def get(url, **kwargs):
+        return mock.Mock(status_code=200, content=url.encode())
+
+    mocker.patch.object(rainfall.radar._session, "head", side_effect=head)
+    get_mock = mocker.patch.object(rainfall.radar._session, "get", side_effect=get)
+
+    # NOTE: 雨が降りそうでなければ、先読みしない (LINE で通知しないよう、降り始めは過去にする)
+    snapshot = rainfall.sensor.Snapshot(
+        raining_start=my_lib.time.now() - datetime.timedelta(days=1),
+        raining_sum=0,
+        solar_rad=0,
+        raining=False,
+    )
+    rainfall.monitor.handle(config, snapshot, 0, 12)
+    rainfall.radar.join()
+    rainfall.notifier.join()
+    get_mock.assert_not_called()
+
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=0, precip_sum=1, solar_rad=0)
+    for _ in range(3):
+        rainfall.monitor.watch(config)
+        rainfall.radar.join()
+        rainfall.notifier.join()
+        time_machine.shift(datetime.timedelta(seconds=rainfall.radar.SLOT_SEC))
+
+    # NOTE: 公開済みの最新の画像のみを取得し、キャッシュは指定した枚数に収める
+    assert get_mock.call_count == 3
+    assert len(list(tmp_path.iterdir())) == 2
+    time_machine.shift(datetime.timedelta(seconds=-rainfall.radar.SLOT_SEC))
+    url = rainfall.radar.get_image_url(config)
+    assert is_available(url)
+    assert get_mock.call_count == 3
+
+    # NOTE: 配信先の URL を指定すると、キャッシュした画像を手元から配信する
+    config["rain_cloud"]["img"]["cache"]["url"] = "http://localhost/radar/"
+    frame = rainfall.radar.get_latest(config)
+    assert rainfall.radar.get_image_url(config) == "http://localhost/radar/" + frame.path.name
+
+    rainfall.radar.start(config)
+    try:
+        port = rainfall.radar._server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/{frame.path.name}") as res:  # noqa: S310
+            assert res.read() == url.encode()
+    finally:
+        rainfall.radar.stop()
+
+    # NOTE: 画像が古くなり、取得もできない場合は、従来どおり時刻から URL を求める
+    time_machine.shift(datetime.timedelta(hours=2))
+    mocker.patch.object(rainfall.radar._session, "head", side_effect=RuntimeError("Failed"))
+    assert rainfall.radar.get_image_url(config) == rainfall.radar.get_fallback_url(config)
+
+
+def test_nowcast(config, mocker, time_machine, tmp_path):
+    import copy
+    import datetime
+    import time
+
+    import my_lib.time
+    import numpy as np
+    import rainfall.monitor
+    import rainfall.notifier
+    import rainfall.nowcast
+    import rainfall.radar
+    import rainfall.sensor
+
+    scale = rainfall.nowcast.SCALE
+
+    # NOTE: 配色に近い色のみを雨雲とみなす
+    rgb = np.full((4 * scale, 4 * scale, 3), 128, dtype=np.uint8)
+    rgb[: 2 * scale] = [33, 140, 255]
+    assert rainfall.nowcast.to_intensity(rgb).tolist() == [[7.5] * 4] * 2 + [[0.0] * 4] * 2
+
+    # NOTE: 5分で間引いた画像の 3 画素分、東に進む雨雲
+    def make_map(col):
+        intensity = np.zeros((150, 200), dtype=np.float32)
+        intensity[60:70, col : col + 10] = 7.5
+        return intensity
+
+    motion, echo = rainfall.nowcast.estimate_motion(make_map(40), make_map(43))
+    assert np.median(motion[echo], axis=0).tolist() == [0, 3]
+
+    # NOTE: Raspberry Pi でも監視周期に収まるよう、画像 1 組の処理は十分短くする
+    rgb = rainfall.nowcast.PALETTE[np.random.default_rng(0).integers(0, 8, (600, 800))].astype(np.uint8)
+    start = time.perf_counter()
+    rainfall.nowcast.estimate_motion(rainfall.nowcast.to_intensity(rgb), rainfall.nowcast.to_intensity(rgb))
+    assert time.perf_counter() - start < 1
+
+    config = copy.deepcopy(config)
+    config["rain_cloud"]["img"]["cache"] = {"dir": str(tmp_path)}
+    config["rain_cloud"]["nowcast"] = {"x": 70 * scale, "y": 65 * scale}
+
+    move_to(time_machine, 12)
+
+    map_by_name = {}
+    for i, col in enumerate([40, 43]):
+        slot = rainfall.radar.get_slot(time.time()) - datetime.timedelta(minutes=10 - 5 * i)
+        rainfall.radar.store(config, slot, f"https://example.com/{i}.jpg", b"")
+        map_by_name[rainfall.radar.get_frame_path(config, slot).name] = make_map(col)
+    mocker.patch("rainfall.nowcast.decode", side_effect=lambda path: map_by_name[path.name])
+
+    nowcast = rainfall.nowcast.estimate(config)
+    assert 15 <= nowcast["arrival_min"] <= 25
+
+    # NOTE: 雨が降り始める前に、雨雲の接近を LINE で知らせる
+    snapshot = rainfall.sensor.Snapshot(
+        raining_start=my_lib.time.now() - datetime.timedelta(days=1),
+        raining_sum=0,
+        solar_rad=0,
+        raining=False,
+    )
+    rainfall.monitor.handle(config, snapshot, 1, 12, nowcast=nowcast)
+    rainfall.notifier.join()
+    check_notify_line(f"約{nowcast['arrival_min']}分後に雨が降り始めそうです。")
+
+    # NOTE: 続けては知らせない
+    rainfall.monitor.handle(config, snapshot, 1, 12, nowcast=nowcast)
+    rainfall.notifier.join()
+    assert len(my_lib.notify.line.hist_get()) == 1
+
+    # NOTE: 雨が降りそうでなくても、雨雲の予測に使う画像は枠毎に 1 回だけ先読みする
+    rainfall.radar.join()
+    prefetch_mock = mocker.patch("rainfall.radar.prefetch_safe")
+    for _ in range(2):
+        rainfall.monitor.handle(config, snapshot, 0, 12)
+        rainfall.radar.join()
+    assert prefetch_mock.call_count == 1
+
+    time_machine.shift(datetime.timedelta(seconds=rainfall.radar.SLOT_SEC))
+    rainfall.monitor.handle(config, snapshot, 0, 12)
+    rainfall.radar.join()
+    assert prefetch_mock.call_count == 2
+
+
+def test_nowcast_image(config, time_machine, tmp_path):
+    import copy
+    import datetime
+    import io
+    import time
+
+    import numpy as np
+    import rainfall.nowcast
+    import rainfall.radar
+
+    image = pytest.importorskip("PIL.Image")
+    scale = rainfall.nowcast.SCALE
+
+    config = copy.deepcopy(config)
+    config["rain_cloud"]["img"]["cache"] = {"dir": str(tmp_path)}
+    config["rain_cloud"]["nowcast"] = {"x": 70 * scale, "y": 65 * scale}
+
+    move_to(time_machine, 12)
+
+    # NOTE: 5分で間引いた画像の 3 画素分、東に進む雨雲を、実際の画像として保存する
+    def make_image(col):
+        rgb = np.full((150 * scale, 200 * scale, 3), 128, dtype=np.uint8)
+        rgb[60 * scale : 70 * scale, col * scale : (col + 10) * scale] = [33, 140, 255]
+        with io.BytesIO() as file:
+            image.fromarray(rgb).save(file, format="PNG")
+            return file.getvalue()
+
+    for i, col in enumerate([40, 43]):
+        slot = rainfall.radar.get_slot(time.time()) - datetime.timedelta(minutes=10 - 5 * i)
+        rainfall.radar.store(config, slot, f"https://example.com/{i}.jpg", make_image(col))
+
+    intensity = rainfall.nowcast.decode(rainfall.radar.get_frame_path(config, slot))
+    assert intensity.shape == (150, 200)
+    assert intensity[65, 45] == 7.5
+    assert intensity[0, 0] == 0
+
+    nowcast = rainfall.nowcast.estimate(config)
+    assert 15 <= nowcast["arrival_min"] <= 25
+
+
+def test_shadow(config, mocker, time_machine):
+    import copy
+    import time
+
+    import my_lib.time
+    import rainfall.monitor
+    import rainfall.notifier
+    import rainfall.sensor
+    import rainfall.shadow
+
+    config = copy.deepcopy(config)
+    config["shadow"] = [
+        {"name": "solar-800", "solar_rad_threshold": 800},
+        {"name": "current"},
+        {"name": "solar-800-voice-20", "solar_rad_threshold": 800, "voice_threshold": 20, "sum_min": 10},
+    ]
+
+    move_to(time_machine, 12)
+
+    # NOTE: 日射量が多いので、今の条件では誤検知として通知しない
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=700)
+    query_mock = rainfall.sensor.query
+
+    rainfall.monitor.watch(config)
+    rainfall.notifier.join()
+
+    check_notify_line(None)
+    assert query_mock.call_count == 1
+
+    stat = rainfall.shadow.get_stat(config)
+    assert stat["solar-800"]["count"]["line"] == 1
+    assert stat["solar-800"]["count"]["voice"] == 1
+    assert stat["current"]["count"]["line"] == 0
+    assert stat["current"]["count"]["suppressed_solar"] == 2
+    assert stat["solar-800-voice-20"]["count"]["line"] == 1
+    assert stat["solar-800-voice-20"]["count"]["voice"] == 0
+    assert stat["solar-800"]["log"][0]["raining_sum"] == 10
+
+    # NOTE: 条件毎に通知の状態を持つので、同じ雨で何度も通知したことにはならない
+    rainfall.monitor.watch(config)
+    assert rainfall.shadow.get_stat(config)["solar-800"]["count"]["line"] == 1
+
+    # NOTE: 条件の組が増えても、1 周期あたりの追加の処理はごく短い
+    snapshot = rainfall.sensor.fetch_snapshot(config, rainfall.monitor.SUM_MIN)
+    accumulator = rainfall.sensor.get_accumulator(config, rainfall.monitor.SUM_MIN)
+    start = time.perf_counter()
+    for _ in range(100):
+        rainfall.shadow.evaluate(
+            config,
+            snapshot,
+            1,
+            True,
+            accumulator,
+            rainfall.monitor.get_default_param(),
+            snapshot.raining_start,
+        )
+    assert (time.perf_counter() - start) / 100 / len(config["shadow"]) < 0.001
+
+
+def test_multi_site(config, mocker, time_machine):
+    import copy
+
+    import my_lib.footprint
+    import my_lib.notify.line
+    import my_lib.time
+    import rainfall.monitor
+    import rainfall.notifier
+    import rainfall.sensor
+    import rainfall.site
+
+    move_to(time_machine, 12)
+
+    config = copy.deepcopy(config)
+    config["site"] = [
+        {"name": "home"},
+        {"name": "office", "sensor": {"rain_fall": {"hostname": "rasp-weather-2"}}},
+    ]
+    config_list = rainfall.site.get_config_list(config)
+
+    assert [site_config["sensor"]["rain_fall"]["hostname"] for site_config in config_list] == [
+        "rasp-weather-1",
+        "rasp-weather-2",
+    ]
+    assert config_list[1]["sensor"]["rain_fall"]["measure"] == config["sensor"]["rain_fall"]["measure"]
+    assert config_list[0]["notify"]["footprint"]["line"]["file"].endswith(".home")
+    assert rainfall.site.get_config_list(config) is config_list
+
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    query_mock = rainfall.sensor.query
+
+    result_list = rainfall.monitor.watch_all(config)
+    rainfall.notifier.join()
+
+    # NOTE: 同じバケットの地点は、1 回のクエリでまとめて取得する
+    assert query_mock.call_count == 1
+    assert len(query_mock.call_args.args[1]) == 2
+    assert len(result_list) == 2
+
+    # NOTE: 通知の状態は地点毎に管理する
+    for site_config in config_list:
+        for mode in ["line", "voice"]:
+            path = site_config["notify"]["footprint"][mode]["file"]
+            assert my_lib.footprint.elapsed(path) < 1
+            my_lib.footprint.clear(path)
+
+    assert len(my_lib.notify.line.hist_get()) == 2
+    assert rainfall.monitor.get_title(config_list[1]) == "天気速報 (office)"
+
+
+def test_ingest(config, mocker):
+    import asyncio
+    import copy
+    import socket
+    import threading
+    import time
+
+    import my_lib.notify.line
+    import my_lib.time
+    import rainfall.ingest
+    import rainfall.monitor
+    import rainfall.scheduler
+    import rainfall.sensor
+    import requests
+
+    point = rainfall.ingest.parse_line(
+        "sensor.rasp,hostname=rasp-weather-1,place=my\\ room "
+        'raining=1i,rain=0.5,memo="a b" 1700000000000000000'
+    )
+    assert point["measurement"] == "sensor.rasp"
+    assert point["tag"] == {"hostname": "rasp-weather-1", "place": "my room"}
+    assert point["field"] == {"raining": 1.0, "rain": 0.5}
+    assert point["time"].timestamp() == 1700000000
+
+    config = copy.deepcopy(config)
+    config["ingest"] = {"http": {"port": 0}, "udp": {"port": 0}, "reconcile_sec": 600}
+    measure = config["sensor"]["rain_fall"]["measure"]
+    hostname = config["sensor"]["rain_fall"]["hostname"]
+
+    # NOTE: 最初の 1 回だけ InfluxDB に問い合わせ、その後はプッシュされたデータで判定する
+    query_mock = mocker.patch(
+        "rainfall.sensor.query",
+        side_effect=make_query(
+            {
+                "raining": [(my_lib.time.now() - datetime.timedelta(minutes=m), 0) for m in range(10, 0, -1)],
+                "rain": [],
+                "solar_rad": [(my_lib.time.now() - datetime.timedelta(minutes=1), 0)],
+            }
+        ),
+    )
+    mocker.patch("rainfall.monitor.check_forecast", return_value=0)
+    mocker.patch(
+        "rainfall.monitor.get_process_start",
+        return_value=my_lib.time.now() - datetime.timedelta(hours=1),
+    )
+
+    def push():
+        host, port = rainfall.ingest.get_address("udp")
+        # NOTE: 認証しないので、既定では他のホストから受信しない
+        assert host == "127.0.0.1"
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(f"{measure},hostname={hostname} solar_rad=10".encode(), (host, port))
+
+        host, port = rainfall.ingest.get_address("http")
+        res = requests.post(
+            f"http://{host}:{port}/api/v2/write?precision=s",
+            data=f"{measure},hostname={hostname} raining=1i,rain=0.2 {int(time.time())}\n"
+            "other,hostname=foo raining=1i",
+            timeout=5,
+        )
+        assert res.status_code == 204
+
+    timer = threading.Timer(1, push)
+    timer.start()
+
+    start = time.perf_counter()
+    app.do_work(config, 2)
+    timer.join()
+
+    assert time.perf_counter() - start < 10
+    assert query_mock.call_count == 1
+    assert len(my_lib.notify.line.hist_get()) == 1
+    assert not rainfall.ingest.is_enabled()
+
+    snapshot = rainfall.sensor.fetch_snapshot_list([config], rainfall.monitor.SUM_MIN, fetch=False)[0]
+    assert snapshot.raining
+    assert snapshot.raining_sum == pytest.approx(0.2)
+    assert rainfall.scheduler.get_liveness_interval(config) == 600
+
+    # NOTE: 受信していない場合は、タイムアウトまで待つ
+    assert not asyncio.run(rainfall.ingest.wait(0.1))
+
+    # NOTE: プッシュが続いていても、reconcile_sec 毎に InfluxDB に問い合わせる
+    config["ingest"]["reconcile_sec"] = 2
+    query_mock.reset_mock()
+    stop_event = threading.Event()
+
+    def push_loop():
+        while not stop_event.wait(0.3):
+            address = rainfall.ingest.get_address("udp")
+            if address is None:
+                continue
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(f"{measure},hostname={hostname} rain=0.0".encode(), address)
+
+    thread = threading.Thread(target=push_loop)
+    thread.start()
+
+    start = time.perf_counter()
+    app.do_work(config, 15)
+    elapsed = time.perf_counter() - start
+    stop_event.set()
+    thread.join()
+
+    assert elapsed < 10
+    assert query_mock.call_count >= int(elapsed / 2)
+
+
+def test_breaker(config, mocker, time_machine):
+    import copy
+    import time
+
+    import my_lib.time
+    import rainfall.breaker
+    import rainfall.metrics
+    import rainfall.monitor
+    import rainfall.notifier
+    import rainfall.sensor
+
+    move_to(time_machine, 12)
+
+    breaker = rainfall.breaker.get("test")
+    for _ in range(rainfall.breaker.THRESHOLD):
+        with pytest.raises(RuntimeError), rainfall.breaker.guard("test"):
+            raise RuntimeError("Failed")
+    assert breaker.state == "open"
+    with pytest.raises(rainfall.breaker.OpenError), rainfall.breaker.guard("test"):
+        pass
+
+    # NOTE: 一定時間経つと試しに 1 回呼び出し、成功したら元に戻る
+    time_machine.shift(rainfall.breaker.COOLDOWN_SEC)
+    with rainfall.breaker.guard("test"):
+        pass
+    assert breaker.state == "closed"
+
+    # NOTE: センサーも天気予報も応答しなくても、期限内に周期を終えて LINE で通知する
+    config = copy.deepcopy(config)
+    config["watch"]["budget"] = {"sensor": 0.2, "forecast": 0.2}
+
+    query = rainfall.sensor.query
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    rainfall.sensor.fetch_snapshot(config, rainfall.monitor.SUM_MIN)
+
+    def hang(*args):
+        time.sleep(1)
+
+    def hang_fail(*args, **kwargs):
+        time.sleep(1)
+        raise RuntimeError("Failed")
+
+    mocker.patch("rainfall.sensor.query", new=query)
+    client_mock = mocker.patch("rainfall.sensor.get_client")
+    client_mock.return_value.query_api.return_value.query.side_effect = hang_fail
+    mocker.patch("rainfall.monitor.check_forecast", side_effect=hang)
+    line_mock = mocker.patch("my_lib.notify.line.send")
+
+    start = time.perf_counter()
+    result_list = rainfall.monitor.watch_all(config)
+    assert time.perf_counter() - start < rainfall.monitor.get_cycle_deadline(config)
+
+    assert result_list[0]["precip_sum"] is None
+    rainfall.notifier.join()
+
+    text = line_mock.call_args.args[1]["template"]["text"]
+    assert "予報は取得できませんでした" in text
+
+    # NOTE: 打ち切った問い合わせが後から失敗しても、二重には数えない
+    time.sleep(1)
+    name = rainfall.sensor.get_breaker_name(config["influxdb"])
+    assert rainfall.breaker.get_stat()[name]["failure_total"] == 1
+    assert f'rainfall_breaker_failures_total{{backend="{name}"}} 1' in rainfall.metrics.format_text()
+
+    # NOTE: 地点毎にチャンネルが異なる場合、1 つのチャンネルの障害で他の地点の通知は止めない
+    other_config = copy.deepcopy(config)
+    other_config["notify"]["line"]["channel"]["access_token"] = "other"
+    for _ in range(rainfall.breaker.THRESHOLD):
+        rainfall.breaker.get(rainfall.monitor.get_line_breaker_name(config)).record_failure()
+
+    with pytest.raises(rainfall.breaker.OpenError):
+        rainfall.monitor.send_line(config, {})
+    line_mock.reset_mock()
+    rainfall.monitor.send_line(other_config, {})
+    line_mock.assert_called_once()
+
+
+def test_metrics(config, mocker, time_machine):
+    import copy
+    import pathlib
+
+    import healthz
+    import my_lib.time
+    import rainfall.metrics
+
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    # NOTE: 事前の音声合成がバックグラウンドで計測されると回数が定まらないので、止めておく
+    mocker.patch("rainfall.voice.presynthesize")
+
+    move_to(time_machine, 12)
+
+    app.do_work(config, 1)
+
+    metrics_text = pathlib.Path(config["metrics"]["file"]).read_text()
+    for stage in ["cycle", "sensor", "forecast", "notify_line", "synthesize", "play"]:
+        assert f'rainfall_stage_seconds_count{{stage="{stage}"}} 1' in metrics_text
+    assert "rainfall_notify_queue_depth 0" in metrics_text
+
+    assert healthz.check_cycle_time(config)
+
+    # NOTE: 処理時間の p95 が閾値を超えたら異常とみなす
+    config = copy.deepcopy(config)
+    config["metrics"]["cycle_p95_sec"] = 0
+    rainfall.metrics.observe("cycle", 1)
+    rainfall.metrics.export(config)
+
+    assert not healthz.check_cycle_time(config)
+
+
+def test_healthz_snapshot(config, mocker, tmp_path):
+    import os
+    import shutil
+
+    import healthz
+    import my_lib.config
+
+    mocker.patch("healthz.SNAPSHOT_DIR", tmp_path)
+    config_file = tmp_path / "config.yaml"
+    shutil.copy(CONFIG_FILE, config_file)
+
+    snapshot = healthz.get_snapshot(config_file)
+    assert healthz.get_target_list(snapshot)[0]["liveness_file"] == pathlib.Path(
+        config["liveness"]["file"]["watch"]
+    )
+
+    # NOTE: 設定ファイルが変わらない間は、設定を読み込み直さない
+    load_mock = mocker.patch("my_lib.config.load", side_effect=my_lib.config.load)
+    assert healthz.get_snapshot(config_file) == snapshot
+    load_mock.assert_not_called()
+
+    stat = config_file.stat()
+    os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    healthz.get_snapshot(config_file)
+    load_mock.assert_called_once()
+
+
+def test_line_only(config, mocker, time_machine):
+    import copy
+    import os
+    import subprocess
+    import sys
+
+    import my_lib.time
+    import rainfall.monitor
+    import rainfall.notifier
+
+    # NOTE: 音声通知を使わない場合は、音声関係のライブラリを読み込まない
+    code = (
+        "import sys, app; "
+        "assert 'my_lib.voice' not in sys.modules; "
+        "assert 'rainfall.voice' not in sys.modules"
+    )
+    subprocess.run(  # noqa: S603
+        [sys.executable, "-c", code],
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        check=True,
+    )
+
+    config = copy.deepcopy(config)
+    del config["notify"]["voice"]
+
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    presynthesize_mock = mocker.patch("rainfall.voice.presynthesize")
+
+    move_to(time_machine, 12)
+
+    app.do_work(config, 1)
+    rainfall.notifier.join()
+
+    check_notify_line("雨が降り始めました。")
+    assert not rainfall.monitor.should_notify_voice(config, None, 1, 12)
+    presynthesize_mock.assert_not_called()
+
+
+def test_config_reload(config, mocker, tmp_path):
+    import copy
+    import os
+    import shutil
+    import signal
+    import threading
+    import time
+
+    import rainfall.breaker
+    import rainfall.forecast
+    import rainfall.radar
+    import rainfall.reload
+    import yaml
+
+    def wait_reload(config):
+        for _ in range(50):
+            reloaded = rainfall.reload.apply(config)
+            if reloaded is not config:
+                return reloaded
+            time.sleep(0.1)
+        return config
+
+    mocker.patch("rainfall.reload.POLL_SEC", 0.1)
+    config_file = tmp_path / "config.yaml"
+    shutil.copy(CONFIG_FILE, config_file)
+
+    forecast_clear_mock = mocker.spy(rainfall.forecast, "clear")
+    radar_start_mock = mocker.spy(rainfall.radar, "start")
+    breaker = rainfall.breaker.get("test")
+
+    rainfall.reload.start(config_file, SCHEMA_CONFIG)
+
+    time.sleep(0.3)
+    assert rainfall.reload.apply(config) is config
+
+    # NOTE: 変更された項目に関係するものだけを作り直す
+    new_config = copy.deepcopy(config)
+    new_config["watch"]["breaker"] = {"threshold": 1, "cooldown_sec": 60}
+    new_config["weather"]["forecast"]["ttl_sec"] = 60
+    config_file.write_text(yaml.safe_dump(new_config))
+
+    reloaded = wait_reload(config)
+    assert reloaded == new_config
+    forecast_clear_mock.assert_called_once()
+    radar_start_mock.assert_not_called()
+    # NOTE: 読み込み直す前に作ったサーキットブレーカーにも反映する
+    assert breaker.threshold == 1
+    assert rainfall.breaker.get("new").threshold == 1
+
+    # NOTE: 読み込めない設定は使わず、今の設定のまま続ける
+    config_file.write_text("watch: [")
+    time.sleep(0.5)
+    assert rainfall.reload.apply(reloaded) is reloaded
+
+    # NOTE: ファイルが変わっていなくても、SIGHUP で読み込み直す
+    mocker.patch("my_lib.config.load", return_value=config)
+    os.kill(os.getpid(), signal.SIGHUP)
+    assert wait_reload(reloaded) is config
+
+    # NOTE: 通知する時間帯を変えても、合成済みの音声は消さない
+    new_config = copy.deepcopy(config)
+    new_config["notify"]["voice"]["hour"]["start"] = 9
+    assert rainfall.reload.get_reset_list(config, new_config) == []
+    new_config["voice"]["server"]["url"] = "http://other-voice-server:50021"
+    assert rainfall.reload.get_reset_list(config, new_config) == [rainfall.reload.reset_voice]
+
+    # NOTE: 地点毎の設定でセンサーが変わった場合は、受信するデータの対応を作り直す
+    site_config = {**config, "site": [{"name": "home"}, {"name": "office"}]}
+    new_config = copy.deepcopy(site_config)
+    new_config["site"][1]["sensor"] = {"rain_fall": {"hostname": "other", "measure": "sensor.rasp"}}
+    assert rainfall.reload.reset_ingest in rainfall.reload.get_reset_list(site_config, new_config)
+
+    # NOTE: 雨雲レーダーの設定を変えても、先読みの終わりは待たない
+    release = threading.Event()
+    with rainfall.radar._lock:
+        rainfall.radar._future_map["test"] = rainfall.radar._executor.submit(release.wait)
+    start = time.perf_counter()
+    rainfall.reload.reset_radar(config)
+    assert time.perf_counter() - start < 0.5
+    release.set()
+
+
+def test_profile(config, mocker, time_machine, tmp_path):
+    import copy
+    import tracemalloc
+
+    import my_lib.time
+    import rainfall.notifier
+    import rainfall.profiler
+
+    config = copy.deepcopy(config)
+    config["profile"] = {"dir": str(tmp_path), "every": 2, "keep": 1}
+    config["watch"]["adaptive"] = {"min_sec": 1, "max_sec": 1}
+
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    mocker.patch("rainfall.voice.presynthesize")
+
+    move_to(time_machine, 12)
+
+    rainfall.profiler.init(config)
+    app.do_work(config, 3)
+    rainfall.notifier.join()
+
+    # NOTE: 0, 2 周期目をプロファイルし、新しいレポートだけを残す
+    path_list = sorted(tmp_path.iterdir())
+    assert [path.name.split(".", 1)[1] for path in path_list] == ["cycle.00000002.prof", "cycle.00000002.txt"]
+    # NOTE: プロファイルする周期の間だけ、メモリの確保を記録する
+    assert not tracemalloc.is_tracing()
+
+    report = path_list[1].read_text()
+    assert "rss:" in report
+    assert "== CPU (top 20 by cumulative time) ==" in report
+    # NOTE: スレッドプールで実行した処理も含まれる
+    assert "fetch_snapshot_list" in report
+    assert "== Memory (top 20 retained at the end of the cycle) ==" in report
+
+    # NOTE: 再起動して周期の番号が戻っても、古いレポートから消す
+    rainfall.profiler.init(config)
+    app.do_work(config, 1)
+    rainfall.notifier.join()
+
+    path_list = sorted(tmp_path.glob("*.txt"))
+    assert len(path_list) == 1
+    assert path_list[0].name.endswith(".cycle.00000000.txt")
+
+
+def test_status(config, mocker, time_machine):
+    import copy
+
+    import healthz
+    import my_lib.time
+    import rainfall.notifier
+    import rainfall.status
+    import requests
+
+    config = copy.deepcopy(config)
+    config["status"] = {"host": "127.0.0.1", "port": 0}
+    config["shadow"] = [{"name": "solar-800", "solar_rad_threshold": 800}]
+
+    move_to(time_machine, 12)
+
+    sensor_mock(mocker, last_event=my_lib.time.now(), raining_sum=10, precip_sum=1, solar_rad=0)
+    mocker.patch("rainfall.voice.presynthesize")
+
+    rainfall.status.start(config)
+    url = "http://{}:{}".format(*rainfall.status.get_address())
+
+    assert requests.get(f"{url}/healthz", timeout=5).status_code == 503
+
+    app.do_work(config, 1)
+    rainfall.notifier.join()
+
+    # NOTE: do_work の終了時にサーバーは止まるので、直近の結果を返すよう立ち上げ直す
+    rainfall.status.start(config)
+    url = "http://{}:{}".format(*rainfall.status.get_address())
+    query_mock = mocker.patch("rainfall.sensor.query")
+
+    status = requests.get(f"{url}/status", timeout=5).json()
+    assert status["cycle"]["count"] == 0
+    assert status["site"][0]["raining"]
+    assert status["site"][0]["raining_sum"] == 10
+    assert status["site"][0]["precip_sum"] == 1
+    assert status["site"][0]["solar_rad"] == 0
+    # NOTE: シャドー評価の結果も返す
+    assert status["site"][0]["shadow"]["solar-800"]["param"]["solar_rad_threshold"] == 800
+    assert "line" in status["site"][0]["shadow"]["solar-800"]["count"]
+
+    assert 'rainfall_stage_seconds_count{stage="cycle"} 1' in requests.get(f"{url}/metrics", timeout=5).text
+    assert requests.get(f"{url}/healthz", timeout=5).status_code == 200
+    assert healthz.check_status({"host": "127.0.0.1", "port": rainfall.status.get_address()[1]})
+    assert requests.get(f"{url}/unknown", timeout=5).status_code == 404
+
+    # NOTE: 問い合わせに応じて InfluxDB にアクセスしない
+    query_mock.assert_not_called()
+
+
+def test_backtest(config):
+    import my_lib.time
+    import numpy as np
+    import rainfall.backtest
+
+    length = 300
+    raining = np.zeros(length)
+    rain = np.zeros(length)
+    solar_rad = np.full(length, np.nan)
+
+    # NOTE: 11時から 5 時間分のデータ。降り始めは 60分後、80分後 (連続した雨)、200分後 (日射あり)
+    for start, stop in [(60, 75), (80, 90), (200, 210)]:
+        raining[start:stop] = 1
+        rain[start:stop] = 0.1
+    solar_rad[::5] = 0
+    solar_rad[190:205] = 800
+
+    data = {
+        "start": my_lib.time.now().replace(hour=11, minute=0, second=0, microsecond=0).timestamp(),
+        "length": length,
+        "raining": raining,
+        "rain": rain,
+        "solar_rad": solar_rad,
+    }
+    param = rainfall.backtest.make_param(
+        {
+            "solar_rad_threshold": [600, 900],
+            "sum_min": [3],
+            "continuous_min": [30],
+            "voice_threshold": [0.1],
+        }
+    )
+
+    result = rainfall.backtest.evaluate(data, param, config["notify"]["voice"]["hour"])
+
+    assert result["edge"] == 3
+    assert result["line"].tolist() == [1, 2]
+    assert result["voice"].tolist() == [1, 2]
+    assert result["suppressed_solar"].tolist() == [1, 0]
+    assert result["suppressed_continuous"].tolist() == [1, 1]
+    assert result["voice_delay_min"].tolist() == [0, 0]
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# ruff: noqa: S101
+"""記録したセンサーの時系列を再生して、監視ループの処理性能と通知までの遅延を計測します。"""
+
+import contextlib
+import copy
+import datetime
+import json
+import logging
+import os
+import pathlib
+import time
+from unittest import mock
+
+import app
+import pytest
+from bench import backend
+
+CONFIG_FILE = "config.example.yaml"
+SCHEMA_CONFIG = "config.schema"
+# NOTE: 結果を残す場合は、書き出し先を環境変数で指定する (指定しない場合はテスト毎の一時ディレクトリ)
+REPORT_DIR_ENV = "BENCH_REPORT_DIR"
+
+
+class ScenarioEnd(Exception):  # noqa: N818
+    pass
+
+
+@pytest.fixture(scope="module", autouse=True)
+def env_mock():
+    with mock.patch.dict(
+        "os.environ",
+        {
+            "TEST": "true",
+            "NO_COLORED_LOGS": "true",
+        },
+    ) as fixture:
+        yield fixture
+
+
+@pytest.fixture(scope="module", autouse=True)
+def line_mock():
+    with mock.patch(
+        "linebot.v3.messaging.MessagingApi",
+        return_value=True,
+    ) as fixture:
+        yield fixture
+
+
+@pytest.fixture(scope="module", autouse=True)
+def voice_play_mock():
+    with mock.patch.multiple(
+        "my_lib.voice",
+        play=mock.Mock(return_value=True),
+        synthesize=mock.Mock(return_value=True),
+    ) as fixture:
+        yield fixture
+
+
+@pytest.fixture(autouse=True)
+def _clear():
+    import my_lib.notify.line
+    import rainfall.forecast
+    import rainfall.metrics
+    import rainfall.sensor
+    import rainfall.state
+    import rainfall.voice
+
+    my_lib.notify.line.hist_clear()
+    rainfall.forecast.clear()
+    rainfall.metrics.clear()
+    rainfall.sensor.clear()
+    rainfall.state.clear()
+    rainfall.voice.clear()
+
+
+def make_config(server, tmp_path):
+    import my_lib.config
+
+    config = copy.deepcopy(my_lib.config.load(CONFIG_FILE, pathlib.Path(SCHEMA_CONFIG)))
+
+    config["influxdb"]["url"] = server.url
+    config["weather"]["forecast"]["yahoo"]["url"] = f"{server.url}/forecast"
+    # NOTE: 天気予報は Yahoo の代わりのサーバーからのみ取得する
+    config["weather"]["forecast"].pop("tenki", None)
+    config["liveness"]["file"]["watch"] = str(tmp_path / "healthz")
+    config["notify"]["footprint"]["line"]["file"] = str(tmp_path / "notify.line")
+    config["notify"]["footprint"]["voice"]["file"] = str(tmp_path / "notify.voice")
+    config["metrics"]["file"] = str(tmp_path / "rainfall.prom")
+
+    return config
+
+
+def record_notify(mocker, notify_list):
+    import rainfall.monitor
+
+    for mode in ["line", "voice"]:
+        func = getattr(rainfall.monitor, f"notify_{mode}_impl")
+
+        def wrapper(*args, mode=mode, func=func):
+            notify_list.append((mode, time.time()))
+            return func(*args)
+
+        mocker.patch(f"rainfall.monitor.notify_{mode}_impl", side_effect=wrapper)
+
+
+def run_scenario(mocker, time_machine, tmp_path, scenario):
+    import my_lib.time
+    import rainfall.metrics
+    import rainfall.notifier
+    import rainfall.voice
+
+    hour, minute = (int(value) for value in scenario["start"].split(":"))
+    start = my_lib.time.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+    end = start.timestamp() + scenario["duration_min"] * 60
+
+    # NOTE: 仮想時刻は待ち時間の分だけ進める
+    time_machine.move_to(start, tick=False)
+
+    server = backend.Backend(scenario, start.timestamp())
+    server.start()
+
+    config = make_config(server, tmp_path)
+
+    mocker.patch("my_lib.weather.get_weather_yahoo", side_effect=server.get_weather_yahoo)
+    mocker.patch("rainfall.monitor.get_process_start", return_value=start - datetime.timedelta(hours=1))
+
+    notify_list = []
+    record_notify(mocker, notify_list)
+
+    cycle = 0
+    sleep_orig = app.asyncio.sleep
+
+    async def sleep(delay):
+        nonlocal cycle
+        cycle += 1
+
+        # NOTE: 通知が仮想時刻の進み方に左右されないよう、1 周期毎に完了を待つ
+        rainfall.notifier.join()
+        rainfall.voice.join()
+
+        if time.time() + delay > end:
+            raise ScenarioEnd
+        time_machine.shift(delay)
+        await sleep_orig(0)
+
+    mocker.patch("app.asyncio.sleep", side_effect=sleep)
+
+    wall_start = time.perf_counter()
+    with contextlib.suppress(ScenarioEnd):
+        app.do_work(config)
+    wall_sec = time.perf_counter() - wall_start
+
+    server.stop()
+
+    return {
+        "scenario": scenario["name"],
+        "cycle": cycle,
+        "wall_sec": wall_sec,
+        "cycle_per_sec": cycle / wall_sec,
+        **server.stat,
+        "sensor_p50_sec": rainfall.metrics.quantile("sensor", 0.5),
+        "notify": get_latency(scenario, start.timestamp(), notify_list),
+    }
+
+
+def get_latency(scenario, start, notify_list):
+    event_start_list = [start + event["start_min"] * 60 for event in scenario["event"]]
+
+    latency = {"line": [], "voice": []}
+    for mode, notify_time in notify_list:
+        event_start = max(t for t in event_start_list if t <= notify_time)
+        latency[mode].append(notify_time - event_start)
+
+    return latency
+
+
+def save_report(report, tmp_path):
+    report_dir = pathlib.Path(os.environ.get(REPORT_DIR_ENV, tmp_path))
+    report_dir.mkdir(parents=True, exist_ok=True)
+    with (report_dir / f"{report['scenario']}.json").open("w") as file:
+        json.dump(report, file, indent=4)
+
+
+######################################################################
+@pytest.mark.parametrize("name", backend.list_scenario())
+def test_bench(mocker, time_machine, tmp_path, name):
+    scenario = backend.load_scenario(name)
+
+    report = run_scenario(mocker, time_machine, tmp_path, scenario)
+    save_report(report, tmp_path)
+
+    logging.info(
+        "%s: %d cycles (%.1f cycles/sec), %d queries, %d bytes, latency: %s",
+        name,
+        report["cycle"],
+        report["cycle_per_sec"],
+        report["influxdb_query"] + report["forecast_query"],
+        report["bytes_received"] + report["bytes_sent"],
+        report["notify"],
+    )
+
+    expect = scenario["expect"]
+    for mode in ["line", "voice"]:
+        assert len(report["notify"][mode]) == expect[mode], f"{mode} の通知回数が想定と異なります。"
+        assert all(latency <= expect["latency_sec"] for latency in report["notify"][mode]), (
+            f"{mode} の通知が遅れています。"
+        )
+
+    # NOTE: 予報はキャッシュされるので、監視周期毎には取得しない
+    assert report["forecast_query"] < report["cycle"] / 10